@@ -0,0 +1,98 @@
+"""
+Lookup latency benchmark for the webexTriage database.
+
+Fills a scratch database with synthetic requests, then times the lookups the handlers make -
+by card, by room and the due escalation poll - on the migrated schema, and optionally on the
+original schema with no keys or indexes for comparison.
+
+    python benchmarks/bench_db.py --rows 1000000 --legacy
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from migrations import MIGRATIONS, migrate  # noqa: E402
+
+
+LEGACY_SCHEMA = '''CREATE TABLE webexTriage
+                   (card_id text, type text, sender_id text, sender_name text, clicked text, responder_id text,
+                    responder_name text, room_id text, state text, attempt integer, next_due real,
+                    claimed_by text, claim_expires real, created real)'''
+
+QUERIES = {
+    "card": ("SELECT sender_name, sender_id FROM webexTriage WHERE card_id=?", "card"),
+    "room": ("SELECT card_id FROM webexTriage WHERE room_id=?", "room"),
+    "due": ("SELECT card_id FROM webexTriage WHERE state='pending' AND next_due<=? ORDER BY next_due LIMIT 50", "due"),
+}
+
+
+def fill(con, rows, seed):
+    """Insert `rows` requests, most of them long finished and a few still escalating."""
+    rng = random.Random(seed)
+    now = time.time()
+
+    def generate():
+        for i in range(rows):
+            state = "pending" if rng.random() < 0.001 else rng.choice(("accepted", "timed_out"))
+            created = now - rng.uniform(0, 90 * 86400)
+            yield (f"card-{i}", "request", f"person-{i % 5000}", f"Person {i % 5000}", "0", None, None,
+                   f"room-{i}", state, 1, created + 7, None, None, created)
+
+    # Named columns, so the rows fit both the legacy schema and the columns later migrations add
+    con.executemany("""INSERT INTO webexTriage (card_id, type, sender_id, sender_name, clicked, responder_id,
+                                                responder_name, room_id, state, attempt, next_due, claimed_by,
+                                                claim_expires, created)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", generate())
+    con.commit()
+
+
+def time_queries(con, rows, lookups, seed):
+    rng = random.Random(seed)
+    for name, (sql, kind) in QUERIES.items():
+        samples = []
+        for _ in range(lookups):
+            i = rng.randrange(rows)
+            parameter = {"card": f"card-{i}", "room": f"room-{i}", "due": time.time()}[kind]
+            start = time.perf_counter()
+            con.execute(sql, (parameter,)).fetchall()
+            samples.append(time.perf_counter() - start)
+        samples.sort()
+        p50 = samples[len(samples) // 2] * 1e6
+        p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1e6
+        print(f"  {name:<5} p50 {p50:10.1f} us   p99 {p99:10.1f} us")
+
+
+def run(label, setup, rows, lookups, seed):
+    with tempfile.TemporaryDirectory() as directory:
+        con = sqlite3.connect(os.path.join(directory, "bench.db"))
+        con.execute("PRAGMA journal_mode=WAL")
+        setup(con)
+        start = time.perf_counter()
+        fill(con, rows, seed)
+        print(f"{label}: inserted {rows} rows in {time.perf_counter() - start:.1f} s")
+        time_queries(con, rows, lookups, seed)
+        con.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--lookups", type=int, default=1000)
+    parser.add_argument("--legacy", action="store_true", help="also time the original unindexed schema")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    run(f"schema v{len(MIGRATIONS)}", migrate, args.rows, args.lookups, args.seed)
+    if args.legacy:
+        # Full table scans are slow, so far fewer lookups are timed on the legacy schema
+        run("legacy", lambda con: con.execute(LEGACY_SCHEMA), args.rows, max(10, args.lookups // 100), args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""
+End to end load benchmark.
+
+Starts the fake Webex server and the bot, both on local ports with a fresh database, then fires
+synthetic webhooks at the bot the way Webex would: N emergencies at once, each followed by a doctor
+accepting its card as soon as it is posted (or after --accept-delay), alongside ordinary chat messages. Reports the webhook
+latency per route, throughput, the time from each emergency to its card and to the patient being
+added to a room, and the bot's outbound send counts. Nothing leaves the machine, and the fake
+server's delays and faults are seeded so runs can be compared. With --instances the bot is run as a
+cluster of that many instances sharing the database, and the webhooks are spread between them as a
+load balancer would.
+
+    python benchmarks/bench_load.py --emergencies 50 --chatter 500 --latency 50 --jitter 20 --send-rate 50
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from logtool import DOCTORSROOM, ENVELOPE, free_port, percentile, wait_ready  # noqa: E402
+
+
+def report(name, samples):
+    print(f"{name:<22} n={len(samples):<6} p50 {percentile(samples, 0.5) * 1000:8.1f} ms   "
+          f"p99 {percentile(samples, 0.99) * 1000:8.1f} ms   max {max(samples, default=float('nan')) * 1000:8.1f} ms")
+
+
+class Load:
+    """Posts the synthetic webhooks and keeps the timings."""
+
+    def __init__(self, bots, webex):
+        self.bots = itertools.cycle(bots)
+        self.webex = webex
+        self.latencies = {"messages": [], "cards": []}
+        self.to_card = []
+        self.to_room = []
+        self.failures = 0
+        self.lost = 0
+
+    async def post(self, route, resource, data):
+        start = time.perf_counter()
+        response = await next(self.bots).post(f"/{route}", json=dict(ENVELOPE, resource=resource, data=data))
+        self.latencies[route].append(time.perf_counter() - start)
+        if response.status_code != 200:
+            self.failures += 1
+
+    async def emergency(self, number, timeout, accept_delay=0):
+        patient = f"patient-{number}"
+        start = time.time()
+        waiting = asyncio.ensure_future(self.webex.get(f"/bench/cards/{patient}", params={"timeout": timeout}))
+        await self.post("messages", "messages", {"id": f"msg-{patient}", "personId": patient,
+                                                 "roomId": "direct", "personEmail": f"{patient}@example.com"})
+        card = await waiting
+        if card.status_code != 200:
+            # The bot gave up on the emergency, e.g. a Webex error it doesn't retry
+            self.lost += 1
+            return
+        self.to_card.append(card.json()["at"] - start)
+        await asyncio.sleep(accept_delay)
+        added = asyncio.ensure_future(self.webex.get(f"/bench/added/{patient}", params={"timeout": timeout}))
+        action = {"id": f"action-{patient}", "messageId": card.json()["id"], "personId": f"doctor-{number % 5}",
+                  "roomId": DOCTORSROOM}
+        # The bot reads which request on a queue card was accepted from the click's inputs
+        await self.webex.post("/bench/actions", json=dict(action, inputs=card.json()["inputs"]))
+        await self.post("cards", "attachmentActions", action)
+        added = await added
+        if added.status_code != 200:
+            self.lost += 1
+            return
+        self.to_room.append(added.json()["at"] - start)
+
+    async def chatter(self, number):
+        await self.post("messages", "messages", {"id": f"chat-person-{number}", "personId": f"person-{number}",
+                                                 "roomId": "direct"})
+
+
+async def run(args, bot_urls, webex_url):
+    limits = httpx.Limits(max_connections=args.emergencies + args.concurrency + 10)
+    bots = [httpx.AsyncClient(base_url=bot_url, limits=limits, timeout=args.timeout) for bot_url in bot_urls]
+    async with httpx.AsyncClient(base_url=webex_url, limits=limits, timeout=args.timeout + 5) as webex:
+        load = Load(bots, webex)
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def chatter(number):
+            async with semaphore:
+                await load.chatter(number)
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*[load.emergency(number, args.timeout, args.accept_delay)
+                                         for number in range(args.emergencies)],
+                                       *[chatter(number) for number in range(args.chatter)], return_exceptions=True)
+        elapsed = time.perf_counter() - start
+        errors = [result for result in results if isinstance(result, Exception)]
+        webhooks = sum(len(samples) for samples in load.latencies.values())
+
+        print(f"{args.emergencies} emergencies and {args.chatter} chat messages in {elapsed:.2f}s, "
+              f"{webhooks / elapsed:.0f} webhooks/s, {load.failures} non-200 responses, {load.lost} emergencies lost, "
+              f"{len(errors)} errors")
+        report("webhook /messages", load.latencies["messages"])
+        report("webhook /cards", load.latencies["cards"])
+        report("emergency to card", load.to_card)
+        report("emergency to room", load.to_room)
+        print(f"fake Webex: {(await webex.get('/bench/stats')).json()}")
+        # The bot's own view, the time spent in the handlers and what it sent
+        prefixes = ("triage_webhook_seconds_sum", "triage_webhook_seconds_count", "triage_dispatcher_sends_total")
+        for number, bot in enumerate(bots):
+            metrics = [line for line in (await bot.get("/metrics")).text.splitlines() if line.startswith(prefixes)]
+            print("\n".join(f"{number} {line}" if len(bots) > 1 else line for line in metrics))
+            await bot.aclose()
+        if errors:
+            print(f"first error: {errors[0]!r}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--emergencies", type=int, default=20, help="emergencies sent at once")
+    parser.add_argument("--chatter", type=int, default=200, help="ordinary messages sent alongside them")
+    parser.add_argument("--concurrency", type=int, default=20, help="chat messages in flight at once")
+    parser.add_argument("--latency", type=float, default=50, help="milliseconds the fake Webex takes per call")
+    parser.add_argument("--jitter", type=float, default=20)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0)
+    parser.add_argument("--send-rate", type=float, default=10, help="the bot's WEBEX_SEND_RATE")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for each card and room")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--accept-delay", type=float, default=0,
+                        help="seconds a doctor takes to accept a card, to leave time for reminders")
+    parser.add_argument("--queue-card-seconds", type=float, default=0,
+                        help="the bot's QUEUE_CARD_SECONDS, to list the requests on one queue card")
+    parser.add_argument("--instances", type=int, default=1,
+                        help="bot instances run as a cluster, each with its own --send-rate")
+    parser.add_argument("--event-log", help="keep the bot's event log here, e.g. to replay it with logtool.py")
+    args = parser.parse_args()
+
+    webex_port, bot_ports = free_port(), [free_port() for _ in range(args.instances)]
+    webex_url, bot_urls = f"http://127.0.0.1:{webex_port}", [f"http://127.0.0.1:{port}" for port in bot_ports]
+    with tempfile.TemporaryDirectory() as directory:
+        env = dict(os.environ, WEBEX_TEAMS_ACCESS_TOKEN="bench", TEAMS_BOT_URL=bot_urls[0],
+                   TEAMS_BOT_EMAIL="bot@example.com",
+                   DOCTORS_ROOM=DOCTORSROOM, DATABASE_NAME=os.path.join(directory, "bench.db"),
+                   EVENT_LOG=os.path.abspath(args.event_log) if args.event_log else os.path.join(directory, "events.jsonl"),
+                   WEBEX_BASE_URL=f"{webex_url}/v1/", WEBEX_SEND_RATE=str(args.send_rate),
+                   QUEUE_CARD_SECONDS=str(args.queue_card_seconds),
+                   WEBEX_SEND_BURST=str(max(20, int(args.send_rate * 2))),
+                   CLUSTER_HEARTBEAT_SECONDS="1" if args.instances > 1 else "0")
+        log = open(os.path.join(directory, "bot.log"), "w")
+        processes = [
+            subprocess.Popen([sys.executable, os.path.join(ROOT, "benchmarks", "fake_webex.py"), "--port", str(webex_port),
+                              "--latency", str(args.latency), "--jitter", str(args.jitter),
+                              "--error-rate", str(args.error_rate), "--rate-limit-rate", str(args.rate_limit_rate),
+                              "--seed", str(args.seed)], cwd=ROOT),
+        ] + [
+            subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(bot_port),
+                              "--log-level", "warning"], cwd=ROOT, env=env, stderr=log)
+            for bot_port in bot_ports
+        ]
+        try:
+            async def start():
+                async with httpx.AsyncClient() as client:
+                    await wait_ready(client, f"{webex_url}/bench/stats", processes[0])
+                    for bot_url, process in zip(bot_urls, processes[1:]):
+                        await wait_ready(client, f"{bot_url}/metrics", process)
+                await run(args, bot_urls, webex_url)
+            asyncio.get_event_loop().run_until_complete(start())
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait()
+            log.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Startup benchmark.
+
+Measures, each in a fresh interpreter, how long `import main` takes and how long uvicorn takes from
+launch until the bot answers its first HTTP request. Webex is pointed at an address nothing listens
+on, so the numbers show the server doesn't wait for Webex before it is ready.
+
+    python benchmarks/bench_startup.py --runs 5
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORT = "import time; start = time.perf_counter(); import main; print(time.perf_counter() - start)"
+
+
+def environment(directory):
+    env = dict(os.environ, WEBEX_TEAMS_ACCESS_TOKEN="benchmark", TEAMS_BOT_URL="http://127.0.0.1:9",
+               TEAMS_BOT_EMAIL="bot@example.com", DOCTORS_ROOM="benchmark",
+               DATABASE_NAME=os.path.join(directory, "startup.db"), HTTPS_PROXY="http://127.0.0.1:9")
+    return env
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def time_import(env):
+    output = subprocess.run([sys.executable, "-c", IMPORT], cwd=ROOT, env=env, capture_output=True, text=True,
+                            check=True).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def time_ready(env, timeout=30):
+    port = free_port()
+    start = time.perf_counter()
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(port)], cwd=ROOT, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                urllib.request.urlopen(f"http://127.0.0.1:{port}/openapi.json", timeout=1)
+                return time.perf_counter() - start
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.005)
+        raise RuntimeError("Server didn't start.")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def report(name, samples):
+    print(f"{name:<8} median {statistics.median(samples) * 1000:7.0f} ms  "
+          f"min {min(samples) * 1000:7.0f} ms  max {max(samples) * 1000:7.0f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        env = environment(directory)
+        report("import", [time_import(env) for _ in range(args.runs)])
+        report("ready", [time_ready(env) for _ in range(args.runs)])
+
+
+if __name__ == "__main__":
+    main()
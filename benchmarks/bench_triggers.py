@@ -0,0 +1,70 @@
+"""
+Microbenchmark for trigger matching.
+
+Compares the compiled trigger engine against the original substring scan over a synthetic corpus
+of chat messages, a small share of which contain a trigger word or a typo of one. The original scan
+is run both over the original seven keywords and over every spelling the engine compiles, which
+is what it would take to cover the same typos without the engine.
+
+    python benchmarks/bench_triggers.py --messages 200000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from triggers import DEFAULT_TRIGGERS, TriggerEngine  # noqa: E402
+
+
+LEGACY_TRIGGERS = ["help", "emergency", "support", "assistance", "hlep", "emergence", "assist"]
+VOCABULARY = ("the patient is stable now we are on the ward can you check bed four results came back "
+              "blood pressure normal thanks see you at handover shift notes updated please call me "
+              "later about the rota meeting tomorrow morning").split()
+TRIGGER_WORDS = ["help", "hlep", "emergency", "emergence", "assistance", "support", "HELP!"]
+
+
+def corpus(count, trigger_rate, seed):
+    """Build `count` synthetic messages, `trigger_rate` of them containing a trigger word."""
+    rng = random.Random(seed)
+    messages = []
+    for _ in range(count):
+        words = rng.choices(VOCABULARY, k=rng.randint(3, 40))
+        if rng.random() < trigger_rate:
+            words.insert(rng.randrange(len(words) + 1), rng.choice(TRIGGER_WORDS))
+        messages.append(" ".join(words))
+    return messages
+
+
+def legacy_match(message):
+    return any(word in message.lower() for word in LEGACY_TRIGGERS)
+
+
+def run(name, match, messages):
+    start = time.perf_counter()
+    found = sum(1 for message in messages if match(message))
+    elapsed = time.perf_counter() - start
+    print(f"{name:<12} {elapsed * 1e9 / len(messages):8.0f} ns/message  {found} matched")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--trigger-rate", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    messages = corpus(args.messages, args.trigger_rate, args.seed)
+    start = time.perf_counter()
+    engine = TriggerEngine(DEFAULT_TRIGGERS)
+    print(f"compiled {len(engine.entries)} spellings in {(time.perf_counter() - start) * 1e3:.1f} ms")
+    spellings = list(engine.entries)
+    run("legacy", legacy_match, messages)
+    run("legacy-all", lambda message: any(word in message.lower() for word in spellings), messages)
+    run("engine", engine.match, messages)
+
+
+if __name__ == "__main__":
+    main()
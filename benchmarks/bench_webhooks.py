@@ -0,0 +1,100 @@
+"""
+Microbenchmark for webhook body parsing.
+
+Compares the original pydantic envelope models, which validated every field of the envelope
+into a model with an untyped `data` dict, against the shared envelope with typed, slotted data,
+decoded with the standard json module and with orjson if it is installed.
+
+    python benchmarks/bench_webhooks.py --bodies 100000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from typing import Optional
+
+from pydantic import BaseModel
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import payloads  # noqa: E402
+from payloads import ActionData, MessageData, parse_webhook  # noqa: E402
+
+
+class Message(BaseModel):
+    id: str
+    name: str
+    targetUrl: str
+    resource: str
+    event: str
+    filter: Optional[str] = None
+    orgId: str
+    createdBy: str
+    appId: str
+    ownedBy: str
+    status: str
+    created: str
+    actorId: str
+    data: dict
+
+
+def bodies(count):
+    """Build `count` webhook bodies, one in ten a card click, the rest messages, as Webex sends them."""
+    envelope = {"id": "Y2lzY29zcGFyazovL3VzL1dFQkhPT0svZjRlNjA1NjAtNjYwMi00ZmIwLWEyNWEtOTQ5ODgxNjA5NDk3",
+                "name": "Message Webhook", "targetUrl": "https://example.com/messages", "filter": None,
+                "orgId": "OTZhYmMyYWEtM2RjYy0xMWU1LWExNTItZmUzNDgxOWNkYzlh", "event": "created",
+                "createdBy": "Y2lzY29zcGFyazovL3VzL1BFT1BMRS8xZjdkZTZkMi0xYjJh",
+                "appId": "Y2lzY29zcGFyazovL3VzL0FQUExJQ0FUSU9OL0MyNzljYjMwYzAyOTE4MGJiNGJkYWViYjA2MWI3OTY1Y2RhMzliNjAyOTdjODUwM2YyNjZhYmY2NmM5OTllYzFm",
+                "ownedBy": "creator", "status": "active", "created": "2021-03-24T15:10:11.243Z",
+                "actorId": "Y2lzY29zcGFyazovL3VzL1BFT1BMRS8xZjdkZTZkMi0xYjJh"}
+    result = []
+    for number in range(count):
+        if number % 10 == 0:
+            data = {"id": f"action-{number}", "type": "submit", "messageId": f"message-{number}",
+                    "personId": f"person-{number}", "roomId": "room", "created": "2021-03-24T15:10:11.243Z"}
+            result.append((True, json.dumps(dict(envelope, resource="attachmentActions", data=data)).encode()))
+        else:
+            data = {"id": f"message-{number}", "roomId": "room", "roomType": "group", "personId": f"person-{number}",
+                    "personEmail": f"person-{number}@example.com", "created": "2021-03-24T15:10:11.243Z"}
+            result.append((False, json.dumps(dict(envelope, resource="messages", data=data)).encode()))
+    return result
+
+
+def legacy_parse(body, is_action):
+    item = Message.parse_raw(body)
+    return item.data["personId"]
+
+
+def shared_parse(body, is_action):
+    item = parse_webhook(body, ActionData if is_action else MessageData)
+    return item.data.personId
+
+
+def run(name, parse, samples):
+    start = time.process_time()
+    for is_action, body in samples:
+        parse(body, is_action)
+    elapsed = time.process_time() - start
+    print(f"{name:<16} {elapsed * 1e6 / len(samples):8.2f} us CPU/request")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bodies", type=int, default=50000)
+    args = parser.parse_args()
+
+    samples = bodies(args.bodies)
+    run("pydantic", legacy_parse, samples)
+    decoder = payloads.loads
+    payloads.loads = json.loads
+    run("shared json", shared_parse, samples)
+    if decoder is not json.loads:
+        payloads.loads = decoder
+        run("shared orjson", shared_parse, samples)
+    else:
+        print("orjson is not installed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+"""
+Local stand-in for the parts of the Webex API the bot uses, for load testing without Webex.
+
+Serves the messages, people, rooms, memberships and webhooks endpoints from memory under `/v1/`,
+with a configurable delay on every call and a share of calls answered with a server error or a
+429 with Retry-After. Point the bot at it with WEBEX_BASE_URL=http://127.0.0.1:<port>/v1/.
+
+Any message ID the server hasn't seen reads back as an emergency from the person in the ID, e.g.
+`msg-patient-7` is "help please" from `patient-7`, IDs starting with `chat-` read back as ordinary
+chatter, and the text of a message can be set beforehand with `/bench/messages`, as can the inputs
+of a card click with `/bench/actions`. The other `/bench` endpoints let a load generator wait for
+the bot to post a request card, or a queue card listing a request, for a person and to add a
+person to a room.
+
+    python benchmarks/fake_webex.py --port 9000 --latency 50 --jitter 20 --error-rate 0.01 --rate-limit-rate 0.01
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+
+
+BOT = {"id": "bot", "emails": ["bot@example.com"], "displayName": "Triage Bot"}
+
+
+class FakeWebex:
+    """
+    In-memory Webex state and fault injection.
+
+    :param latency: milliseconds added to every call.
+    :param jitter: up to this many milliseconds more or less are added at random.
+    :param error_rate: share of calls answered with 503.
+    :param rate_limit_rate: share of calls answered with 429.
+    :param retry_after: seconds sent in the Retry-After header of a 429.
+    :param seed: seed for the random delays and faults, so runs can be repeated.
+    """
+
+    def __init__(self, latency=0, jitter=0, error_rate=0, rate_limit_rate=0, retry_after=1, seed=1):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.ids = itertools.count(1)
+        self.messages = {}
+        self.rooms = {}
+        self.memberships = []
+        self.webhooks = {}
+        self.actions = {}
+        # People who have sent a message, whose names are looked for in request cards
+        self.senders = set()
+        self.calls = 0
+        self.faults = 0
+        # Times the bot posted a request card for a person, and added a person to a room
+        self.cards = {}
+        self.added = {}
+        self._waiters = {}
+
+    def new_id(self, kind):
+        return f"{kind}-{next(self.ids)}"
+
+    async def fault(self):
+        """Wait out the configured latency and pick whether the call fails, returning the error response if so."""
+        self.calls += 1
+        delay = max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter)) / 1000
+        if delay:
+            await asyncio.sleep(delay)
+        roll = self.random.random()
+        if roll < self.rate_limit_rate:
+            self.faults += 1
+            return JSONResponse({"message": "Too Many Requests"}, status_code=429,
+                                headers={"Retry-After": str(self.retry_after)})
+        if roll < self.rate_limit_rate + self.error_rate:
+            self.faults += 1
+            return JSONResponse({"message": "Service Unavailable"}, status_code=503)
+        return None
+
+    def record(self, table, key, value):
+        table[key] = value
+        for waiter in self._waiters.pop((id(table), key), []):
+            if not waiter.done():
+                waiter.set_result(value)
+
+    async def wait(self, table, key, timeout, after=0):
+        """
+        :returns: the value recorded for `key` later than epoch time `after`, waiting up to `timeout` seconds
+                  for it, or None.
+        """
+        if key in table and table[key]["at"] > after:
+            return table[key]
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiters.setdefault((id(table), key), []).append(waiter)
+        try:
+            return await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+def submitted(element):
+    """:returns: the `data` of the first Action.Submit in a card element, or None."""
+    if isinstance(element, dict):
+        if element.get("type") == "Action.Submit":
+            return element.get("data", {})
+        element = list(element.values())
+    if isinstance(element, list):
+        for item in element:
+            data = submitted(item)
+            if data is not None:
+                return data
+    return None
+
+
+def create_app(webex):
+    """:returns: the ASGI app serving the fake Webex API."""
+    app = FastAPI()
+
+    @app.get("/v1/people/me")
+    async def get_me():
+        return BOT
+
+    @app.get("/v1/people/{person_id}")
+    async def get_person(person_id: str):
+        return {"id": person_id, "emails": [f"{person_id}@example.com"], "displayName": person_id}
+
+    @app.get("/v1/messages/{message_id}")
+    async def get_message(message_id: str):
+        if message_id in webex.messages:
+            message = webex.messages[message_id]
+            webex.senders.add(message["personId"])
+            return message
+        kind, _, person_id = message_id.partition("-")
+        text = "just checking in on the ward" if kind == "chat" else "help please"
+        webex.senders.add(person_id)
+        return {"id": message_id, "personId": person_id, "personEmail": f"{person_id}@example.com", "text": text}
+
+    @app.post("/v1/messages")
+    async def create_message(request: Request):
+        body = await request.json()
+        message = dict(body, id=webex.new_id("message"), personId=BOT["id"], personEmail=BOT["emails"][0])
+        webex.messages[message["id"]] = message
+        if body.get("attachments") and body.get("markdown") == "Card sent." and body.get("roomId"):
+            card = body["attachments"][0]["content"]
+            # The card names the sender, which is the person ID for the fake people. A queue card has a row per
+            # request, so a click is for the request whose row holds the button, a request card has one button
+            for element in card["body"]:
+                for word in json.dumps(element).replace('"', " ").split():
+                    if word in webex.senders:
+                        inputs = submitted(element) or submitted(card["body"]) or {}
+                        webex.record(webex.cards, word, {"id": message["id"], "at": time.time(), "inputs": inputs})
+        return message
+
+    @app.delete("/v1/messages/{message_id}")
+    async def delete_message(message_id: str):
+        webex.messages.pop(message_id, None)
+        return Response(status_code=204)
+
+    @app.post("/v1/rooms")
+    async def create_room(request: Request):
+        room = dict(await request.json(), id=webex.new_id("room"))
+        webex.rooms[room["id"]] = room
+        return room
+
+    @app.delete("/v1/rooms/{room_id}")
+    async def delete_room(room_id: str):
+        webex.rooms.pop(room_id, None)
+        return Response(status_code=204)
+
+    @app.get("/v1/memberships")
+    async def list_memberships(roomId: str = None, personId: str = None):
+        items = [membership for membership in webex.memberships
+                 if roomId in (None, membership["roomId"]) and personId in (None, membership["personId"])]
+        return {"items": items}
+
+    @app.post("/v1/memberships")
+    async def create_membership(request: Request):
+        membership = dict(await request.json(), id=webex.new_id("membership"))
+        webex.memberships.append(membership)
+        webex.record(webex.added, membership["personId"], {"room": membership["roomId"], "at": time.time()})
+        return membership
+
+    @app.get("/v1/attachment/actions/{action_id}")
+    async def get_action(action_id: str):
+        if action_id not in webex.actions:
+            return JSONResponse({"message": "Not Found"}, status_code=404)
+        return webex.actions[action_id]
+
+    @app.get("/v1/webhooks")
+    async def list_webhooks():
+        return {"items": list(webex.webhooks.values())}
+
+    @app.post("/v1/webhooks")
+    async def create_webhook(request: Request):
+        webhook = dict(await request.json(), id=webex.new_id("webhook"), status="active")
+        webex.webhooks[webhook["id"]] = webhook
+        return webhook
+
+    @app.put("/v1/webhooks/{webhook_id}")
+    async def update_webhook(webhook_id: str, request: Request):
+        webex.webhooks[webhook_id].update(await request.json())
+        return webex.webhooks[webhook_id]
+
+    @app.post("/bench/messages")
+    async def seed_message(request: Request):
+        """Set the text the bot reads back for a message, from an `id`, `personId` and `text`."""
+        body = await request.json()
+        message = {"id": body["id"], "personId": body["personId"], "personEmail": f"{body['personId']}@example.com",
+                   "text": body["text"]}
+        webex.messages[message["id"]] = message
+        return message
+
+    @app.post("/bench/actions")
+    async def seed_action(request: Request):
+        """Set the card click read back for an action, from an `id`, `messageId`, `personId`, `roomId` and `inputs`."""
+        action = dict(await request.json(), type="submit")
+        webex.actions[action["id"]] = action
+        return action
+
+    @app.get("/bench/cards/{person_id}")
+    async def wait_card(person_id: str, timeout: float = 60, after: float = 0):
+        """Wait for the bot to post a request card for a person, later than epoch time `after`."""
+        return await webex.wait(webex.cards, person_id, timeout, after) or JSONResponse({}, status_code=404)
+
+    @app.get("/bench/added/{person_id}")
+    async def wait_added(person_id: str, timeout: float = 60, after: float = 0):
+        """Wait for the bot to add a person to a room, later than epoch time `after`."""
+        return await webex.wait(webex.added, person_id, timeout, after) or JSONResponse({}, status_code=404)
+
+    @app.get("/bench/stats")
+    async def stats():
+        return {"calls": webex.calls, "faults": webex.faults, "messages": len(webex.messages),
+                "rooms": len(webex.rooms), "memberships": len(webex.memberships)}
+
+    async def inject_faults(scope, receive, send):
+        # Plain ASGI rather than middleware, so every Webex call is delayed before it is routed
+        if scope["type"] == "http" and scope["path"].startswith("/v1/"):
+            error = await webex.fault()
+            if error is not None:
+                return await error(scope, receive, send)
+        return await app(scope, receive, send)
+
+    return inject_faults
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency", type=float, default=0, help="milliseconds added to every call")
+    parser.add_argument("--jitter", type=float, default=0, help="milliseconds of random variation in the latency")
+    parser.add_argument("--error-rate", type=float, default=0, help="share of calls answered with 503")
+    parser.add_argument("--rate-limit-rate", type=float, default=0, help="share of calls answered with 429")
+    parser.add_argument("--retry-after", type=float, default=1, help="Retry-After seconds sent with a 429")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    webex = FakeWebex(args.latency, args.jitter, args.error_rate, args.rate_limit_rate, args.retry_after, args.seed)
+    uvicorn.run(create_app(webex), host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
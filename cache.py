@@ -0,0 +1,98 @@
+"""
+Bounded in-memory cache for Webex lookups that repeat across webhooks (e.g. people).
+
+Entries expire after a fixed TTL and the least recently used entry is evicted once the cache
+is full. Concurrent misses for the same key share one load instead of each calling Webex.
+"""
+import asyncio
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    TTL + LRU cache with single-flight loading.
+
+    :param maxsize: the most entries kept before the least recently used is evicted.
+    :param ttl: seconds an entry is served before it is loaded again.
+    """
+
+    def __init__(self, maxsize=512, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._pending = {}
+
+    async def get(self, key, loader):
+        """
+        Return the cached value for `key`, loading it with `await loader(key)` on a miss.
+        Errors from the loader are passed to every caller waiting on the key and are not cached,
+        neither are None results.
+
+        :param key: cache key.
+        :param loader: coroutine function used to load a missing value.
+        :returns: the cached or freshly loaded value.
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires, value = entry
+            if expires > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._entries[key]
+
+        pending = self._pending.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            return await asyncio.shield(pending)
+
+        self.misses += 1
+        future = asyncio.get_event_loop().create_future()
+        self._pending[key] = future
+        try:
+            value = await loader(key)
+        except Exception as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved in case nobody else was waiting on it
+            future.exception()
+            raise
+        except BaseException:
+            future.cancel()
+            raise
+        finally:
+            del self._pending[key]
+        if value is not None:
+            self.set(key, value)
+        future.set_result(value)
+        return value
+
+    def set(self, key, value):
+        """Store a value, evicting the least recently used entry if the cache is full."""
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        """Drop a single entry."""
+        self._entries.pop(key, None)
+
+    def clear(self):
+        """Drop every entry."""
+        self._entries.clear()
+
+    def stats(self):
+        """:returns: dict of the cache size and hit/miss counters."""
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+        }
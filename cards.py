@@ -0,0 +1,137 @@
+"""
+Adaptive card templates.
+
+Card definitions are loaded from the `cards` folder once at startup, checked, and serialised to
+JSON text ahead of time. Sending a card then only fills in the dynamic fields - marked `{{field}}`
+inside any string - rather than rebuilding and re-encoding the whole card.
+
+An element with an `id` of `each:<list>` is repeated for every entry of that list when the card
+is rendered, with the entry's keys as its fields, e.g. one row per on-call doctor.
+"""
+import json
+import os
+import re
+
+from webex import RawJSON
+
+
+CONTENTTYPE = "application/vnd.microsoft.card.adaptive"
+""" Element properties holding lists of further elements, checked when a card is validated"""
+ELEMENTLISTS = ("body", "items", "columns", "actions")
+PLACEHOLDER = re.compile(r'(,?)"\{\{@(\w+)\}\}"(,?)|\{\{(\w+)\}\}')
+
+
+def validate(name, content):
+    """
+    Check a card has the shape Webex expects, raising ValueError naming the problem if not.
+
+    :param name: name of the card, used in the error.
+    :param content: the card's parsed JSON.
+    """
+    if not isinstance(content, dict) or content.get("type") != "AdaptiveCard":
+        raise ValueError(f"Card '{name}' is not an AdaptiveCard.")
+    if "version" not in content:
+        raise ValueError(f"Card '{name}' has no version.")
+    if not isinstance(content.get("body"), list) or not content["body"]:
+        raise ValueError(f"Card '{name}' has no body.")
+
+    def check(elements, path):
+        for index, element in enumerate(elements):
+            if not isinstance(element, dict) or "type" not in element:
+                raise ValueError(f"Card '{name}' element {path}[{index}] has no type.")
+            for key in ELEMENTLISTS:
+                if key in element:
+                    check(element[key], f"{path}[{index}].{key}")
+
+    check(content["body"], "body")
+    check(content.get("actions", []), "actions")
+
+
+class CardTemplate:
+    """
+    A pre-serialised card.
+
+    :param name: name of the card.
+    :param content: the card's parsed JSON (the `content` of the Webex attachment).
+    """
+
+    def __init__(self, name, content):
+        validate(name, content)
+        self.name = name
+        self.lists = {}
+        body = []
+        for element in content["body"]:
+            element_id = element.get("id", "")
+            if element_id.startswith("each:"):
+                list_name = element_id[len("each:"):]
+                entry = {key: value for key, value in element.items() if key != "id"}
+                self.lists[list_name] = self._compile(json.dumps(entry, separators=(",", ":")))
+                element = "{{@" + list_name + "}}"
+            body.append(element)
+        attachment = [{"contentType": CONTENTTYPE, "content": dict(content, body=body)}]
+        self._parts = self._compile(json.dumps(attachment, separators=(",", ":")))
+        self.fields = {part[1] for part in self._parts if part[0] == "field"}
+
+    @classmethod
+    def from_file(cls, path):
+        """Load a card from a JSON file, named after the file."""
+        with open(path, encoding="utf-8") as card_file:
+            return cls(os.path.splitext(os.path.basename(path))[0], json.load(card_file))
+
+    @staticmethod
+    def _compile(text):
+        parts = []
+        position = 0
+        for found in PLACEHOLDER.finditer(text):
+            parts.append(("text", text[position:found.start()]))
+            if found.group(2):
+                parts.append(("list", found.group(2), found.group(1), found.group(3)))
+            else:
+                parts.append(("field", found.group(4)))
+            position = found.end()
+        parts.append(("text", text[position:]))
+        return parts
+
+    def _render(self, parts, values):
+        pieces = []
+        for part in parts:
+            if part[0] == "text":
+                pieces.append(part[1])
+            elif part[0] == "field":
+                # Encode the value as JSON and drop the quotes, it sits inside an existing string
+                pieces.append(json.dumps(str(values[part[1]]))[1:-1])
+            else:
+                _, list_name, before, after = part
+                entries = [self._render(self.lists[list_name], entry) for entry in values[list_name]]
+                joined = ",".join(entries)
+                # Keep the commas either side of the list valid whether it renders empty or not
+                if entries:
+                    pieces.append(before + joined + after)
+                elif before and after:
+                    pieces.append(",")
+        return "".join(pieces)
+
+    def render(self, **values):
+        """
+        Fill in the card's fields.
+
+        :param values: a value for every `{{field}}` in the card, and a list of dicts for every repeated element.
+        :returns: RawJSON for the message's `attachments`.
+        :raises KeyError: if a field has no value.
+        """
+        return RawJSON(self._render(self._parts, values))
+
+
+def load_cards(directory):
+    """
+    Load and compile every card in a folder.
+
+    :param directory: folder of `<name>.json` card files.
+    :returns: dict of card name to CardTemplate.
+    """
+    cards = {}
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith(".json"):
+            card = CardTemplate.from_file(os.path.join(directory, filename))
+            cards[card.name] = card
+    return cards
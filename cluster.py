@@ -0,0 +1,80 @@
+"""
+Cluster membership, leadership and work partitioning for several bot instances sharing one database.
+
+Each instance heartbeats into the shared database and reads back the members heard from recently.
+One of them holds the leader lease, renewed with every heartbeat, and runs the work only one
+instance should do, e.g. reconciling the webhooks. Work keyed by a card - escalation steps and
+sweeping stale rooms - is split between the members by rendezvous hashing on the card ID, so each
+member takes an even share and only the dead member's share moves when the membership changes.
+
+An instance which dies stops heartbeating, and once it hasn't been heard from for a few heartbeats
+the others drop it, take over its share of the cards and, if it was the leader, the lease. Escalation
+steps are still claimed in the database, so a card moving between members is never escalated twice.
+"""
+import time
+import zlib
+
+from loguru import logger
+
+
+""" Heartbeats a member can miss before it is treated as dead, and before it is removed altogether"""
+MISSEDHEARTBEATS = 3
+FORGETHEARTBEATS = 100
+
+
+class Cluster:
+    """
+    This instance's view of the cluster.
+
+    :param db: Database shared by the cluster.
+    :param worker_id: ID of this instance.
+    :param interval: seconds between heartbeats, 0 to run on its own, owning everything and always leading.
+    """
+
+    def __init__(self, db, worker_id, interval=0):
+        self.db = db
+        self.worker_id = worker_id
+        self.interval = interval
+        self.members = [worker_id]
+        self.leader = not interval
+
+    @property
+    def enabled(self):
+        return bool(self.interval)
+
+    async def heartbeat(self):
+        """
+        Tell the cluster this instance is alive, refresh the members and renew or try to take the leader lease.
+
+        :returns: True if this instance has just become the leader.
+        """
+        now = time.time()
+        await self.db.heartbeat(self.worker_id, now - self.interval * FORGETHEARTBEATS)
+        members = await self.db.live_members(now - self.interval * MISSEDHEARTBEATS)
+        if members != self.members:
+            logger.info(f"Cluster members: {', '.join(members)}")
+            self.members = members or [self.worker_id]
+        was_leader = self.leader
+        self.leader = await self.db.acquire_lease("leader", self.worker_id, self.interval * MISSEDHEARTBEATS)
+        if self.leader != was_leader:
+            logger.info(f"{'Took' if self.leader else 'Lost'} the cluster leader lease.")
+        return self.leader and not was_leader
+
+    async def leave(self):
+        """Leave the cluster, handing this instance's share of the work and any lease over straight away."""
+        if self.enabled:
+            await self.db.leave(self.worker_id)
+
+    def size(self):
+        """:returns: number of live members."""
+        return len(self.members)
+
+    def owner(self, key):
+        """:returns: ID of the member whose share of the work `key` is in."""
+        if len(self.members) == 1:
+            return self.members[0]
+        return max(self.members, key=lambda member: zlib.crc32(f"{member}/{key}".encode()))
+
+    def owns(self, key):
+        """:returns: True if `key`, e.g. a card ID, is in this instance's share of the work."""
+        return not self.enabled or self.owner(key) == self.worker_id
@@ -0,0 +1,527 @@
+"""
+Data access for the webexTriage database.
+
+Reads run on a small pool of reader threads, each with its own connection, so concurrent handlers
+never share a cursor and a read held up by a lock never blocks the event loop. Writes are handed
+to a single writer thread which collects whatever arrives within a short window and commits it
+together (group commit), so a burst of emergencies costs one fsync per batch rather than per update.
+The database runs in WAL mode, which lets readers carry on while the writer commits.
+Reads and writes are both coroutines, writes return once their batch has been committed.
+"""
+import asyncio
+import functools
+import queue
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from loguru import logger
+
+from metrics import histogram
+from migrations import migrate
+from tracing import span
+
+
+QUERY_SECONDS = histogram("triage_db_query_seconds", "Time taken by database reads, and by writes until committed.",
+                          ("operation",))
+READ_SECONDS = QUERY_SECONDS.labels("read")
+WRITE_SECONDS = QUERY_SECONDS.labels("write")
+COMMIT_SECONDS = histogram("triage_db_commit_seconds", "Time taken to commit a batch of writes.")
+BATCH_SIZE = histogram("triage_db_batch_size", "Writes committed together in a batch.",
+                       buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+TABLE = re.compile(r"\b(?:FROM|INTO|UPDATE)\s+(\w+)", re.IGNORECASE)
+""" Columns of webexTriage, which are kept in webexTriageArchive along with when they were archived"""
+REQUESTCOLUMNS = ("card_id, type, sender_id, sender_name, clicked, responder_id, responder_name, room_id, state, "
+                  "attempt, next_due, claimed_by, claim_expires, created, specialty")
+
+
+@functools.lru_cache(maxsize=256)
+def table_name(sql):
+    """:returns: the first table a statement uses, to label its trace span."""
+    found = TABLE.search(sql)
+    return found.group(1) if found else sql.split(None, 1)[0]
+
+
+class Database:
+    """
+    Connection management and queries for the triage bot.
+
+    :param path: path to the SQLite database file.
+    :param commit_interval: seconds the writer waits for more writes before committing a batch.
+    :param max_batch: the most write statements committed in one batch.
+    :param timeout: seconds a connection waits on a lock held by another process.
+    :param readers: number of reader threads.
+    """
+
+    def __init__(self, path, commit_interval=0.005, max_batch=500, timeout=10, readers=4):
+        self.path = path
+        self.commit_interval = commit_interval
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self.readers = readers
+        self.batches = 0
+        self.writes = 0
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._writer = None
+        self._reader_pool = None
+
+    def connect(self, check_same_thread=True):
+        """
+        :param check_same_thread: only allow the connection to be used from the thread which opened it.
+        :returns: a new connection set up for WAL mode.
+        """
+        con = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=check_same_thread)
+        con.execute("PRAGMA journal_mode=WAL")
+        # Safe from corruption in WAL mode, only the last commits can be lost on power failure
+        con.execute("PRAGMA synchronous=NORMAL")
+        return con
+
+    def start(self):
+        """Bring the schema up to date and start the writer and reader threads."""
+        con = self.connect()
+        try:
+            migrate(con)
+        finally:
+            con.close()
+        self._writer = threading.Thread(target=self._write_loop, name="db-writer", daemon=True)
+        self._writer.start()
+        self._reader_pool = ThreadPoolExecutor(max_workers=self.readers, thread_name_prefix="db-reader")
+
+    def close(self):
+        """Commit any queued writes, stop the writer and reader threads and close every connection."""
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join()
+            self._writer = None
+        if self._reader_pool is not None:
+            self._reader_pool.shutdown(wait=True)
+            self._reader_pool = None
+        with self._lock:
+            # The reader threads have finished, so their connections can be closed from here
+            for con in self._connections:
+                con.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+    @property
+    def reader(self):
+        """The calling reader thread's connection."""
+        con = getattr(self._local, "con", None)
+        if con is None:
+            con = self.connect(check_same_thread=False)
+            self._local.con = con
+            with self._lock:
+                self._connections.append(con)
+        return con
+
+    async def run(self, function, *args):
+        """
+        Run `function(*args)` on a reader thread.
+
+        :returns: whatever the function returns.
+        """
+        if self._reader_pool is None:
+            raise RuntimeError("Database has not been started.")
+        return await asyncio.get_event_loop().run_in_executor(self._reader_pool, function, *args)
+
+    async def fetchone(self, sql, params=()):
+        with READ_SECONDS.time(), span("sqlite read", table=table_name(sql)):
+            return await self.run(lambda: self.reader.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql, params=()):
+        with READ_SECONDS.time(), span("sqlite read", table=table_name(sql)):
+            return await self.run(lambda: self.reader.execute(sql, params).fetchall())
+
+    def queued(self):
+        """:returns: number of writes waiting for the writer."""
+        return self._queue.qsize()
+
+    def submit(self, *statements):
+        """
+        Queue write statements to be committed together in the next batch.
+
+        :param statements: (sql, params) tuples.
+        :returns: concurrent.futures.Future resolving to the list of rowcounts once committed.
+        """
+        if self._writer is None:
+            raise RuntimeError("Database has not been started.")
+        future = Future()
+        self._queue.put((statements, future))
+        return future
+
+    async def write(self, *statements):
+        """
+        Commit write statements through the group commit writer.
+
+        :param statements: (sql, params) tuples.
+        :returns: list of the rowcount of each statement.
+        """
+        with WRITE_SECONDS.time(), span("sqlite write", table=table_name(statements[0][0]),
+                                        statements=len(statements)):
+            return await asyncio.wrap_future(self.submit(*statements))
+
+    def _write_loop(self):
+        con = self.connect()
+        # Transactions are managed by hand so a whole batch goes in one commit
+        con.isolation_level = None
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.commit_interval
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._commit(con, batch)
+        con.close()
+
+    def _commit(self, con, batch):
+        results = []
+        start = time.perf_counter()
+        try:
+            con.execute("BEGIN IMMEDIATE")
+            for statements, future in batch:
+                # Each submit is applied whole or not at all, without failing the rest of the batch
+                con.execute("SAVEPOINT submit")
+                try:
+                    rowcounts = [con.execute(sql, params).rowcount for sql, params in statements]
+                    results.append((future, rowcounts, None))
+                except sqlite3.Error as e:
+                    con.execute("ROLLBACK TO submit")
+                    results.append((future, None, e))
+                con.execute("RELEASE submit")
+            con.execute("COMMIT")
+        except sqlite3.Error as e:
+            logger.error(f"Group commit failed: {e}")
+            if con.in_transaction:
+                con.execute("ROLLBACK")
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        COMMIT_SECONDS.observe(time.perf_counter() - start)
+        BATCH_SIZE.observe(len(batch))
+        self.batches += 1
+        self.writes += len(batch)
+        for future, rowcounts, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(rowcounts)
+
+    # Requests
+
+    async def add_request(self, card_id, sender_id, sender_name, kind="request", specialty=None):
+        """
+        Record a new request, due for its first escalation step straight away.
+
+        :param card_id: ID of the request card, or for a request on the queue card the request's own ID.
+        :param kind: 'request' for a request with its own card, 'queued' for one listed on the queue card.
+        :param specialty: roster specialty the request goes to, None for the general on-call doctors.
+        """
+        now = time.time()
+        await self.write(("""INSERT INTO webexTriage (card_id, type, sender_id, sender_name, clicked, state, attempt,
+                                                      next_due, created, specialty)
+                             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                          (card_id, kind, sender_id, sender_name, "0", "pending", 1, now, now, specialty)))
+
+    async def accept_request(self, card_id):
+        """
+        Mark a request card as accepted.
+
+        :returns: the epoch time the request was created and the state it was in, e.g. 'timed_out', if this is the
+                  first time it has been accepted, otherwise None (already accepted, or the card isn't a request).
+        """
+        row = await self.fetchone("""SELECT created, state FROM webexTriage
+                                     WHERE card_id=? AND state IS NOT 'accepted'""", (card_id,))
+        rowcounts = await self.write(("""UPDATE webexTriage SET clicked=?, state=?
+                                         WHERE card_id=? AND state IS NOT 'accepted'""",
+                                      ("1", "accepted", card_id)))
+        if rowcounts[0] != 1 or row is None:
+            return None
+        return row
+
+    async def reopen_request(self, card_id, state):
+        """
+        Put an accepted request whose room couldn't be set up back to the state it was accepted in, so it can be
+        accepted again. A pending request has its next escalation step due straight away, a timed out one stays
+        timed out, with its attempts left as they were so the timeout isn't run again.
+
+        :param card_id: ID of the request's card.
+        :param state: the state the request was accepted in, 'pending' or 'timed_out'.
+        """
+        await self.write(("""UPDATE webexTriage
+                             SET clicked=?, state=?, next_due=?, responder_id=NULL, responder_name=NULL, room_id=NULL,
+                                 claimed_by=NULL, claim_expires=NULL
+                             WHERE card_id=? AND state='accepted'""",
+                          ("0", state, time.time() if state == "pending" else None, card_id)))
+
+    async def get_request(self, card_id):
+        """:returns: (sender_name, sender_id, kind) for a request, or None."""
+        return await self.fetchone("SELECT sender_name, sender_id, type FROM webexTriage WHERE card_id=?", (card_id,))
+
+    async def queued_requests(self):
+        """:returns: (card_id, sender_name, state, created) of the requests waiting on the queue card, oldest first."""
+        return await self.fetchall("""SELECT card_id, sender_name, state, created FROM webexTriage
+                                      WHERE state IN ('pending', 'timed_out') AND type='queued'
+                                      ORDER BY created""")
+
+    async def delete_request(self, card_id):
+        await self.write(("DELETE FROM webexTriage WHERE card_id=?", (card_id,)))
+
+    # Escalations
+
+    async def due_escalations(self, now, limit=50):
+        """:returns: IDs of the pending cards whose next escalation step is due, oldest first."""
+        rows = await self.fetchall("""SELECT card_id
+                                      FROM webexTriage
+                                      WHERE state='pending' AND next_due<=?
+                                      ORDER BY next_due
+                                      LIMIT ?""", (now, limit))
+        return [card_id for (card_id,) in rows]
+
+    async def claim_escalation(self, card_id, worker_id, lease):
+        """
+        Claim a due escalation step for a worker.
+        The claim is a single conditional UPDATE, so only one worker can win it; a claim which
+        isn't released in time (e.g. the worker died) can be taken over by another worker.
+
+        :param card_id: ID of the card to claim.
+        :param worker_id: ID of the claiming worker.
+        :param lease: seconds the claim is held for.
+        :returns: the sender ID, sender name, attempt number, kind of request and specialty, or None if the step
+                  isn't ours to run.
+        """
+        now = time.time()
+        rowcounts = await self.write(("""UPDATE webexTriage
+                                         SET claimed_by=?, claim_expires=?
+                                         WHERE card_id=? AND state='pending' AND next_due<=?
+                                         AND (claim_expires IS NULL OR claim_expires<?)""",
+                                      (worker_id, now + lease, card_id, now, now)))
+        if rowcounts[0] != 1:
+            return None
+        return await self.fetchone("""SELECT sender_id, sender_name, attempt, type, specialty
+                                      FROM webexTriage WHERE card_id=?""", (card_id,))
+
+    async def release_escalation(self, card_id, worker_id, state, attempt, next_due):
+        """
+        Record the outcome of an escalation step and release the claim on it.
+        Leaves the row alone if the card was accepted while the step was running.
+
+        :param card_id: ID of the card.
+        :param worker_id: ID of the worker holding the claim.
+        :param state: 'pending' if there are more steps to run, 'timed_out' once the requester has been sent the contacts.
+        :param attempt: the attempt number of the next step.
+        :param next_due: epoch time the next step is due.
+        """
+        await self.write(("""UPDATE webexTriage
+                             SET state=?, attempt=?, next_due=?, claimed_by=NULL, claim_expires=NULL
+                             WHERE card_id=? AND state='pending' AND claimed_by=?""",
+                          (state, attempt, next_due, card_id, worker_id)))
+
+    # Queue card
+
+    async def queue_card_changed(self, due, reminder=0, accepted=None):
+        """
+        Record a change to the queue card, which any worker may then repost.
+
+        :param due: epoch time the card is due to be reposted, unless a repost is already due sooner.
+        :param reminder: the attempt number of a reminder due with the card, 0 for none.
+        :param accepted: (sender name, responder name) of a request accepted, to announce with the card.
+        """
+        statements = [("""UPDATE queueCard
+                          SET due=COALESCE(due, ?), reminder=MAX(reminder, ?), version=version+1
+                          WHERE name='doctors'""", (due, reminder))]
+        if accepted is not None:
+            statements.append(("INSERT INTO queueCardAccepted (sender_name, responder_name) VALUES (?, ?)", accepted))
+        await self.write(*statements)
+
+    async def queue_card_due(self, now):
+        """:returns: True if the queue card is due to be reposted and no live worker has claimed the repost."""
+        row = await self.fetchone("""SELECT 1 FROM queueCard
+                                     WHERE name='doctors' AND due<=? AND (claim_expires IS NULL OR claim_expires<?)""",
+                                  (now, now))
+        return row is not None
+
+    async def claim_queue_card(self, worker_id, lease):
+        """
+        Claim the repost of the queue card for a worker. Like claiming an escalation it is a single conditional
+        UPDATE, so only one worker reposts the card at a time.
+
+        :param worker_id: ID of the claiming worker.
+        :param lease: seconds the claim is held for.
+        :returns: the ID of the card showing, the highest reminder attempt due, the version of the changes, the
+                  epoch time the card was last posted and a list of (ID, sender name, responder name) for the
+                  accepted requests to announce, or None if the repost isn't ours to run.
+        """
+        now = time.time()
+        rowcounts = await self.write(("""UPDATE queueCard
+                                         SET claimed_by=?, claim_expires=?
+                                         WHERE name='doctors' AND due<=? AND (claim_expires IS NULL OR claim_expires<?)""",
+                                      (worker_id, now + lease, now, now)))
+        if rowcounts[0] != 1:
+            return None
+        card_id, reminder, version, posted = await self.fetchone(
+            "SELECT card_id, reminder, version, posted FROM queueCard WHERE name='doctors'")
+        accepted = await self.fetchall("SELECT id, sender_name, responder_name FROM queueCardAccepted ORDER BY id")
+        return card_id, reminder, version, posted, accepted
+
+    async def release_queue_card(self, worker_id, card_id, posted, version, reminder, accepted_id, next_due):
+        """
+        Record the queue card now showing and release the claim on reposting it. Changes made while the card was
+        being reposted are kept, and have it reposted again at `next_due`.
+
+        :param worker_id: ID of the worker holding the claim.
+        :param card_id: ID of the card showing now, or None.
+        :param posted: epoch time the requests on the card were read.
+        :param version: the version of the changes the card was posted with, None to keep them all for the next repost.
+        :param reminder: the reminder attempt sent with the card.
+        :param accepted_id: ID of the last accepted request announced, or None.
+        :param next_due: epoch time to repost the card if it changed in the meantime.
+        """
+        statements = [("""UPDATE queueCard
+                          SET card_id=?, posted=?, claimed_by=NULL, claim_expires=NULL,
+                              reminder=CASE WHEN reminder<=? THEN 0 ELSE reminder END,
+                              due=CASE WHEN version=? THEN NULL ELSE ? END
+                          WHERE name='doctors' AND claimed_by=?""",
+                       (card_id, posted, reminder, version, next_due, worker_id))]
+        if accepted_id is not None:
+            statements.append(("DELETE FROM queueCardAccepted WHERE id<=?", (accepted_id,)))
+        await self.write(*statements)
+
+    # Rooms
+
+    async def add_room(self, card_id, room_id, responder_id, responder_name):
+        """Record the room created for an accepted request, and who accepted it."""
+        await self.write(("UPDATE webexTriage SET responder_name=?, responder_id=?, room_id=? WHERE card_id=?",
+                          (responder_name, responder_id, room_id, card_id)),
+                         ("INSERT OR REPLACE INTO webexRooms (room_id, card_id, created) VALUES (?, ?, ?)",
+                          (room_id, card_id, time.time())))
+
+    async def is_room(self, room_id):
+        """:returns: True if the room was created by the bot and hasn't been cleaned up."""
+        return await self.fetchone("SELECT 1 FROM webexRooms WHERE room_id=?", (room_id,)) is not None
+
+    async def delete_room(self, room_id):
+        await self.write(("DELETE FROM webexRooms WHERE room_id=?", (room_id,)))
+
+    # Sweeping
+
+    async def stale_rooms(self, before, limit=50):
+        """:returns: (room_id, card_id) of the rooms created before the epoch time `before`, oldest first."""
+        return await self.fetchall("SELECT room_id, card_id FROM webexRooms WHERE created<? ORDER BY created LIMIT ?",
+                                   (before, limit))
+
+    async def stale_requests(self, before, limit=500):
+        """:returns: IDs of the request cards created before the epoch time `before`, whatever their state."""
+        rows = await self.fetchall("""SELECT card_id FROM webexTriage WHERE state IN (?, ?, ?) AND created<?
+                                      UNION ALL
+                                      SELECT card_id FROM webexTriage WHERE state IS NULL AND created<?
+                                      LIMIT ?""", ("pending", "accepted", "timed_out", before, before, limit))
+        return [card_id for (card_id,) in rows]
+
+    async def archive_requests(self, card_ids):
+        """
+        Move request rows to the archive in one transaction.
+
+        :returns: the number of rows archived.
+        """
+        marks = ",".join("?" * len(card_ids))
+        rowcounts = await self.write((f"""INSERT OR REPLACE INTO webexTriageArchive ({REQUESTCOLUMNS}, archived)
+                                          SELECT {REQUESTCOLUMNS}, ? FROM webexTriage WHERE card_id IN ({marks})""",
+                                      (time.time(), *card_ids)),
+                                     (f"DELETE FROM webexTriage WHERE card_id IN ({marks})", tuple(card_ids)))
+        return rowcounts[1]
+
+    async def prune_archive(self, before, limit=500):
+        """
+        Delete up to `limit` archived rows archived before the epoch time `before`.
+
+        :returns: the number of rows deleted.
+        """
+        rowcounts = await self.write(("""DELETE FROM webexTriageArchive WHERE card_id IN
+                                         (SELECT card_id FROM webexTriageArchive WHERE archived<? LIMIT ?)""",
+                                      (before, limit)))
+        return rowcounts[0]
+
+    async def compact(self):
+        """
+        Checkpoint the write-ahead log back into the database file, and refresh the query planner's statistics.
+        Freed pages are reused by later writes, so the file stops growing. The checkpoint is passive, it copies
+        what it can without waiting on readers or the writer, so it never holds up a request.
+        """
+        def checkpoint():
+            self.reader.execute("PRAGMA wal_checkpoint(PASSIVE)")
+            self.reader.execute("PRAGMA optimize")
+        await self.run(checkpoint)
+
+    # Webhook events
+
+    async def record_event(self, event_id, resource):
+        """
+        Record a webhook event as handled.
+
+        :returns: True if the event hadn't been recorded before.
+        """
+        rowcounts = await self.write(("INSERT OR IGNORE INTO webhookEvents (event_id, resource, received) VALUES (?, ?, ?)",
+                                      (event_id, resource, time.time())))
+        return rowcounts[0] == 1
+
+    async def prune_events(self, before):
+        """Forget webhook events received before the epoch time `before`."""
+        await self.write(("DELETE FROM webhookEvents WHERE received<?", (before,)))
+
+    # Cluster
+
+    async def heartbeat(self, worker_id, forget_before):
+        """
+        Record that a cluster member is alive, and forget members not heard from since the epoch time `forget_before`.
+
+        :param worker_id: ID of the member.
+        """
+        now = time.time()
+        await self.write(("""INSERT INTO clusterMembers (worker_id, heartbeat, joined) VALUES (?, ?, ?)
+                             ON CONFLICT (worker_id) DO UPDATE SET heartbeat=excluded.heartbeat""",
+                          (worker_id, now, now)),
+                         ("DELETE FROM clusterMembers WHERE heartbeat<?", (forget_before,)))
+
+    async def live_members(self, since):
+        """:returns: IDs of the cluster members heard from since the epoch time `since`."""
+        rows = await self.fetchall("SELECT worker_id FROM clusterMembers WHERE heartbeat>=? ORDER BY worker_id",
+                                   (since,))
+        return [worker_id for (worker_id,) in rows]
+
+    async def leave(self, worker_id):
+        """Remove a member from the cluster and give up its leases, so the others take over straight away."""
+        await self.write(("DELETE FROM clusterMembers WHERE worker_id=?", (worker_id,)),
+                         ("UPDATE clusterLeases SET expires=0 WHERE holder=?", (worker_id,)))
+
+    async def acquire_lease(self, name, holder, duration):
+        """
+        Take or renew a lease. Like claiming an escalation it is a single conditional UPDATE, so only one
+        member holds a lease at a time and it can only be taken over once it has run out.
+
+        :param name: name of the lease, e.g. 'leader'.
+        :param holder: ID of the member asking for it.
+        :param duration: seconds the lease is held for.
+        :returns: True if the member holds the lease.
+        """
+        now = time.time()
+        rowcounts = await self.write(("INSERT OR IGNORE INTO clusterLeases (name, holder, expires) VALUES (?, ?, 0)",
+                                      (name, holder)),
+                                     ("""UPDATE clusterLeases SET holder=?, expires=?
+                                         WHERE name=? AND (holder=? OR expires<?)""",
+                                      (holder, now + duration, name, holder, now)))
+        return rowcounts[1] == 1
@@ -0,0 +1,209 @@
+"""
+Outbound dispatcher for calls that send to Webex.
+
+Every send is queued in a priority lane and released through a token bucket, so a burst of
+reminders during an incident can't push Webex into rate limiting the emergency cards. When Webex
+does answer 429 the whole bucket is paused for the Retry-After time and the call is queued again,
+so the highest priority work is still the first to go once sending resumes.
+
+Reads, e.g. fetching a message to check it for trigger words, aren't queued behind the sends but
+get the same retries, so one failed call to Webex doesn't lose the webhook it was for.
+"""
+import asyncio
+import itertools
+import time
+
+import httpx
+from loguru import logger
+
+from tracing import bind, span
+from webex import ApiError
+
+
+""" Priority lanes, lower goes first"""
+URGENT = 0
+ESCALATION = 1
+ROUTINE = 2
+HOUSEKEEPING = 3
+LANES = {URGENT: "urgent", ESCALATION: "escalation", ROUTINE: "routine", HOUSEKEEPING: "housekeeping"}
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter.
+
+    :param rate: tokens added per second.
+    :param capacity: the most tokens the bucket holds, i.e. the largest burst allowed.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        """Stop handing out tokens for `seconds`, e.g. after Webex returns 429."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    async def acquire(self):
+        """Wait until a token is available and take it."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class Dispatcher:
+    """
+    Rate limited, prioritised queue for outbound Webex calls.
+
+    :param rate: sends per second allowed on average.
+    :param burst: sends allowed back to back before the rate applies.
+    :param max_retries: retries after a 429, 5xx or connection error before the error is raised to the caller.
+    :param workers: the most sends in flight at once.
+    """
+
+    def __init__(self, rate=10, burst=20, max_retries=3, workers=4):
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.workers = workers
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.rate_limited = 0
+        self._sequence = itertools.count()
+        self._queue = None
+        self._bucket = None
+        self._tasks = []
+
+    def start(self):
+        """Start the worker tasks on the running event loop."""
+        self._queue = asyncio.PriorityQueue()
+        self._bucket = TokenBucket(self.rate, self.burst)
+        self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """Stop the workers, anything still queued is dropped."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def depth(self):
+        """:returns: number of sends waiting in the queue."""
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def send(self, priority, call, *args, **kwargs):
+        """
+        Queue `await call(*args, **kwargs)` in a priority lane and wait for its result.
+
+        :param priority: one of URGENT, ESCALATION, ROUTINE or HOUSEKEEPING.
+        :param call: coroutine function making the Webex call, e.g. `api.messages.create`.
+        :returns: whatever the call returns.
+        :raises ApiError: if the call fails, or still fails after the retries.
+        """
+        if self._queue is None:
+            raise RuntimeError("Dispatcher has not been started.")
+        with span(f"dispatch {LANES.get(priority, priority)}"):
+            future = asyncio.get_event_loop().create_future()
+            # The call is made by a worker, bound to this span so the Webex call is traced as part of it
+            self._queue.put_nowait((priority, next(self._sequence), 0, bind(call), args, kwargs, future))
+            return await future
+
+    async def _worker(self):
+        while True:
+            item = await self._queue.get()
+            await self._bucket.acquire()
+            # Something more important may have been queued while waiting for the token
+            if not self._queue.empty():
+                self._queue.put_nowait(item)
+                item = self._queue.get_nowait()
+            priority, sequence, attempt, call, args, kwargs, future = item
+            if future.done():
+                continue
+            try:
+                result = await call(*args, **kwargs)
+            except ApiError as e:
+                if e.status_code == 429:
+                    self.rate_limited += 1
+                    delay = e.retry_after if e.retry_after is not None else 2 ** attempt
+                    logger.warning(f"Webex rate limit hit, pausing sends for {delay}s.")
+                    self._bucket.pause(delay)
+                    self._retry(item, 0, e)
+                elif e.status_code >= 500:
+                    self._retry(item, 2 ** attempt, e)
+                else:
+                    self._fail(future, e)
+            except httpx.TransportError as e:
+                self._retry(item, 2 ** attempt, e)
+            except Exception as e:
+                self._fail(future, e)
+            else:
+                self.sent += 1
+                future.set_result(result)
+
+    async def read(self, call, *args, **kwargs):
+        """
+        Make a Webex read straight away, retrying it after a 429, 5xx or connection error.
+
+        :param call: coroutine function making the Webex call, e.g. `api.messages.get`.
+        :returns: whatever the call returns.
+        :raises ApiError: if the call fails, or still fails after the retries.
+        :raises httpx.TransportError: if Webex still can't be reached after the retries.
+        """
+        attempt = 0
+        while True:
+            try:
+                return await call(*args, **kwargs)
+            except ApiError as e:
+                if (e.status_code != 429 and e.status_code < 500) or attempt >= self.max_retries:
+                    raise
+                if e.status_code == 429:
+                    self.rate_limited += 1
+                delay = e.retry_after if e.retry_after is not None else 2 ** attempt
+            except httpx.TransportError:
+                if attempt >= self.max_retries:
+                    raise
+                delay = 2 ** attempt
+            self.retried += 1
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    def _retry(self, item, delay, error):
+        priority, sequence, attempt, call, args, kwargs, future = item
+        if attempt >= self.max_retries:
+            logger.error(f"Giving up on {LANES.get(priority, priority)} send after {attempt + 1} attempts.")
+            self._fail(future, error)
+            return
+        self.retried += 1
+        # Keep the original sequence number so the call keeps its place in its lane
+        retry = (priority, sequence, attempt + 1, call, args, kwargs, future)
+        asyncio.get_event_loop().call_later(delay, self._queue.put_nowait, retry)
+
+    def _fail(self, future, error):
+        self.failed += 1
+        if not future.done():
+            future.set_exception(error)
+
+    def stats(self):
+        """:returns: dict of the queue depth and send counters."""
+        return {
+            "queued": self.depth(),
+            "sent": self.sent,
+            "retried": self.retried,
+            "rate_limited": self.rate_limited,
+            "failed": self.failed,
+        }
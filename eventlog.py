@@ -0,0 +1,112 @@
+"""
+Append-only log of triage events, one JSON object per line.
+
+Events are handed to a writer thread, which collects whatever arrives within a short window and
+appends it to the file in a single write, so logging an event never waits on the disk. Each line
+holds the epoch time `ts`, the `event` name and the event's own fields, e.g.
+
+    {"ts": 1616598611.2, "event": "accepted", "card_id": "...", "doctor_id": "...", "waited": 12.5}
+
+The file is opened for appending, so several workers can share one log.
+"""
+import json
+import os
+import queue
+import threading
+import time
+
+from loguru import logger
+
+
+""" Events written to the log, in the order they happen to a request"""
+EVENTS = ("message", "emergency", "card_sent", "reminder", "timed_out", "accepted", "room_created", "cleaned_up")
+
+
+class EventLog:
+    """
+    Buffered writer for the event log.
+
+    :param path: path to the log file, or None to not keep a log.
+    :param flush_interval: seconds the writer waits for more events before writing a batch.
+    :param max_batch: the most events written in one batch.
+    """
+
+    def __init__(self, path, flush_interval=0.5, max_batch=1000):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.written = 0
+        self.batches = 0
+        self._queue = queue.Queue()
+        self._writer = None
+
+    def start(self):
+        """Open the log and start the writer thread."""
+        if not self.path:
+            return
+        self._writer = threading.Thread(target=self._write_loop, args=(self._open(),), name="event-log", daemon=True)
+        self._writer.start()
+
+    def close(self):
+        """Write any queued events and stop the writer."""
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join()
+            self._writer = None
+
+    def record(self, event, **fields):
+        """
+        Queue an event for the log.
+
+        :param event: one of EVENTS.
+        :param fields: the event's fields, anything JSON can encode.
+        """
+        if self._writer is not None:
+            self._queue.put(dict(fields, ts=time.time(), event=event))
+
+    def _open(self):
+        return os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def _write_loop(self, fd):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            lines = "".join(json.dumps(event, separators=(",", ":"), default=str) + "\n" for event in batch)
+            try:
+                # One write per batch, so lines from workers sharing the file don't interleave
+                os.write(fd, lines.encode())
+                self.written += len(batch)
+                self.batches += 1
+            except OSError as e:
+                logger.error(f"Couldn't write {len(batch)} events to {self.path}: {e}")
+        os.close(fd)
+
+
+def read_events(path):
+    """
+    Stream the events in a log file, skipping any line which can't be read (e.g. one cut short by a crash).
+
+    :param path: path to the log file.
+    :returns: generator of event dicts in the order they were written.
+    """
+    with open(path, encoding="utf-8") as log:
+        for line in log:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(event, dict) and "event" in event:
+                yield event
@@ -0,0 +1,64 @@
+"""
+Reload configuration files when they change on disk, without restarting the bot.
+"""
+import os
+import time
+
+from loguru import logger
+
+
+class WatchedFile:
+    """
+    Holds the parsed contents of a file and re-parses it when the file's modification time changes.
+
+    The file is stat'ed at most once every `interval` seconds, so `get()` is cheap enough to call
+    on every request. If a changed file fails to load, the error is logged and kept in `error`, and
+    the last good value is kept.
+
+    :param path: path to the file.
+    :param loader: function taking the path and returning the parsed value.
+    :param interval: the least number of seconds between checks of the file.
+    :param default: value used if the file doesn't exist or never loads.
+    :param lazy: leave loading the file to the first `get()` rather than loading it straight away.
+    """
+
+    def __init__(self, path, loader, interval=2.0, default=None, lazy=False):
+        self.path = path
+        self.loader = loader
+        self.interval = interval
+        self.value = default
+        self.error = None
+        self._mtime = None
+        self._checked = float("-inf")
+        if not lazy:
+            self.reload()
+
+    def get(self):
+        """:returns: the current value, reloading the file first if it has changed."""
+        now = time.monotonic()
+        if now - self._checked >= self.interval:
+            self._checked = now
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+            except OSError:
+                mtime = None
+            if mtime != self._mtime:
+                self.reload()
+        return self.value
+
+    def reload(self):
+        """Load the file now, keeping the current value if it can't be loaded."""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            logger.warning(f"{self.path} not found, using the current settings.")
+            self._mtime = None
+            return
+        try:
+            self.value = self.loader(self.path)
+            self.error = None
+            logger.info(f"Loaded {self.path}.")
+        except Exception as e:
+            self.error = e
+            logger.error(f"Failed to load {self.path}, keeping the current settings: {e}")
+        self._mtime = mtime
@@ -0,0 +1,52 @@
+"""
+Duplicate webhook suppression.
+
+Webex redelivers a webhook when the bot is slow to respond, and each redelivery of a message
+would otherwise start another request card and escalation. Events are keyed on the ID of the
+message or attachment action they carry. Recent IDs are held in memory so a repeat to the same
+worker is dropped without touching the database; every first sighting is also recorded in the
+database, which catches repeats that land on another worker or arrive after a restart.
+"""
+from collections import OrderedDict
+
+
+class EventDeduplicator:
+    """
+    Remembers which webhook events have already been handled.
+
+    :param db: Database used to share seen events between workers.
+    :param maxsize: the most event IDs kept in memory.
+    """
+
+    def __init__(self, db, maxsize=10000):
+        self.db = db
+        self.maxsize = maxsize
+        self.suppressed = 0
+        self._seen = OrderedDict()
+
+    async def first_delivery(self, event_id, resource):
+        """
+        Check an event and record it as seen.
+
+        :param event_id: ID of the message or attachment action in the webhook.
+        :param resource: the webhook resource, e.g. 'messages'.
+        :returns: True the first time an event is seen, False for a duplicate delivery.
+        """
+        if event_id in self._seen:
+            self._seen.move_to_end(event_id)
+            self.suppressed += 1
+            return False
+        # Remember the event before awaiting the database so a concurrent repeat is caught here too
+        self._seen[event_id] = None
+        if len(self._seen) > self.maxsize:
+            self._seen.popitem(last=False)
+        try:
+            first = await self.db.record_event(event_id, resource)
+        except Exception:
+            # The webhook fails and Webex redelivers it, which mustn't be taken for a duplicate
+            self._seen.pop(event_id, None)
+            raise
+        if not first:
+            self.suppressed += 1
+            return False
+        return True
@@ -0,0 +1,147 @@
+"""
+Bounded work queue for incoming webhooks.
+
+The webhook handlers only check and classify a webhook, queue the work it needs in a priority
+lane and return, and a fixed pool of workers does the work. Emergencies are queued by the severity
+of their trigger ahead of card clicks, which are ahead of checking ordinary messages, with cleaning
+up rooms last. When the queue is full, work in the low priority lanes makes room for more important
+work by being put off to be queued again later, or dropped if it wasn't given a time to put it off
+for. The work put off is bounded too, once the limit is reached more is dropped rather than put off.
+Emergencies and card clicks are always taken, even over the limit, so they never wait behind
+housekeeping.
+"""
+import asyncio
+import collections
+import time
+
+from loguru import logger
+
+from metrics import counter, histogram
+from triggers import SEVERITIES
+
+
+""" Priority lanes, earlier goes first - one for each trigger severity, then card clicks, messages and clean ups"""
+LANES = SEVERITIES + ("accept", "message", "clean_up")
+ACCEPT = LANES.index("accept")
+MESSAGE = LANES.index("message")
+CLEAN_UP = LANES.index("clean_up")
+""" Lanes whose work can be dropped or put off when the queue is full"""
+SHEDDABLE = {MESSAGE, CLEAN_UP}
+
+WAIT_SECONDS = histogram("triage_ingest_wait_seconds", "Time work waited in the ingest queue.", ("lane",))
+SHED = counter("triage_ingest_shed", "Work dropped or put off because the ingest queue was full.", ("lane", "action"))
+
+
+def severity_lane(severity):
+    """:returns: the lane for an emergency with the given trigger severity."""
+    return SEVERITIES.index(severity)
+
+
+class WorkQueue:
+    """
+    Prioritised, bounded queue of webhook work and the workers running it.
+
+    :param maxsize: the most items queued before low priority work is shed.
+    :param workers: number of workers running the work.
+    :param max_deferred: the most items put off at once, after which shed work is dropped, defaults to `maxsize`.
+    """
+
+    def __init__(self, maxsize=1000, workers=8, max_deferred=None):
+        self.maxsize = maxsize
+        self.workers = workers
+        self.max_deferred = maxsize if max_deferred is None else max_deferred
+        self.done = 0
+        self.failed = 0
+        self._lanes = [collections.deque() for _ in LANES]
+        self._size = 0
+        # Counts the queued items, so a worker only wakes when there is work to take
+        self._ready = None
+        self._tasks = []
+        # Timer of each item put off to the index of its lane
+        self._deferred = {}
+
+    def start(self):
+        """Start the workers on the running event loop."""
+        self._ready = asyncio.Semaphore(0)
+        self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """Stop the workers, anything still queued or put off is dropped."""
+        for timer in self._deferred:
+            timer.cancel()
+        self._deferred.clear()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def depth(self):
+        """:returns: dict of lane name to the number of items waiting in it."""
+        return {name: len(lane) for name, lane in zip(LANES, self._lanes)}
+
+    def deferred(self):
+        """:returns: dict of lane name to the number of items put off to be queued again."""
+        counts = collections.Counter(self._deferred.values())
+        return {name: counts[index] for index, name in enumerate(LANES) if index in SHEDDABLE}
+
+    def submit(self, lane, call, *args, defer=None):
+        """
+        Queue `await call(*args)` in a lane.
+
+        :param lane: lane index, e.g. ACCEPT or severity_lane('critical').
+        :param call: coroutine function doing the work.
+        :param defer: seconds to wait before queueing the work again if it is shed, by default shed work is dropped.
+        :returns: True if the work was queued, False if it was shed.
+        """
+        if self._ready is None:
+            raise RuntimeError("Work queue has not been started.")
+        item = (time.perf_counter(), call, args, defer)
+        if self._size >= self.maxsize:
+            worst = max((index for index, queued in enumerate(self._lanes) if queued), default=None)
+            if worst is not None and worst > lane and worst in SHEDDABLE:
+                # Make room by shedding the newest of the least important work, the item count stays the same
+                self._shed(worst, self._lanes[worst].pop())
+                self._lanes[lane].append(item)
+                return True
+            if lane in SHEDDABLE:
+                self._shed(lane, item)
+                return False
+        self._lanes[lane].append(item)
+        self._size += 1
+        self._ready.release()
+        return True
+
+    def _shed(self, lane, item):
+        _, call, args, defer = item
+        if defer is None or len(self._deferred) >= self.max_deferred:
+            SHED.labels(LANES[lane], "dropped").inc()
+            logger.warning(f"Work queue full, dropped {LANES[lane]} work {call.__name__}{args}"
+                           f"{'' if defer is None else f', {len(self._deferred)} items are already put off'}.")
+            return
+        SHED.labels(LANES[lane], "deferred").inc()
+        logger.warning(f"Work queue full, putting off {LANES[lane]} work {call.__name__}{args} for {defer}s.")
+
+        def resubmit():
+            del self._deferred[timer]
+            self.submit(lane, call, *args, defer=defer)
+
+        timer = asyncio.get_event_loop().call_later(defer, resubmit)
+        self._deferred[timer] = lane
+
+    def _take(self):
+        for index, lane in enumerate(self._lanes):
+            if lane:
+                self._size -= 1
+                return index, lane.popleft()
+
+    async def _worker(self):
+        while True:
+            await self._ready.acquire()
+            lane, (queued, call, args, _) = self._take()
+            WAIT_SECONDS.labels(LANES[lane]).observe(time.perf_counter() - queued)
+            try:
+                await call(*args)
+                self.done += 1
+            except Exception:
+                self.failed += 1
+                logger.exception(f"{LANES[lane]} work {call.__name__} failed.")
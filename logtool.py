@@ -0,0 +1,310 @@
+"""
+Offline tool for the triage event log written by the bot (see eventlog.py).
+
+`stats` streams a log and reports how requests went: the events by type, how long each doctor took
+to accept a request card, and how long the cards and rooms took to set up.
+
+    python logtool.py stats events.jsonl
+
+`replay` plays a log back against a local copy of the bot and the fake Webex server from the
+benchmarks, with a fresh database, for regression testing. Each message is sent again at the same
+point in the log (sped up by --speed), with the trigger word it matched as its text, every card
+accepted in the log is accepted again by the same doctor and every room cleaned up by hand is
+cleaned up again. The bot's own log of the replay is then compared with the original. Reminders and
+timeouts run on the bot's own timers, which aren't sped up.
+
+    python logtool.py replay events.jsonl --speed 10 --latency 50
+"""
+import argparse
+import asyncio
+import collections
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from eventlog import EVENTS, read_events
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+""" The Doctors space and the webhook envelope used when running the bot against the Webex stand-in, shared with
+    the load benchmark"""
+DOCTORSROOM = "room-doctors"
+ENVELOPE = {"id": "webhook", "name": "bench", "targetUrl": "http://bench", "event": "created", "orgId": "org",
+            "createdBy": "bench", "appId": "bench", "ownedBy": "creator", "status": "active",
+            "created": "2021-01-01T00:00:00.000Z", "actorId": "bench"}
+
+
+def free_port():
+    """:returns: a local port nothing is listening on."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(samples, share):
+    """Nearest rank percentile of a list of samples."""
+    if not samples:
+        return float("nan")
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, round(share * len(ordered)) - 1))]
+
+
+async def wait_ready(client, url, process, timeout=30):
+    """Wait for a server started as `process` to answer at `url`."""
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited with {process.returncode}.")
+        try:
+            await client.get(url)
+            return
+        except httpx.TransportError:
+            await asyncio.sleep(0.05)
+    raise RuntimeError(f"{url} didn't start.")
+
+
+def summarise(events):
+    """
+    Stream a log's events into a summary.
+
+    :param events: iterable of event dicts, e.g. from read_events.
+    :returns: dict with the `counts` of each event, the acceptance times `waited` for each doctor, and the
+              `to_card` and `room` setup times in seconds.
+    """
+    counts = collections.Counter()
+    waited = collections.defaultdict(list)
+    messages = {}
+    to_card = []
+    room = []
+    for event in events:
+        kind = event["event"]
+        counts[kind] += 1
+        if kind == "emergency":
+            messages[event.get("message_id")] = event["ts"]
+        elif kind == "card_sent":
+            sent = messages.pop(event.get("message_id"), None)
+            if sent is not None:
+                to_card.append(event["ts"] - sent)
+        elif kind == "accepted":
+            waited[event.get("doctor_name") or event.get("doctor_id")].append(event["waited"])
+        elif kind == "room_created":
+            room.append(event["seconds"])
+    return {"counts": counts, "waited": waited, "to_card": to_card, "room": room}
+
+
+def seconds(samples):
+    return (f"n={len(samples):<6} p50 {percentile(samples, 0.5):8.2f}s  p90 {percentile(samples, 0.9):8.2f}s  "
+            f"p99 {percentile(samples, 0.99):8.2f}s  max {max(samples, default=float('nan')):8.2f}s")
+
+
+def stats(args):
+    summary = summarise(read_events(args.log))
+    counts = summary["counts"]
+    print("  ".join(f"{kind} {counts[kind]}" for kind in EVENTS))
+    if counts["card_sent"]:
+        print(f"accepted {counts['accepted'] / counts['card_sent']:.0%} of request cards, "
+              f"{counts['timed_out']} timed out")
+    print(f"{'emergency to card':<24} {seconds(summary['to_card'])}")
+    print(f"{'room setup':<24} {seconds(summary['room'])}")
+    print(f"{'card to accept':<24} {seconds([value for values in summary['waited'].values() for value in values])}")
+    for doctor, samples in sorted(summary["waited"].items(), key=lambda item: -len(item[1])):
+        print(f"  {str(doctor)[:22]:<22} {seconds(samples)}")
+
+
+def plan(path):
+    """
+    Work out what to replay from a log.
+
+    :param path: path to the log file.
+    :returns: list of (seconds into the log, message ID, person ID, trigger word or None, card accept or None,
+              clean up or None), where the card accept is (seconds into the log, doctor ID) and the clean up
+              is the seconds into the log the room was cleaned up.
+    """
+    start = None
+    messages = []
+    keywords = {}
+    cards = {}
+    accepted = {}
+    rooms = {}
+    cleaned = {}
+    for event in read_events(path):
+        kind = event["event"]
+        if start is None:
+            start = event["ts"]
+        if kind == "message":
+            messages.append((event["ts"] - start, event["message_id"], event["person_id"]))
+        elif kind == "emergency":
+            keywords[event["message_id"]] = event["keyword"]
+        elif kind == "card_sent":
+            cards[event["message_id"]] = event["card_id"]
+        elif kind == "accepted":
+            accepted[event["card_id"]] = (event["ts"] - start, event["doctor_id"])
+        elif kind == "room_created":
+            rooms[event["card_id"]] = event["room_id"]
+        elif kind == "cleaned_up" and not event.get("swept"):
+            cleaned[event["room_id"]] = event["ts"] - start
+    result = []
+    for offset, message_id, person_id in messages:
+        card_id = cards.get(message_id)
+        result.append((offset, message_id, person_id, keywords.get(message_id), accepted.get(card_id),
+                       cleaned.get(rooms.get(card_id))))
+    return result
+
+
+class Replay:
+    """Sends a log's webhooks to the bot again, keeping the timings."""
+
+    def __init__(self, bot, webex, speed, timeout):
+        self.bot = bot
+        self.webex = webex
+        self.speed = speed
+        self.timeout = timeout
+        self.started = None
+        self.to_card = []
+        self.to_room = []
+        self.failures = 0
+        self.lost = 0
+
+    async def at(self, offset):
+        await asyncio.sleep(max(0, self.started + offset / self.speed - time.perf_counter()))
+
+    async def post(self, route, resource, data):
+        response = await self.bot.post(f"/{route}", json=dict(ENVELOPE, resource=resource, data=data))
+        if response.status_code != 200:
+            self.failures += 1
+
+    async def wait(self, kind, person_id, after):
+        response = await self.webex.get(f"/bench/{kind}/{person_id}", params={"timeout": self.timeout, "after": after})
+        if response.status_code != 200:
+            self.lost += 1
+            return None
+        return response.json()
+
+    async def message(self, offset, message_id, person_id, keyword, accept, clean_up):
+        text = keyword or "replayed message"
+        await self.webex.post("/bench/messages", json={"id": message_id, "personId": person_id, "text": text})
+        await self.at(offset)
+        sent = time.time()
+        await self.post("messages", "messages", {"id": message_id, "personId": person_id, "roomId": "direct",
+                                                 "personEmail": f"{person_id}@example.com"})
+        if keyword is None or accept is None:
+            return
+        card = await self.wait("cards", person_id, sent)
+        if card is None:
+            return
+        self.to_card.append(card["at"] - sent)
+        accept_at, doctor_id = accept
+        await self.at(accept_at)
+        clicked = time.time()
+        action = {"id": f"accept-{message_id}", "messageId": card["id"], "personId": doctor_id, "roomId": DOCTORSROOM}
+        await self.webex.post("/bench/actions", json=dict(action, inputs=card["inputs"]))
+        await self.post("cards", "attachmentActions", action)
+        added = await self.wait("added", person_id, clicked)
+        if added is None:
+            return
+        self.to_room.append(added["at"] - clicked)
+        if clean_up is not None:
+            await self.at(clean_up)
+            await self.post("cards", "attachmentActions", {"id": f"clean-up-{message_id}", "messageId": "clean-up",
+                                                            "personId": doctor_id, "roomId": added["room"]})
+
+
+async def settle(bot, timeout):
+    """
+    Wait up to `timeout` seconds for the bot to have had nothing queued for a second, e.g. clean ups behind the
+    reminders.
+    """
+    deadline = time.perf_counter() + timeout
+    quiet = 0
+    while time.perf_counter() < deadline and quiet < 5:
+        lines = (await bot.get("/metrics")).text.splitlines()
+        # Timers are left out, the reminders for cards that were never accepted can be a while yet
+        depths = [line for line in lines if line.startswith(("triage_ingest_depth{", "triage_queue_depth{"))
+                  and 'queue="timers"' not in line]
+        quiet = quiet + 1 if all(float(line.rsplit(" ", 1)[1]) == 0 for line in depths) else 0
+        await asyncio.sleep(0.2)
+
+
+async def replay_log(args, bot_url, webex_url):
+    steps = plan(args.log)
+    limits = httpx.Limits(max_connections=len(steps) * 2 + 10)
+    async with httpx.AsyncClient(base_url=bot_url, limits=limits, timeout=args.timeout) as bot, \
+            httpx.AsyncClient(base_url=webex_url, limits=limits, timeout=args.timeout + 5) as webex:
+        replay = Replay(bot, webex, args.speed, args.timeout)
+        replay.started = time.perf_counter()
+        results = await asyncio.gather(*[replay.message(*step) for step in steps], return_exceptions=True)
+        elapsed = time.perf_counter() - replay.started
+        errors = [result for result in results if isinstance(result, Exception)]
+        print(f"replayed {len(steps)} messages in {elapsed:.2f}s, {replay.failures} non-200 responses, "
+              f"{replay.lost} cards or rooms lost, {len(errors)} errors")
+        print(f"{'emergency to card':<24} {seconds(replay.to_card)}")
+        print(f"{'accept to room':<24} {seconds(replay.to_room)}")
+        await settle(bot, args.timeout)
+        if errors:
+            print(f"first error: {errors[0]!r}")
+
+
+def replay(args):
+    webex_port, bot_port = free_port(), free_port()
+    webex_url, bot_url = f"http://127.0.0.1:{webex_port}", f"http://127.0.0.1:{bot_port}"
+    with tempfile.TemporaryDirectory() as directory:
+        replayed = os.path.join(directory, "events.jsonl")
+        env = dict(os.environ, WEBEX_TEAMS_ACCESS_TOKEN="replay", TEAMS_BOT_URL=bot_url,
+                   TEAMS_BOT_EMAIL="bot@example.com", DOCTORS_ROOM=DOCTORSROOM,
+                   DATABASE_NAME=os.path.join(directory, "replay.db"), EVENT_LOG=replayed,
+                   WEBEX_BASE_URL=f"{webex_url}/v1/")
+        log = open(os.path.join(directory, "bot.log"), "w")
+        processes = [
+            subprocess.Popen([sys.executable, os.path.join(ROOT, "benchmarks", "fake_webex.py"), "--port", str(webex_port),
+                              "--latency", str(args.latency), "--jitter", str(args.jitter), "--seed", str(args.seed)],
+                             cwd=ROOT),
+            subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(bot_port),
+                              "--log-level", "warning"], cwd=ROOT, env=env, stderr=log),
+        ]
+        try:
+            async def start():
+                async with httpx.AsyncClient() as client:
+                    await wait_ready(client, f"{webex_url}/bench/stats", processes[0])
+                    await wait_ready(client, f"{bot_url}/metrics", processes[1])
+                await replay_log(args, bot_url, webex_url)
+            asyncio.get_event_loop().run_until_complete(start())
+        finally:
+            # The bot writes the rest of its event log as it shuts down
+            for process in processes:
+                process.terminate()
+                process.wait()
+            log.close()
+
+        original = summarise(read_events(args.log))["counts"]
+        counts = summarise(read_events(replayed))["counts"] if os.path.exists(replayed) else collections.Counter()
+        print(f"{'event':<14} {'original':>9} {'replay':>9}")
+        for kind in EVENTS:
+            changed = "" if original[kind] == counts[kind] else "  *"
+            print(f"{kind:<14} {original[kind]:>9} {counts[kind]:>9}{changed}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    stats_parser = commands.add_parser("stats", help="summarise an event log")
+    stats_parser.add_argument("log", help="path to the event log")
+    stats_parser.set_defaults(run=stats)
+    replay_parser = commands.add_parser("replay", help="replay an event log against a local bot")
+    replay_parser.add_argument("log", help="path to the event log")
+    replay_parser.add_argument("--speed", type=float, default=1, help="how many times faster than the original")
+    replay_parser.add_argument("--latency", type=float, default=0, help="milliseconds the fake Webex takes per call")
+    replay_parser.add_argument("--jitter", type=float, default=0)
+    replay_parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for each card and room")
+    replay_parser.add_argument("--seed", type=int, default=1)
+    replay_parser.set_defaults(run=replay)
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
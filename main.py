@@ -7,54 +7,40 @@ TODO:   Update SQL to SQLAlchemy rather than direct SQL statements
 
 
 """importing all modules needed"""
-from fastapi import FastAPI
-from pydantic import BaseModel
-from typing import Optional, Dict, Any, AnyStr
-import requests
-import json
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse, PlainTextResponse
+import asyncio
+import collections
 import datetime
+import functools
+import hmac
 import os
+import socket
 import time
-import sqlite3
+import uuid
 
+import httpx
 from dotenv import load_dotenv
 from loguru import logger
-from webexteamssdk import WebexTeamsAPI, ApiError
-
-
-"""Defining the classes for the incoming API requests from Webex"""
-class Message(BaseModel):
-    id: str
-    name: str
-    targetUrl: str
-    resource: str
-    event: str
-    filter: Optional[str] = None
-    orgId: str
-    createdBy: str
-    appId: str
-    ownedBy: str
-    status: str
-    created: str
-    actorId: str
-    data: dict
-
-class CardResponse(BaseModel):
-    id: str
-    name: str
-    targetUrl: str
-    resource: str
-    event: str
-    filter: Optional[str] = None
-    orgId: str
-    createdBy: str
-    appId: str
-    ownedBy: str
-    status: str
-    created: str
-    actorId: str
-    data: dict
 
+from cache import TTLCache
+from cards import load_cards
+from cluster import Cluster
+from database import Database
+from dispatcher import Dispatcher, ESCALATION, HOUSEKEEPING, ROUTINE, URGENT
+from eventlog import EventLog
+from hotreload import WatchedFile
+from idempotency import EventDeduplicator
+from ingest import ACCEPT, CLEAN_UP, MESSAGE, WorkQueue, severity_lane
+from metrics import CONTENTTYPE, REGISTRY, callback, counter, histogram, time_calls
+from payloads import ActionData, MessageData, parse_webhook
+from profiler import Profiler
+from queuecard import QueueCard
+from roster import Roster
+from scheduler import EscalationScheduler
+from tracing import TRACER, configure as configure_tracing, traced
+from triggers import DEFAULT_TRIGGERS, TriggerEngine
+from webex import BASEURL, WebexAPI, ApiError
 
 
 """Import and set the environemnt variables from the '.env' file"""
@@ -65,176 +51,511 @@ BOTEMAIL = os.getenv("TEAMS_BOT_EMAIL")
 TEAMSTOKEN = os.getenv("WEBEX_TEAMS_ACCESS_TOKEN")
 DOCTORSROOM = os.getenv("DOCTORS_ROOM")
 DATABASE = os.getenv("DATABASE_NAME")
+EVENTLOGFILE = os.getenv("EVENT_LOG", "")
+CARDSDIR = os.getenv("CARDS_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cards"))
+ROSTERFILE = os.getenv("ROSTER_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "roster.json"))
+TRIGGERSFILE = os.getenv("TRIGGERS_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "triggers.json"))
+""" Webex API address, only changed to point the bot at a stand-in server for testing"""
+WEBEXBASEURL = os.getenv("WEBEX_BASE_URL", BASEURL)
 
 """ Variables to decide the time to wait for a response before sending another alert and how many alerts to be sent before
     falling back"""
 TIMEOUTSECONDS = 7
 ALERTCOUNT = 5
 
+""" How long new requests, reminders and accepted requests are collected for before the queue card listing every waiting
+    request is reposted in the Doctors space - 0 sends a card per request instead"""
+QUEUECARDSECONDS = float(os.getenv("QUEUE_CARD_SECONDS", "0"))
+
+""" Who each reminder mentions in the Doctors space - the on-call tiers for the first attempts, then everyone"""
+REMINDERTIERS = {1: ("primary",), 2: ("primary", "secondary")}
+
+""" How often each worker polls the database for escalations that are due, and how long a worker
+    may hold a claimed escalation before another worker is allowed to take it over"""
+POLLSECONDS = float(os.getenv("ESCALATION_POLL_SECONDS", "1"))
+CLAIMSECONDS = 60
+WORKERID = f'{socket.gethostname()}:{os.getpid()}'
+
+""" How long the database writer collects writes before committing them together"""
+COMMITMILLISECONDS = float(os.getenv("DATABASE_COMMIT_MS", "5"))
+
+""" How often each instance heartbeats when several share the database as a cluster - 0 runs a single instance. In a
+    cluster only the leader reconciles the webhooks and archives old requests, and escalations and sweeping stale
+    rooms are split between the instances"""
+CLUSTERSECONDS = float(os.getenv("CLUSTER_HEARTBEAT_SECONDS", "0"))
+
+""" How long to wait before trying again when the webhooks couldn't be checked at startup"""
+RECONCILESECONDS = 60
+
+""" How often the sweeper runs, how old a room or request gets before it is swept away, how long swept requests are
+    archived for and how many are swept together"""
+SWEEPSECONDS = float(os.getenv("SWEEP_SECONDS", "600"))
+STALEHOURS = float(os.getenv("STALE_HOURS", "24"))
+ARCHIVEDAYS = float(os.getenv("ARCHIVE_DAYS", "90"))
+SWEEPBATCH = 200
+
+""" How long handled webhook events are remembered, to drop Webex redeliveries"""
+EVENTSECONDS = 86400
+
+""" Outbound rate limit for sends to Webex - sends per second, the burst allowed and retries after a 429 or server error"""
+SENDRATE = float(os.getenv("WEBEX_SEND_RATE", "10"))
+SENDBURST = int(os.getenv("WEBEX_SEND_BURST", "20"))
+SENDRETRIES = int(os.getenv("WEBEX_SEND_RETRIES", "3"))
+
+""" The most webhooks queued before low priority work is shed, the number of workers handling them, the most shed work
+    put off at once before more is dropped, and how long a room clean up and checking a message are put off for - a
+    message may be an emergency, so it is only put off briefly"""
+INGESTQUEUESIZE = int(os.getenv("INGEST_QUEUE_SIZE", "1000"))
+INGESTWORKERS = int(os.getenv("INGEST_WORKERS", "8"))
+INGESTDEFERREDSIZE = int(os.getenv("INGEST_DEFERRED_SIZE", str(INGESTQUEUESIZE)))
+DEFERSECONDS = 30
+MESSAGEDEFERSECONDS = 5
+
+""" Work for a webhook taking longer than this is logged with a trace of where the time went - 0 turns tracing off"""
+TRACESLOWMS = float(os.getenv("TRACE_SLOW_MS", "0"))
+""" Token for the admin endpoints, e.g. the profiler - they aren't served without one"""
+ADMINTOKEN = os.getenv("ADMIN_TOKEN")
+
+""" Size of the person lookup cache and how long a person's details are reused before fetching them again"""
+PERSONCACHESIZE = int(os.getenv("PERSON_CACHE_SIZE", "512"))
+PERSONCACHESECONDS = float(os.getenv("PERSON_CACHE_SECONDS", "300"))
+
 """ FastAPI and Webex Connections"""
 app = FastAPI()
-api = WebexTeamsAPI(access_token=TEAMSTOKEN)
+api = WebexAPI(access_token=TEAMSTOKEN, base_url=WEBEXBASEURL)
+scheduler = EscalationScheduler()
+dispatcher = Dispatcher(rate=SENDRATE, burst=SENDBURST, max_retries=SENDRETRIES)
+people_cache = TTLCache(maxsize=PERSONCACHESIZE, ttl=PERSONCACHESECONDS)
+work = WorkQueue(maxsize=INGESTQUEUESIZE, workers=INGESTWORKERS, max_deferred=INGESTDEFERREDSIZE)
+profiler = Profiler()
+configure_tracing(TRACESLOWMS / 1000 if TRACESLOWMS else None)
+
+
+"""SQLite3 Database access - the schema is brought up to date and the writer started when the app starts up.
+   WAL mode lets every uvicorn worker read and claim escalations while another is writing."""
+db = Database(DATABASE, commit_interval=COMMITMILLISECONDS / 1000)
+events = EventDeduplicator(db)
+cluster = Cluster(db, WORKERID, CLUSTERSECONDS)
+""" Append-only log of what happened to each request, for analysing response times and replaying incidents"""
+event_log = EventLog(EVENTLOGFILE)
 
 
-"""Connect to SQLite3 Database and check for the table - create if it doesn't exist."""
-con = sqlite3.connect(DATABASE, check_same_thread=False)
-cur = con.cursor()
-cur.execute('''CREATE TABLE IF NOT EXISTS webexTriage
-               (card_id text, type text, sender_id text, sender_name text, clicked text, responder_id text, responder_name text, room_id text)''')
+"""Load and compile the adaptive cards, and the on-call roster - loaded in the background at startup and reloaded
+   when the roster file changes"""
+cards = load_cards(CARDSDIR)
+roster = WatchedFile(ROSTERFILE, Roster.from_file, default=Roster([]), lazy=True)
 
 
-""" Define the triggers for the bot to listen to - needs to be built out further
-    defining the necessary Global Variables"""
-triggers = ["help", "emergency", "support", "assistance", "hlep", "emergence", "assist"]
-ROOMSLIST = {""}
+""" Define the triggers for the bot to listen to - loaded from the triggers file in the background at startup and
+    reloaded when it changes, defining the necessary Global Variables"""
+triggers = WatchedFile(TRIGGERSFILE, TriggerEngine.from_file, default=TriggerEngine(DEFAULT_TRIGGERS), lazy=True)
+BOTID = None
+""" Counts of how incoming messages were handled, including those rejected before any Webex call"""
+message_stats = collections.Counter()
+""" Metrics served on /metrics - latency histograms for the request flow, and the counters kept by the other
+    components read when scraped"""
+WEBHOOK_SECONDS = histogram("triage_webhook_seconds", "Time taken to handle a webhook.", ("route",))
+MESSAGE_SECONDS = histogram("triage_message_seconds", "Time taken to check a message and start any request.")
+CARD_SECONDS = histogram("triage_emergency_to_card_seconds",
+                         "Time from an emergency message arriving to its request card being posted.")
+ACCEPT_SECONDS = histogram("triage_card_to_accept_seconds",
+                           "Time from a request card being posted to it being accepted.",
+                           buckets=(5, 10, 20, 30, 45, 60, 90, 120, 300, 600, 1800, 3600))
+ROOM_SECONDS = histogram("triage_room_ready_seconds", "Time from a request being accepted to its room being ready.")
+STEP_SECONDS = histogram("triage_room_step_seconds", "Time taken by each step of setting up an accepted request.",
+                         ("step",))
+CLEAN_UP_SECONDS = histogram("triage_clean_up_seconds", "Time taken to clean up a room.")
+SWEEP_DURATION = histogram("triage_sweep_seconds", "Time taken by a sweep for stale rooms and requests.")
+SWEPT = counter("triage_swept", "Rooms deleted, requests archived and archived requests deleted by the sweeper.",
+                ("kind",))
+callback("triage_queue_depth", "Work waiting in each queue.",
+         lambda: {"dispatcher": dispatcher.depth(), "timers": scheduler.pending(), "db_writes": db.queued()},
+         labelnames=("queue",))
+callback("triage_ingest_depth", "Webhook work waiting in each lane of the ingest queue.", lambda: work.depth(),
+         labelnames=("lane",))
+callback("triage_ingest_deferred", "Webhook work put off to be queued again, by lane.", lambda: work.deferred(),
+         labelnames=("lane",))
+callback("triage_dispatcher_sends", "Outbound Webex sends by outcome.",
+         lambda: {outcome: count for outcome, count in dispatcher.stats().items() if outcome != "queued"},
+         kind="counter", labelnames=("outcome",))
+callback("triage_messages", "Incoming messages by how they were handled.", lambda: dict(message_stats),
+         kind="counter", labelnames=("outcome",))
+callback("triage_person_cache", "Person cache lookups and evictions.",
+         lambda: {event: count for event, count in people_cache.stats().items() if event != "size"},
+         kind="counter", labelnames=("event",))
+callback("triage_person_cache_size", "People held in the person cache.", lambda: people_cache.stats()["size"])
+callback("triage_duplicate_webhooks", "Repeat webhook deliveries dropped.", lambda: events.suppressed, kind="counter")
+callback("triage_db_batches", "Batches committed by the database writer.", lambda: db.batches, kind="counter")
+callback("triage_db_writes", "Writes committed by the database writer.", lambda: db.writes, kind="counter")
+callback("triage_queue_card_reposts", "Times the queue card was reposted.", lambda: queue_card.reposts,
+         kind="counter")
+callback("triage_traces", "Traces finished and those logged as slow.",
+         lambda: {"finished": TRACER.traces, "slow": TRACER.slow_traces}, kind="counter", labelnames=("outcome",))
+callback("triage_cluster_members", "Live instances in the cluster.", lambda: cluster.size())
+callback("triage_cluster_leader", "1 if this instance is the cluster leader.", lambda: int(cluster.leader))
+callback("triage_event_log_writes", "Events written to the event log.", lambda: event_log.written, kind="counter")
+
 MESSAGEWEBHOOKURL = f'{WEBHOOKURL}/messages'
 ATTACHMENTWEBHOOKURL = f'{WEBHOOKURL}/cards'
+""" The webhooks the bot needs, keyed by resource and event"""
+WEBHOOKS = {
+    ("messages", "created"): ("Message Webhook", MESSAGEWEBHOOKURL),
+    ("attachmentActions", "created"): ("Card Attachment Webhook", ATTACHMENTWEBHOOKURL),
+}
+
 
+@app.on_event("startup")
+async def startup():
+    """
+    Open the database, load the roster, start the outbound dispatcher, attach the escalation scheduler to the
+    running event loop and start polling for due escalations.
+    Nothing here waits on Webex - the bot identity, the webhooks and compiling the triggers are left to
+    background tasks so the server is ready to take requests straight away.
+    """
+    started = time.perf_counter()
+    # Without the roster every reminder would go to everyone, so don't start with one that doesn't load
+    roster.reload()
+    if roster.error is not None:
+        raise RuntimeError(f"Couldn't load the roster from {ROSTERFILE}: {roster.error}")
+    db.start()
+    event_log.start()
+    dispatcher.start()
+    work.start()
+    scheduler.start(asyncio.get_event_loop())
+    scheduler.schedule_periodic("escalation-poll", POLLSECONDS, poll_escalations)
+    scheduler.schedule_periodic("event-prune", 3600, prune_events)
+    scheduler.schedule_periodic("sweep", SWEEPSECONDS, sweep)
+    scheduler.schedule("bot-identity", 0, get_bot_identity)
+    if cluster.enabled:
+        # The webhooks are reconciled by whichever instance takes the leader lease
+        scheduler.schedule("cluster-join", 0, cluster_heartbeat)
+        scheduler.schedule_periodic("cluster-heartbeat", CLUSTERSECONDS, cluster_heartbeat)
+    else:
+        scheduler.schedule("webhook-reconcile", 0, reconcile_webhooks)
+    scheduler.schedule("warm-up", 0, warm_up)
+    if QUEUECARDSECONDS:
+        # Any worker can repost the queue card, including for changes made by the others
+        scheduler.schedule_periodic("queue-card-poll", POLLSECONDS, queue_card.poll)
+    logger.info(f"Started in {(time.perf_counter() - started) * 1000:.0f}ms.")
+
+@app.on_event("shutdown")
+async def shutdown():
+    """
+    Drop any pending escalation timers and queued webhooks, leave the cluster, and close the dispatcher, database,
+    event log and Webex connections.
+    """
+    scheduler.stop()
+    if profiler.running:
+        profiler.stop()
+    await work.stop()
+    await dispatcher.stop()
+    await cluster.leave()
+    db.close()
+    event_log.close()
+    logger.info(f"Person cache stats: {people_cache.stats()}")
+    logger.info(f"Message stats: {dict(message_stats)}")
+    logger.info(f"Dispatcher stats: {dispatcher.stats()}")
+    logger.info(f"Duplicate webhooks suppressed: {events.suppressed}")
+    await api.close()
+
+@app.get("/metrics")
+async def read_metrics():
+    """Serve the metrics in the Prometheus text format."""
+    return Response(REGISTRY.render(), media_type=CONTENTTYPE)
+
+def is_admin(request):
+    """:returns: True if the request carries the admin token, there is no admin access without one set."""
+    supplied = request.headers.get("Authorization", "")
+    return bool(ADMINTOKEN) and hmac.compare_digest(supplied.encode(), f"Bearer {ADMINTOKEN}".encode())
+
+@app.post("/admin/profile/start")
+async def start_profile(request: Request, interval_ms: float = 5):
+    """
+    Start the sampling profiler.
+
+    :param interval_ms: milliseconds between samples.
+    """
+    if not is_admin(request):
+        return JSONResponse({"detail": "Not Found"}, status_code=404)
+    if profiler.running:
+        return JSONResponse({"detail": "The profiler is already running."}, status_code=409)
+    profiler.interval = max(interval_ms, 1) / 1000
+    profiler.start()
+    logger.info(f"Profiler started, sampling every {profiler.interval * 1000:.0f}ms.")
+    return {"detail": "Profiler started."}
+
+@app.post("/admin/profile/stop")
+async def stop_profile(request: Request):
+    """Stop the sampling profiler and return the profile in the folded format, ready for a flame graph."""
+    if not is_admin(request):
+        return JSONResponse({"detail": "Not Found"}, status_code=404)
+    if not profiler.running:
+        return JSONResponse({"detail": "The profiler isn't running."}, status_code=409)
+    folded = profiler.stop()
+    logger.info(f"Profiler stopped after {profiler.samples} samples.")
+    return PlainTextResponse(folded)
 
 @app.post("/messages")
-def read_message(item: Message):
+@time_calls(WEBHOOK_SECONDS.labels("messages"))
+@traced("webhook messages", root=True)
+async def read_message(request: Request):
     """
     Defining the actions for the incoming POST request to the messages URL.
-    Sets the incoming message ID and sender ID before running the flow to get the messages
-    details and run the rest of the flow accordingly
+    Sets the incoming message ID and sender ID and queues the flow to get the messages
+    details and run the rest of the flow accordingly, returning straight away.
+    Messages sent by the bot itself (e.g. the reminders) are dropped straight from the webhook
+    payload without calling Webex, as are redeliveries of a message already handled.
 
-    :param Message: Class for the response format to the messages URL.
+    :param request: the webhook request, its body is parsed as a messages webhook.
     """
-
-    message_id = item.data["id"]
-    sender_id = item.data["personId"]
-    sender = get_person(sender_id)
-    sender_name = sender.displayName
-    get_message(message_id, sender_name)
+    received = time.perf_counter()
+    try:
+        item = parse_webhook(await request.body(), MessageData)
+    except ValueError as e:
+        return JSONResponse({"detail": str(e)}, status_code=422)
+    message_id = item.data.id
+    sender_id = item.data.personId
+    if sender_id == BOTID or item.data.personEmail == BOTEMAIL:
+        message_stats["bot_skipped"] += 1
+        return
+    if not await events.first_delivery(message_id, item.resource):
+        logger.info(f"Ignoring repeat delivery of message {message_id}")
+        return
+    event_log.record("message", message_id=message_id, person_id=sender_id)
+    if not work.submit(MESSAGE, get_message, message_id, sender_id, received, defer=MESSAGEDEFERSECONDS):
+        # Put off, or dropped if too much is put off already - triage_ingest_shed tells them apart
+        message_stats["shed"] += 1
     return
 
 @app.post("/cards")
-async def read_message(item: CardResponse):
+@time_calls(WEBHOOK_SECONDS.labels("cards"))
+@traced("webhook cards", root=True)
+async def read_message(request: Request):
     """
     Defining the actions for the incoming POST request to the cards URL.
-    Sets the incoming person ID, card ID and room ID. Checks the card against
-    the database for existence and then either cleans up the room or creates the 
-    room
+    Sets the incoming person ID, card ID and room ID. Checks the room against
+    the database and then queues either cleaning up the room or accepting the
+    request, a click on the queue card is matched to its request by the values it
+    submitted. Repeat deliveries of the same click are ignored.
     
-    :param CardResponse: Class for the response format to the cards URL.
-    """
-    person_id = item.data["personId"]
-    card_id = item.data["messageId"]
-    room_id = item.data["roomId"]
-    cur.execute("""SELECT card_id
-                   FROM webexTriage
-                   WHERE card_id=?""",
-                (card_id,))
-    result = cur.fetchone()
-    if result:
-        cur.execute('''UPDATE webexTriage
-                SET clicked =?
-                WHERE card_id=?''', ('1', card_id,))
-    # Retrieve information about the sender
-    person = get_person(person_id)
-    # Trigger Teams room creation flow
-    if room_id in ROOMSLIST:
+    :param request: the webhook request, its body is parsed as an attachmentActions webhook.
+    """
+    try:
+        item = parse_webhook(await request.body(), ActionData)
+    except ValueError as e:
+        return JSONResponse({"detail": str(e)}, status_code=422)
+    if not await events.first_delivery(item.data.id, item.resource):
+        logger.info(f"Ignoring repeat delivery of card action {item.data.id}")
+        return
+    person_id = item.data.personId
+    card_id = item.data.messageId
+    room_id = item.data.roomId
+    if await db.is_room(room_id):
         logger.info("Triggering clean up for room.")
-        clean_up(room_id)
+        work.submit(CLEAN_UP, clean_up, room_id, defer=DEFERSECONDS)
     else:
-        create_room(card_id, person)
+        work.submit(ACCEPT, accept_request, card_id, person_id, item.data.id)
+    return
+
+@traced("accept_request", root=True)
+async def accept_request(card_id, person_id, action_id=None):
+    """
+    Record a doctor accepting a request card, stop its reminders and trigger the room creation flow.
+    A card which isn't a request itself is taken to be the queue card, and the request is the one
+    whose accept button was clicked, read from the inputs of the click.
+    The doctor is looked up before the request is claimed, and if the room can't be set up the request
+    is put back to waiting and its reminders carry on, so it is never left accepted with nobody on it.
+
+    :param card_id: ID of the card which was accepted.
+    :param person_id: ID of the person who clicked accept.
+    :param action_id: ID of the click.
+    """
+    if action_id is not None and await db.get_request(card_id) is None:
+        try:
+            action = await dispatcher.read(api.attachment_actions.get, action_id)
+        except (ApiError, httpx.TransportError) as e:
+            logger.error(e)
+            return
+        card_id = (action.inputs or {}).get("request")
+        if card_id is None:
+            logger.info(f"Card action {action_id} isn't for a request.")
+            return
+    person = await get_person(person_id)
+    if person is None:
+        logger.error(f"Couldn't look up {person_id}, leaving card {card_id} open to be accepted again.")
         return
+    accepted = await db.accept_request(card_id)
+    if accepted is None:
+        # Another doctor got there first, or the card isn't a request
+        logger.info(f"Card {card_id} is not an open request.")
+        return
+    created, state = accepted
+    waited = time.time() - created
+    ACCEPT_SECONDS.observe(waited)
+    event_log.record("accepted", card_id=card_id, doctor_id=person_id,
+                     doctor_name=person.displayName, waited=round(waited, 3))
+    # Stop any reminders still pending for the card, other workers will see the new state
+    scheduler.cancel(card_id)
+    # Trigger Teams room creation flow
+    try:
+        ready = await create_room(card_id, person)
+    except Exception:
+        logger.exception(f"Setting up the room for card {card_id} failed.")
+        ready = False
+    if not ready:
+        await reopen_request(card_id, person.displayName, state)
 
-def check_webhooks():
-    """ Check the existing webhooks and update/create them accordingly"""
+async def reopen_request(card_id, responder_name, state):
+    """
+    Put a request whose room couldn't be set up back to the state it was accepted in and tell the Doctors space.
+    A request which was still waiting has its reminders restarted, one which had timed out isn't timed out again.
+
+    :param card_id: ID of the request's card.
+    :param responder_name: name of the doctor who accepted it.
+    :param state: the state the request was accepted in, 'pending' or 'timed_out'.
+    """
+    await db.reopen_request(card_id, state)
+    if state == "pending":
+        scheduler.schedule(card_id, 0, escalate, card_id)
+    logger.warning(f"Reopened card {card_id} as its room couldn't be set up.")
+    message = f"Couldn't set up a space for {responder_name}, the request is open to be accepted again."
+    if QUEUECARDSECONDS:
+        await queue_card.changed()
+        kwargs = {}
+    else:
+        kwargs = {"parentId": card_id}
     try:
-        webhooks = api.webhooks.list()
-    except ApiError as e:
+        await dispatcher.send(URGENT, api.messages.create, roomId=DOCTORSROOM, markdown=message, **kwargs)
+    except (ApiError, httpx.TransportError) as e:
         logger.error(e)
-    webhooks_list = list(webhooks)
-    webhookCount = len(webhooks_list)
-    logger.info(f'Webhook count is: {webhookCount}')
-    if webhookCount == 0:
-        try:
-            api.webhooks.create("Message Webhook", MESSAGEWEBHOOKURL, "messages", "created")
-        except ApiError as e:
-            logger.error(e)
+
+async def reconcile_webhooks():
+    """
+    Bring the bot's webhooks in line with WEBHOOKS.
+    Compares the webhooks Webex has with the ones the bot needs, and only creates or updates the
+    ones which are missing, point somewhere else or have been disabled. Tries again later if the
+    webhooks can't be listed.
+    """
+    if not cluster.leader:
+        logger.info("Leaving the webhooks to the cluster leader.")
+        return
+    started = time.perf_counter()
+    try:
+        current = list(await api.webhooks.list())
+    except (ApiError, httpx.TransportError) as e:
+        logger.error(f"Couldn't list webhooks, trying again in {RECONCILESECONDS}s: {e}")
+        scheduler.schedule("webhook-reconcile", RECONCILESECONDS, reconcile_webhooks)
+        return
+    logger.info(f'Webhook count is: {len(current)}')
+    changes = 0
+    for (resource, event), (name, target_url) in WEBHOOKS.items():
+        matching = [webhook for webhook in current if webhook.resource == resource and webhook.event == event]
+        # Prefer a webhook already pointing at us over one left behind by an old URL
+        webhook = next((webhook for webhook in matching if webhook.targetUrl == target_url),
+                       matching[0] if matching else None)
         try:
-            api.webhooks.create("Card Attachment Webhook", ATTACHMENTWEBHOOKURL, "attachmentActions", "created")
-        except ApiError as e:
+            if webhook is None:
+                await api.webhooks.create(name, target_url, resource, event)
+                logger.info(f"Created {name}.")
+            elif webhook.targetUrl != target_url or webhook.name != name or webhook.status != "active":
+                await api.webhooks.update(webhook.id, name, target_url, status="active")
+                logger.info(f"Updated {name}.")
+            else:
+                continue
+            changes += 1
+        except (ApiError, httpx.TransportError) as e:
             logger.error(e)
+    logger.info(f"Webhooks checked in {(time.perf_counter() - started) * 1000:.0f}ms, {changes} changed.")
 
-    if webhookCount == 1:
-        for webhook in webhooks:
-            if "messages" in webhook.resource:
-                if "created" in webhook.event:
-                    logger.info("Existing Webhook is not Messages Webhook.")
-                    logger.info("Creating Messages Webhook.")
-                    try:
-                        api.webhooks.create("Message Webhook", MESSAGEWEBHOOKURL, "messages", "created")
-                    except ApiError as e:
-                        logger.error(e)
-            if "attachmentActions" in webhook.resource:
-                if "created" in webhook.event:
-                    logger.info("Existing Webhook is not Messages Webhook.")
-                    logger.info("Creating Messages Webhook.")
-                    try:
-                        api.webhooks.create("Card Attachment Webhook", ATTACHMENTWEBHOOKURL, "attachmentActions", "created")
-                    except ApiError as e:
-                        logger.error(e)
-    else:
-        for webhook in webhooks:
-            if ("messages" in webhook.resource) and ("created" in webhook.event):
-                webhook_id = webhook.id
-                try:
-                    api.webhooks.update(webhook_id, "Message Webhook", MESSAGEWEBHOOKURL)
-                    logger.info("Updated Message Webhook")
-                except ApiError as e:
-                    logger.error(e)
-
-            if ("attachmentActions" in webhook.resource) and ("created" in webhook.event):
-                webhook_id = webhook.id
-                try:
-                    api.webhooks.update(webhook_id, "Card Attachment Webhook", ATTACHMENTWEBHOOKURL)
-                    logger.info("Updated Attachment Webhook")
-                except ApiError as e:
-                    logger.error(e)
-
-def get_message(message_id, sender_name):
+def warm_up():
+    """Compile the triggers ahead of the first message."""
+    triggers.get()
+
+async def get_bot_identity():
+    """
+    Look up the bot's own person ID once at startup, so the messages webhook can recognise
+    the bot's own messages from the payload alone.
+    """
+    global BOTID
+    try:
+        bot = await api.people.me()
+        BOTID = bot.id
+        logger.info(f"Bot identity is {bot.displayName}.")
+    except (ApiError, httpx.TransportError) as e:
+        logger.error(e)
+        logger.info("Falling back to matching the bot by email only.")
+
+@time_calls(MESSAGE_SECONDS)
+@traced("get_message", root=True)
+async def get_message(message_id, sender_id, received=None):
     """
     Get the details of a message, check:
     if the sender was the bot then ignore;
-    if the sender wasn't the bot and it contains a trigger word, then run the emergency function
+    if the sender wasn't the bot and it contains a trigger word, then queue the emergency function
+    in the lane for the trigger's severity, for the on-call doctors of the trigger's specialty.
+    The sender's details are only fetched once a trigger word has matched. Webex is asked again if it
+    fails to answer, as the webhook has already been acknowledged and won't be redelivered.
         
     :param message_id: the ID of the message to retrieve
-    :param sender_name: the name of the person who sent the message
+    :param sender_id: the ID of the person who sent the message
+    :param received: perf_counter time the message's webhook arrived
     """
     try:
-        message_data = api.messages.get(message_id)
-        message = message_data.text
+        message_data = await dispatcher.read(api.messages.get, message_id)
+        message = message_data.text or ""
         sender = message_data.personEmail
-        sender_id = message_data.personId
         logger.info(f'{sender} sent {message}')
         if sender == BOTEMAIL:
             logger.info("Ignoring our own message")
-        elif any(word in message.lower() for word in triggers):
-            logger.info("Emergency Detected - Running Script.")
-            markdown = "We've received your emergency request... matching with a doctor. Sit tight."
-            reply(sender, markdown)
-            send_card(sender_id, sender_name)
-    except ApiError as e:
+            message_stats["bot_skipped"] += 1
+            return
+        trigger = triggers.get().match(message)
+        if trigger:
+            logger.info(f"Emergency Detected ('{trigger.keyword}', {trigger.severity}) - Running Script.")
+            message_stats["emergencies"] += 1
+            event_log.record("emergency", message_id=message_id, person_id=sender_id, keyword=trigger.keyword,
+                             severity=trigger.severity, specialty=trigger.specialty)
+            work.submit(severity_lane(trigger.severity), start_request, message_id, sender, sender_id, received,
+                        trigger.specialty)
+        else:
+            message_stats["no_trigger"] += 1
+    except (ApiError, httpx.TransportError) as e:
         logger.error(e)
-    
-def get_person(person_id):
+
+@traced("start_request", root=True)
+async def start_request(message_id, sender, sender_id, received=None, specialty=None):
+    """
+    Let the person know their emergency has been received and send the request card to the Doctors space.
+
+    :param message_id: ID of the emergency message.
+    :param sender: email of the person who sent the emergency.
+    :param sender_id: ID of the person who sent the emergency.
+    :param received: perf_counter time the message's webhook arrived.
+    :param specialty: roster specialty the request goes to, None for the general on-call doctors.
+    """
+    markdown = "We've received your emergency request... matching with a doctor. Sit tight."
+    # A failed acknowledgement is logged by reply, the card is sent either way
+    await reply(sender, markdown)
+    person = await get_person(sender_id)
+    sender_name = person.displayName if person else sender
+    await send_card(sender_id, sender_name, received, message_id, specialty)
+
+async def get_person(person_id):
     """
     Retrieve the details of a person based on ID.
+    Served from the person cache where possible, only a miss calls the Webex API, retrying if it fails.
 
     :param person_id: ID of the person
-    :returns: object with all information fof a person from Webex API
+    :returns: object with all information fof a person from Webex API, or None if it couldn't be retrieved
     """
     try:
         logger.info("Getting Person Details.")
-        data = api.people.get(person_id)
+        data = await people_cache.get(person_id, functools.partial(dispatcher.read, api.people.get))
         return data
-    except ApiError as e:
+    except (ApiError, httpx.TransportError) as e:
         logger.error(e)
 
-def reply(sender, markdown):
+async def reply(sender, markdown):
     """
     Function to send a reply.
 
@@ -242,352 +563,500 @@ def reply(sender, markdown):
     :param markdown: Markdown formatted message to be sent.
     """
     try:
-        api.messages.create(toPersonEmail=sender, markdown=markdown)
+        await dispatcher.send(URGENT, api.messages.create, toPersonEmail=sender, markdown=markdown)
         logger.info(f'Sending response to {sender}')
-    except ApiError as e:
+    except (ApiError, httpx.TransportError) as e:
         logger.error(e)
 
-def send_card(sender_id, sender_name):
+@traced("send_card")
+async def send_card(sender_id, sender_name, received=None, message_id=None, specialty=None):
     """
     Sending a card to the pre-defined doctors room.
     Also updates the database as required with information about the card.
-    Also sends the updates to the Doctors space if there is no response in the set time
+    Also schedules the escalation which sends updates to the Doctors space if there is no response in the set time
     
     :param sender_id: ID of the person who sent the initial message.
     :param sender_name: Name od the person who sent the initial message.
+    :param received: perf_counter time the message's webhook arrived, to measure how long the card took.
+    :param message_id: ID of the emergency message, to tie the card to it in the event log.
+    :param specialty: roster specialty the request goes to, None for the general on-call doctors.
     """
+    if QUEUECARDSECONDS:
+        await queue_request(sender_id, sender_name, message_id, specialty)
+        return
     current_DT = datetime.datetime.now()
     current_DT = current_DT.strftime("%H:%M")
     try:
-        card = [
-                {
-                    "contentType": "application/vnd.microsoft.card.adaptive",
-                    "content": {
-                        "type": "AdaptiveCard",
-                        "version": "1.0",
-                        "body": [
-                                    {
-                                        "type": "TextBlock",
-                                        "text": "Incoming Request",
-                                        "size": "ExtraLarge",
-                                        "color": "Warning",
-                                        "weight": "Bolder"
-                                    },
-                                    {
-                                        "type": "TextBlock",
-                                        "text": f"New request incoming from {sender_name}",
-                                        "size": "Medium",
-                                        "weight": "Bolder"
-                                    },
-                                    {
-                                        "type": "TextBlock",
-                                        "text": f"Request sent at {current_DT}",
-                                        "spacing": "ExtraLarge",
-                                        "size": "Medium"
-                                    },
-                                    {
-                                        "type": "ActionSet",
-                                        "actions": [
-                                            {
-                                                "type": "Action.Submit",
-                                                "title": "Click to Accept",
-                                                "id": ""
-                                            }
-                                        ]
-                                    }
-                                ],
-                        "$schema": "http://adaptivecards.io/schemas/adaptive-card.json",
-                    },
-                }
-            ]
-
-        card_res = api.messages.create(roomId=DOCTORSROOM, markdown="Card sent.", attachments=card )
+        card = cards["request"].render(sender_name=sender_name, time=current_DT)
+        card_res = await dispatcher.send(URGENT, api.messages.create, roomId=DOCTORSROOM, markdown="Card sent.", attachments=card)
         card_id = card_res.id
-        cur.execute("INSERT into webexTriage (card_id, type, sender_id, sender_name, clicked) VALUES (?, ?, ?, ?, ?)", (card_id, "request" , sender_id, sender_name, "0"))
-        con.commit()
-        message_count = 1
-        global CARDCLICKED
-        cur.execute("SELECT clicked FROM webexTriage WHERE card_id=?", (card_id,))
-        CARDCLICKED = cur.fetchone()
-        CARDCLICKED = CARDCLICKED[0]
-        while CARDCLICKED == '0':
-            if message_count < ALERTCOUNT:
-                message = f'<@all> Waiting for a response, mentioning all doctors attempt number {message_count}'
-                logger.debug(f"Message attempt {message_count}")
-                api.messages.create(roomId=DOCTORSROOM, parentId=card_id, markdown=message)
-            else:
-                time.sleep(2)
-                CARDCLICKED = True
-                logger.debug("Max attempts reached, messaging responder.")
-                message = f"Request timed out. Sending direct contact details for on-call doctors to {sender_name}"
-                api.messages.create(roomId=DOCTORSROOM, parentId=card_id, markdown=message)
-                message_responder(sender_id)
-                message = f"This request can still be accepted after the timeout, but the requester may already have assistance."
-                api.messages.create(roomId=DOCTORSROOM, parentId=card_id, markdown=message)
-            message_count += 1
-            time.sleep(TIMEOUTSECONDS)
-    except ApiError as e:
+        if received is not None:
+            CARD_SECONDS.observe(time.perf_counter() - received)
+        await db.add_request(card_id, sender_id, sender_name, specialty=specialty)
+        event_log.record("card_sent", card_id=card_id, message_id=message_id, sender_id=sender_id,
+                         sender_name=sender_name)
+        # Hand the reminders and timeout over to the scheduler so the webhook can return
+        scheduler.schedule(card_id, 0, escalate, card_id)
+    except (ApiError, httpx.TransportError) as e:
         logger.error(e)
 
-def send_clean_up(room_id):
+async def queue_request(sender_id, sender_name, message_id=None, specialty=None):
+    """
+    Add a request to the queue card in the Doctors space rather than sending it a card of its own.
+    The request is recorded under its own ID, which its accept button on the queue card submits.
+
+    :param sender_id: ID of the person who sent the initial message.
+    :param sender_name: Name of the person who sent the initial message.
+    :param message_id: ID of the emergency message, used as the request's ID.
+    :param specialty: roster specialty the request goes to, None for the general on-call doctors.
+    """
+    request_id = message_id or uuid.uuid4().hex
+    await db.add_request(request_id, sender_id, sender_name, kind="queued", specialty=specialty)
+    event_log.record("card_sent", card_id=request_id, message_id=message_id, sender_id=sender_id,
+                     sender_name=sender_name)
+    await queue_card.changed()
+    scheduler.schedule(request_id, 0, escalate, request_id)
+
+@traced("repost_queue_card", root=True)
+async def repost_queue_card(changes):
+    """
+    Replace the queue card with one listing every request still waiting, with any reminder due as a reply to it.
+    Requests accepted since the last card are announced together in one message. The old card is deleted before
+    the new one is posted, so a failure part way through never leaves two cards showing. Each step is recorded
+    on `changes` as it is done, and the steps not done are left for the next repost.
+
+    :param changes: QueueChanges since the card was posted.
+    """
+    requests = await db.queued_requests()
+    try:
+        if changes.card_id is not None:
+            try:
+                await dispatcher.send(URGENT, api.messages.delete, changes.card_id)
+            except ApiError as e:
+                # Already deleted, e.g. by hand
+                if e.status_code != 404:
+                    raise
+            changes.card_id = None
+        if requests:
+            entries = [{"request_id": request_id, "sender_name": sender_name,
+                        "time": datetime.datetime.fromtimestamp(created).strftime("%H:%M"),
+                        "status": " - timed out, contacts sent" if state == "timed_out" else ""}
+                       for request_id, sender_name, state, created in requests]
+            card = cards["queue"].render(requests=entries, count=len(entries),
+                                         time=datetime.datetime.now().strftime("%H:%M"))
+            card_res = await dispatcher.send(URGENT, api.messages.create, roomId=DOCTORSROOM, markdown="Card sent.",
+                                             attachments=card)
+            changes.card_id = card_res.id
+            # The new requests are timed from when they were recorded, as another worker may have received them
+            posted = time.time()
+            for _, _, _, created in requests:
+                if changes.since is None or created > changes.since:
+                    CARD_SECONDS.observe(posted - created)
+        changes.posted = True
+        if changes.reminder and requests:
+            message = f'{reminder_mentions(changes.reminder)} {len(requests)} requests waiting for a response'
+            await dispatcher.send(ESCALATION, api.messages.create, roomId=DOCTORSROOM, parentId=changes.card_id,
+                                  markdown=message)
+        changes.reminded = True
+        if changes.accepted:
+            message = "\n".join(f"{responder_name} has accepted the request from {sender_name}."
+                                 for sender_name, responder_name in changes.accepted)
+            await dispatcher.send(ROUTINE, api.messages.create, roomId=DOCTORSROOM, markdown=message)
+        changes.announced = True
+    except (ApiError, httpx.TransportError) as e:
+        logger.error(e)
+
+""" The queue card, reposted once a window when QUEUECARDSECONDS is set"""
+queue_card = QueueCard(db, scheduler, QUEUECARDSECONDS, repost_queue_card, WORKERID, CLAIMSECONDS)
+
+async def poll_escalations():
+    """
+    Find escalations that are due and not claimed by a live worker, and advance them.
+    Runs periodically on every worker so steps still happen if the worker which sent the card
+    has restarted or gone away. In a cluster each instance only advances its own share of the cards.
+    """
+    for card_id in await db.due_escalations(time.time(), limit=50 * cluster.size()):
+        if cluster.owns(card_id):
+            await escalate(card_id)
+
+async def cluster_heartbeat():
+    """Heartbeat to the rest of the cluster, and reconcile the webhooks on becoming the leader."""
+    if await cluster.heartbeat():
+        scheduler.schedule("webhook-reconcile", 0, reconcile_webhooks)
+
+async def prune_events():
+    """Forget handled webhook events old enough that Webex won't redeliver them."""
+    await db.prune_events(time.time() - EVENTSECONDS)
+
+@time_calls(SWEEP_DURATION)
+async def sweep():
+    """
+    Clear away what's been left behind, in batches and at housekeeping priority so it never holds up requests.
+    Deletes rooms older than STALEHOURS whose clean up card was never clicked, moves requests older than
+    STALEHOURS (e.g. timed out cards) to the archive, deletes archived requests older than ARCHIVEDAYS and
+    then compacts the database.
+    In a cluster each instance deletes its own share of the stale rooms, and the rest is left to the leader.
+    """
+    now = time.time()
+    stale = now - STALEHOURS * 3600
+    rooms = [(room_id, card_id) for room_id, card_id in await db.stale_rooms(stale, SWEEPBATCH * cluster.size())
+             if cluster.owns(card_id or room_id)]
+    for room_id, _ in rooms:
+        try:
+            await dispatcher.send(HOUSEKEEPING, api.rooms.delete, room_id)
+        except ApiError as e:
+            # Already deleted by hand, or removed by Webex - forget it either way
+            if e.status_code != 404:
+                logger.error(e)
+                continue
+        except httpx.TransportError as e:
+            logger.error(e)
+            continue
+        await db.delete_room(room_id)
+        event_log.record("cleaned_up", room_id=room_id, swept=True)
+        SWEPT.labels("room").inc()
+
+    if not cluster.leader:
+        if rooms:
+            logger.info(f"Swept {len(rooms)} rooms.")
+        return
+
+    archived = 0
+    while True:
+        card_ids = await db.stale_requests(stale, SWEEPBATCH)
+        if not card_ids:
+            break
+        for card_id in card_ids:
+            scheduler.cancel(card_id)
+        archived += await db.archive_requests(card_ids)
+        # Let writes from requests in between batches
+        await asyncio.sleep(0)
+    SWEPT.labels("request").inc(archived)
+    if archived and QUEUECARDSECONDS:
+        # Take any archived requests off the queue card
+        await queue_card.changed()
+
+    pruned = 0
+    while True:
+        deleted = await db.prune_archive(now - ARCHIVEDAYS * 86400, SWEEPBATCH)
+        pruned += deleted
+        if deleted < SWEEPBATCH:
+            break
+    SWEPT.labels("archived_request").inc(pruned)
+
+    if rooms or archived or pruned:
+        await db.compact()
+        logger.info(f"Swept {len(rooms)} rooms, archived {archived} requests and deleted {pruned} archived requests.")
+
+@traced("escalate", root=True)
+async def escalate(card_id):
+    """
+    Run one escalation step for a card that hasn't been accepted yet.
+    Sends a reminder to the Doctors space and schedules the next step, or once the
+    alert count is reached, times the request out and sends the requester the on-call contacts.
+    The step is claimed in the database first, so it only runs once across all workers. In a cluster
+    a step for a card in another instance's share is left to that instance's poll.
+
+    :param card_id: ID of the card sent to the Doctors space.
+    """
+    if not cluster.owns(card_id):
+        logger.debug(f"Escalation for card {card_id} belongs to {cluster.owner(card_id)}.")
+        return
+    claim = await db.claim_escalation(card_id, WORKERID, CLAIMSECONDS)
+    if claim is None:
+        logger.debug(f"Escalation for card {card_id} is not due or is handled elsewhere.")
+        return
+    sender_id, sender_name, message_count, kind, specialty = claim
+    if kind == "queued":
+        await escalate_queued(card_id, sender_id, message_count, specialty)
+        return
+    try:
+        if message_count < ALERTCOUNT:
+            message = f'{reminder_mentions(message_count, specialty)} Waiting for a response attempt number {message_count}'
+            logger.debug(f"Message attempt {message_count}")
+            await dispatcher.send(ESCALATION, api.messages.create, roomId=DOCTORSROOM, parentId=card_id, markdown=message)
+            await db.release_escalation(card_id, WORKERID, "pending", message_count + 1, time.time() + TIMEOUTSECONDS)
+            event_log.record("reminder", card_id=card_id, attempt=message_count)
+            scheduler.schedule(card_id, TIMEOUTSECONDS, escalate, card_id)
+        else:
+            logger.debug("Max attempts reached, messaging responder.")
+            message = f"Request timed out. Sending direct contact details for on-call doctors to {sender_name}"
+            await dispatcher.send(ESCALATION, api.messages.create, roomId=DOCTORSROOM, parentId=card_id, markdown=message)
+            await message_responder(sender_id, specialty)
+            message = f"This request can still be accepted after the timeout, but the requester may already have assistance."
+            await dispatcher.send(ESCALATION, api.messages.create, roomId=DOCTORSROOM, parentId=card_id, markdown=message)
+            await db.release_escalation(card_id, WORKERID, "timed_out", message_count, None)
+            event_log.record("timed_out", card_id=card_id, attempt=message_count)
+    except (ApiError, httpx.TransportError) as e:
+        logger.error(e)
+
+async def escalate_queued(request_id, sender_id, message_count, specialty=None):
+    """
+    Run one escalation step for a request on the queue card, which has been claimed.
+    The reminder goes out with the next queue card, as does the request being marked as timed out.
+
+    :param request_id: ID of the request.
+    :param sender_id: ID of the person who sent the emergency.
+    :param message_count: the attempt number of the step.
+    :param specialty: roster specialty the request goes to, None for the general on-call doctors.
+    """
+    try:
+        if message_count < ALERTCOUNT:
+            await queue_card.remind(message_count)
+            await db.release_escalation(request_id, WORKERID, "pending", message_count + 1,
+                                        time.time() + TIMEOUTSECONDS)
+            event_log.record("reminder", card_id=request_id, attempt=message_count)
+            scheduler.schedule(request_id, TIMEOUTSECONDS, escalate, request_id)
+        else:
+            await message_responder(sender_id, specialty)
+            await db.release_escalation(request_id, WORKERID, "timed_out", message_count, None)
+            event_log.record("timed_out", card_id=request_id, attempt=message_count)
+            await queue_card.changed()
+    except (ApiError, httpx.TransportError) as e:
+        logger.error(e)
+
+def reminder_mentions(message_count, specialty=None):
+    """
+    Work out who a reminder should mention, escalating through the on-call tiers in the roster.
+    Falls back to mentioning everyone in the Doctors space if nobody is on call in the tier.
+
+    :param message_count: the attempt number of the reminder.
+    :param specialty: roster specialty the request goes to, None for the general on-call doctors.
+    :returns: markdown mentions for the reminder.
+    """
+    on_call = roster.get().on_call(specialty=specialty)
+    doctors = [doctor for tier in REMINDERTIERS.get(message_count, ()) for doctor in getattr(on_call, tier)]
+    mentions = [f"<@personEmail:{doctor['email']}|{doctor['name']}>" for doctor in doctors]
+    return " ".join(mentions) or "<@all>"
+
+def contact_card(specialty=None):
+    """
+    Render the contact card for the doctors on call now.
+    Cached on the roster, so it is only rendered again when the roster or the doctors on call change.
+
+    :param specialty: roster specialty to list the doctors of, None for the general on-call doctors.
+    :returns: the rendered card attachments.
+    """
+    current = roster.get()
+    doctors = current.contacts(specialty=specialty)
+    key = ("contacts",) + tuple(doctor["name"] for doctor in doctors)
+    if key not in current.cache:
+        current.cache[key] = cards["contacts"].render(doctors=doctors)
+    return current.cache[key]
+
+async def send_clean_up(room_id):
     """
     Function to send a card to a room to request post conversation action (currently to delete the space and clean up).
 
     :param room_id: ID of the room for the card to be sent to
     """
     try:
-        card = [
-                {
-                    "contentType": "application/vnd.microsoft.card.adaptive",
-                    "content": {
-                        "type": "AdaptiveCard",
-                        "version": "1.0",
-                        "body": [
-                            {
-                                "type": "TextBlock",
-                                "text": "When you've finished in this space, click the button below to clean up and delete this room.",
-                                "wrap": True,
-                            },
-                            {
-                                "type": "ActionSet",
-                                "actions": [
-                                    {"type": "Action.Submit", "title": "Clean Up!"}
-                                ],
-                            },
-                        ],
-                        "$schema": "http://adaptivecards.io/schemas/adaptive-card.json",
-                    },
-                }
-            ]
-        api.messages.create(roomId=room_id, markdown="Clean up sent.", attachments=card)
-    except ApiError as e:
+        card = cards["clean_up"].render()
+        await dispatcher.send(ROUTINE, api.messages.create, roomId=room_id, markdown="Clean up sent.", attachments=card)
+    except (ApiError, httpx.TransportError) as e:
         logger.error(e)
 
-def create_room(card_id, actionClicker):
+@traced("create_room")
+async def create_room(card_id, actionClicker):
     """ 
     Create the room which the person requesting assistance as well as the doctor who responded will be added.
     The room name will be in the format '{Current Date and Time} - {Sender Name} & {Responder Name}'
     Database also updated accordingly.
 
-    (Long function which probably needs breaking up)
+    Only the room and the two members are on the path to the room being ready, and the members are
+    added together once the room exists. The clean up card, the notice in the Doctors space and
+    deleting the request card are handed to the scheduler to finish after the webhook has returned,
+    even if a member couldn't be added, in which case the room is told who is missing.
+    Each step is timed and logged.
 
     :param card_id: ID of the card which was accepted to trigger the room creation.
     :param actionClicker: object with the Webex information of the person who accepted the card.
+    :returns: True once the room has been created, False if it couldn't be.
     """
+    timings = {}
+    started = time.perf_counter()
+    if actionClicker is None:
+        logger.error(f"No details of who accepted card {card_id}, can't set up the room.")
+        return False
     try:
         current_DT = datetime.datetime.now()
         current_DT = current_DT.strftime("%Y-%m-%d %H:%M")
         responder_name = actionClicker.displayName
         responder_id = actionClicker.id
         logger.debug(f'responder_id: {responder_id}')
-        cur.execute("SELECT sender_name FROM webexTriage WHERE card_id=?", (card_id,))
-        sender_name = cur.fetchone()
-        sender_name = sender_name[0]
-        logger.debug(f"sender_name: {sender_name}")
-        cur.execute("SELECT sender_id FROM webexTriage WHERE card_id=?", (card_id,))
-        sender_id = cur.fetchone()
-        sender_id = sender_id[0]
-        logger.debug(f"sender_id: {sender_id}")
-        cur.execute("UPDATE webexTriage SET responder_name = ?,responder_id = ? WHERE card_id=?", (card_id, responder_name, responder_id))
-        con.commit()
+        request = await db.get_request(card_id)
+        if request is None:
+            logger.info(f"No open request for card {card_id}.")
+            return False
+        sender_name, sender_id, kind = request
+        logger.debug(f"sender_name: {sender_name}, sender_id: {sender_id}")
         title = str(f'{current_DT} - {sender_name} & {responder_name}')
-        room_res = api.rooms.create(title)
+        room_res = await timed(timings, "room", dispatcher.send(URGENT, api.rooms.create, title))
         room_id = room_res.id
-        # Add room_id to shelve
-        cur.execute(''' UPDATE webexTriage
-                SET room_id = ?
-                WHERE card_id=?''', (card_id, room_id,))
-        con.commit()
-        ROOMSLIST.add(room_id)
-        try:
-            api.memberships.create(room_id, personId=responder_id)
-            logger.info(f'Added {responder_name} to space.')
-        except ApiError as e:
-            memberships = api.memberships.list(roomId=room_id)
-            for membership in memberships:
-                if membership.personId == responder_id:
-                    logger.error("Person is already in the space.")
-                    logger.error(e)
-                    break
-        try:
-            api.memberships.create(room_id, personId=sender_id)
-            logger.info(f'Added {sender_name} to space.')
-        except ApiError as e:
-            memberships = api.memberships.list(roomId=room_id)
-            for membership in memberships:
-                if membership.personId == sender_id:
-                    logger.error("Person is already in the space.")
-                    logger.error(e)
-                    break
-        send_clean_up(room_id)
-        message = f'{responder_name} has accepted this job. Message will be deleted shortly.'
-        api.messages.create(roomId=DOCTORSROOM, parentId=card_id, markdown=message)
-        api.messages.delete(card_id)
-        cur.execute(''' UPDATE webexTriage
-                SET clicked = 1
-                WHERE card_id=?''', (card_id,))
-        con.commit()
+        # Record the responder and the room so the clean up click can be handled by any worker
+        _, responder_added, sender_added = await asyncio.gather(
+            timed(timings, "add_room", db.add_room(card_id, room_id, responder_id, responder_name)),
+            timed(timings, "responder", add_member(room_id, responder_id, responder_name)),
+            timed(timings, "sender", add_member(room_id, sender_id, sender_name)),
+        )
+        missing = [name for name, added in ((responder_name, responder_added), (sender_name, sender_added))
+                   if not added]
+        if missing:
+            scheduler.schedule(f"{card_id}:missing", 0, report_missing, room_id, missing)
+        ready = time.perf_counter() - started
+        ROOM_SECONDS.observe(ready)
+        event_log.record("room_created", card_id=card_id, room_id=room_id, doctor_id=responder_id,
+                         seconds=round(ready, 3))
+        log_timings(f"Room for card {card_id} ready", started, timings)
+        if kind == "queued":
+            scheduler.schedule(f"{card_id}:accepted", 0, finish_queued_request, card_id, room_id, responder_name,
+                               sender_name)
+        else:
+            scheduler.schedule(f"{card_id}:accepted", 0, finish_request, card_id, room_id, responder_name)
+        return True
+    except (ApiError, httpx.TransportError) as e:
+        logger.error(e)
+        return False
+
+async def add_member(room_id, person_id, name):
+    """
+    Add a person to a room, it isn't an error if they are in it already.
+
+    :param room_id: ID of the room.
+    :param person_id: ID of the person to add.
+    :param name: name of the person, for the log.
+    :returns: True if the person is in the room.
+    """
+    try:
+        await dispatcher.send(URGENT, api.memberships.create, room_id, personId=person_id)
+        logger.info(f'Added {name} to space.')
+        return True
+    except (ApiError, httpx.TransportError) as e:
+        error = e
+    try:
+        memberships = await dispatcher.read(api.memberships.list, roomId=room_id, personId=person_id)
+    except (ApiError, httpx.TransportError) as e:
+        logger.error(f"Could not check whether {name} is in the space: {e}")
+        memberships = []
+    for membership in memberships:
+        if membership.personId == person_id:
+            logger.error("Person is already in the space.")
+            logger.error(error)
+            return True
+    logger.error(f"Could not add {name} to space.")
+    logger.error(error)
+    return False
+
+async def report_missing(room_id, names):
+    """
+    Tell a request's room who couldn't be added to it, so they can be added by hand.
+
+    :param room_id: ID of the room.
+    :param names: names of the people missing from the room.
+    """
+    message = f"Couldn't add {' and '.join(names)} to this space, please add them by hand."
+    try:
+        await dispatcher.send(URGENT, api.messages.create, roomId=room_id, markdown=message)
+    except (ApiError, httpx.TransportError) as e:
+        logger.error(e)
+
+@traced("finish_request", root=True)
+async def finish_request(card_id, room_id, responder_name):
+    """
+    The steps after an accepted request's room is ready which nobody is waiting on.
+    Sends the clean up card to the room while telling the Doctors space who accepted the request,
+    then removes the request card and its database entry.
+
+    :param card_id: ID of the accepted card.
+    :param room_id: ID of the room created for the request.
+    :param responder_name: name of the doctor who accepted.
+    """
+    timings = {}
+    started = time.perf_counter()
+    message = f'{responder_name} has accepted this job. Message will be deleted shortly.'
+
+    async def notify_and_delete():
+        # The notice is a reply to the card, so the card can only go once the notice has been sent
+        await timed(timings, "notice", dispatcher.send(ROUTINE, api.messages.create, roomId=DOCTORSROOM,
+                                                       parentId=card_id, markdown=message))
+        await timed(timings, "delete_card", dispatcher.send(ROUTINE, api.messages.delete, card_id))
+
+    try:
+        await asyncio.gather(timed(timings, "clean_up_card", send_clean_up(room_id)), notify_and_delete())
         logger.debug('Deleting Database entry.')
-        cur.execute("DELETE from webexTriage WHERE card_id=?", (card_id,))
-    except ApiError as e:
+        await timed(timings, "delete_request", db.delete_request(card_id))
+        log_timings(f"Request {card_id} finished", started, timings)
+    except (ApiError, httpx.TransportError) as e:
         logger.error(e)
 
-def clean_up(room_id):
+@traced("finish_queued_request", root=True)
+async def finish_queued_request(request_id, room_id, responder_name, sender_name):
+    """
+    The steps after the room is ready for an accepted request on the queue card.
+    Sends the clean up card to the room and removes the database entry, and the request is taken off
+    the queue card and announced as accepted when the card is next reposted.
+
+    :param request_id: ID of the accepted request.
+    :param room_id: ID of the room created for the request.
+    :param responder_name: name of the doctor who accepted.
+    :param sender_name: name of the person who sent the request.
+    """
+    await queue_card.accepted(sender_name, responder_name)
+    await send_clean_up(room_id)
+    await db.delete_request(request_id)
+
+async def timed(timings, step, awaitable):
+    """
+    Await a step and record how long it took, in the timings and the step metrics.
+
+    :param timings: dict the step's duration in milliseconds is recorded in.
+    :param step: name of the step.
+    :param awaitable: the step to await.
+    :returns: the step's result.
+    """
+    start = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        elapsed = time.perf_counter() - start
+        STEP_SECONDS.labels(step).observe(elapsed)
+        timings[step] = elapsed * 1000
+
+def log_timings(event, started, timings):
+    """Log the total time since `started` and the time of each step."""
+    steps = ", ".join(f"{step} {duration:.0f}ms" for step, duration in timings.items())
+    logger.info(f"{event} in {(time.perf_counter() - started) * 1000:.0f}ms ({steps})")
+
+@time_calls(CLEAN_UP_SECONDS)
+@traced("clean_up", root=True)
+async def clean_up(room_id):
     """
     Function to clean up the room
 
     :param room_id: ID of the room to be cleaned up.
     """
     try:
-        api.rooms.delete(room_id)
+        await dispatcher.send(HOUSEKEEPING, api.rooms.delete, room_id)
         logger.info("Space has been cleaned up.")
-        ROOMSLIST.remove(room_id)
-        logger.info("Room purged from list.")
-    except ApiError as e:
+        await db.delete_room(room_id)
+        logger.info("Room purged from database.")
+        event_log.record("cleaned_up", room_id=room_id, swept=False)
+    except (ApiError, httpx.TransportError) as e:
         logger.error(e)
 
-def message_responder(sender_id):
+async def message_responder(sender_id, specialty=None):
     """
     Function to send a message to the person requesting assistance after the timeout has occurred.
-    Currently sends a card with static data ot the requester.
+    Sends the requester the contact card for the doctors currently on call.
     
     :param sender_id: ID of the person who requested assistance initiall, who will be receiving the timeout response.
+    :param specialty: roster specialty the request went to, None for the general on-call doctors.
     """
     try:
         logger.debug("Sending contact info to responder after timeout.")
-        card = [
-                    {
-                        "contentType": "application/vnd.microsoft.card.adaptive",
-                        "content": {
-                            "type": "AdaptiveCard",
-                            "version": "1.0",
-                            "body": [
-                            {
-                                "type": "TextBlock",
-                                "text": "Doctor Contact Information",
-                                "size": "Large",
-                                "weight": "Bolder",
-                                "color": "Attention"
-                            },
-                            {
-                                "type": "TextBlock",
-                                "text": "No doctors were available to accept the request within the time.  Here are the direct contacts for the currently on-call doctors:",
-                                "wrap": True,
-                                "weight": "Bolder"
-                            },
-                            {
-                                "type": "ColumnSet",
-                                "columns": [
-                                    {
-                                        "type": "Column",
-                                        "width": "stretch",
-                                        "items": [
-                                            {
-                                                "type": "TextBlock",
-                                                "text": "Dr. Ashutosh",
-                                                "size": "Large",
-                                                "horizontalAlignment": "Center"
-                                            }
-                                        ]
-                                    },
-                                    {
-                                        "type": "Column",
-                                        "width": "stretch",
-                                        "items": [
-                                            {
-                                                "type": "ActionSet",
-                                                "actions": [
-                                                    {
-                                                        "type": "Action.OpenUrl",
-                                                        "title": "Call",
-                                                        "url": "https://cutt.ly/sk5GhLn"
-                                                    }
-                                                ],
-                                                "spacing": "None",
-                                                "horizontalAlignment": "Center"
-                                            }
-                                        ]
-                                    }
-                                ],
-                            },
-                            {
-                                "type": "ColumnSet",
-                                "columns": [
-                                    {
-                                        "type": "Column",
-                                        "width": "stretch",
-                                        "items": [
-                                            {
-                                                "type": "TextBlock",
-                                                "text": "Dr. Ollie",
-                                                "size": "Large",
-                                                "horizontalAlignment": "Center"
-                                            }
-                                        ]
-                                    },
-                                    {
-                                        "type": "Column",
-                                        "width": "stretch",
-                                        "items": [
-                                            {
-                                                "type": "ActionSet",
-                                                "actions": [
-                                                    {
-                                                        "type": "Action.OpenUrl",
-                                                        "title": "Call",
-                                                        "url": "https://cutt.ly/bk5Gx4n"
-                                                    }
-                                                ],
-                                                "horizontalAlignment": "Center"
-                                            }
-                                        ]
-                                    }
-                                ]
-                            },
-                            {
-                                "type": "ColumnSet",
-                                "columns": [
-                                    {
-                                        "type": "Column",
-                                        "width": "stretch",
-                                        "items": [
-                                            {
-                                                "type": "TextBlock",
-                                                "text": "Dr. Patrick",
-                                                "size": "Large",
-                                                "horizontalAlignment": "Center"
-                                            }
-                                        ]
-                                    },
-                                    {
-                                        "type": "Column",
-                                        "width": "stretch",
-                                        "items": [
-                                            {
-                                                "type": "ActionSet",
-                                                "actions": [
-                                                    {
-                                                        "type": "Action.OpenUrl",
-                                                        "title": "Call",
-                                                        "url": "https://cutt.ly/Rk5GEzL"
-                                                    }
-                                                ],
-                                                "horizontalAlignment": "Center"
-                                            }
-                                        ]
-                                    }
-                                ]
-                            }
-                        ],
-                            "$schema": "http://adaptivecards.io/schemas/adaptive-card.json",
-                        },
-                    }
-                ]
+        card = contact_card(specialty)
 
         # Actually send the card
-        api.messages.create(toPersonId=sender_id, markdown="Card sent.", attachments=card)
-    except ApiError as e:
+        await dispatcher.send(URGENT, api.messages.create, toPersonId=sender_id, markdown="Card sent.", attachments=card)
+    except (ApiError, httpx.TransportError) as e:
         logger.error(e)
-
-"""Run check webhooks when the script first starts"""
-check_webhooks()
\ No newline at end of file
@@ -0,0 +1,249 @@
+"""
+Prometheus style metrics, served as text from the `/metrics` endpoint.
+
+Each label set of a metric gets its own child holding its values, and a histogram child has its
+bucket counts allocated up front, so recording a value is a dict lookup, a bisect and a couple of
+additions. Figures the bot already keeps elsewhere (cache stats, queue depths) are registered as
+callbacks and read when the endpoint is scraped.
+
+Updates aren't locked. The writer thread records into its own metrics, and at worst a racing
+update is lost, which is acceptable for monitoring.
+"""
+import bisect
+import functools
+import math
+import time
+
+
+""" Default histogram buckets in seconds, from a fast cached lookup to a slow Webex call"""
+DEFAULTBUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names, values):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Timer:
+    """Context manager observing the seconds spent inside it."""
+
+    __slots__ = ("child", "start")
+
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.child.observe(time.perf_counter() - self.start)
+
+
+class HistogramChild:
+    __slots__ = ("buckets", "counts", "sum")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # One count per bucket plus the +Inf bucket, cumulated when rendered
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def time(self):
+        """:returns: a context manager observing the time spent in it."""
+        return Timer(self)
+
+
+def time_calls(child):
+    """
+    Decorator observing how long each call of a coroutine function takes.
+
+    :param child: histogram (or histogram child) to record the times in.
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                child.observe(time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+
+class Metric:
+    """
+    A named metric with an optional set of labels.
+
+    :param name: metric name.
+    :param documentation: help text.
+    :param labelnames: names of the metric's labels.
+    """
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        if not self.labelnames:
+            self._unlabelled = self.labels()
+
+    def _child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """
+        The child for a label set, created on first use. Hold on to the child to skip the lookup.
+
+        :param values: a value for each label, in order.
+        """
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} takes the labels {self.labelnames}.")
+            child = self._children[values] = self._child()
+        return child
+
+    def samples(self):
+        """:returns: (suffix, label names, label values, value) for every sample of the metric."""
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def _child(self):
+        return CounterChild()
+
+    def inc(self, amount=1):
+        self._unlabelled.inc(amount)
+
+    def samples(self):
+        for values, child in self._children.items():
+            yield "_total", self.labelnames, values, child.value
+
+
+class Histogram(Metric):
+    """
+    :param buckets: upper bounds of the buckets in ascending order, +Inf is added.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULTBUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _child(self):
+        return HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._unlabelled.observe(value)
+
+    def time(self):
+        return self._unlabelled.time()
+
+    def samples(self):
+        names = self.labelnames + ("le",)
+        for values, child in self._children.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), child.counts):
+                cumulative += count
+                yield "_bucket", names, values + (format_value(bound),), cumulative
+            yield "_sum", self.labelnames, values, child.sum
+            yield "_count", self.labelnames, values, cumulative
+
+
+class Callback(Metric):
+    """
+    A metric read from elsewhere when it is scraped.
+
+    :param kind: 'gauge' or 'counter'.
+    :param function: returns the value, or a dict of label value tuples to values if the metric has labels.
+    """
+
+    def __init__(self, name, documentation, kind, function, labelnames=()):
+        self.kind = kind
+        self.function = function
+        super().__init__(name, documentation, labelnames)
+
+    def _child(self):
+        return None
+
+    def samples(self):
+        suffix = "_total" if self.kind == "counter" else ""
+        value = self.function()
+        if not self.labelnames:
+            yield suffix, (), (), value
+            return
+        for values, sample in value.items():
+            yield suffix, self.labelnames, values if isinstance(values, tuple) else (values,), sample
+
+
+class Registry:
+    """The metrics served by the bot, in the order they were registered."""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered.")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        """:returns: every metric in the Prometheus text format."""
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {escape(metric.documentation)}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for suffix, names, values, value in metric.samples():
+                lines.append(f"{metric.name}{suffix}{format_labels(names, values)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+CONTENTTYPE = "text/plain; version=0.0.4"
+
+
+def counter(name, documentation, labelnames=()):
+    """Register a counter with the default registry."""
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULTBUCKETS):
+    """Register a histogram with the default registry."""
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+
+def callback(name, documentation, function, kind="gauge", labelnames=()):
+    """Register a metric read from `function` when scraped with the default registry."""
+    return REGISTRY.register(Callback(name, documentation, kind, function, labelnames))
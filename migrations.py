@@ -0,0 +1,128 @@
+"""
+Versioned schema migrations for the webexTriage database.
+
+The schema version is kept in SQLite's `user_version` pragma. Each migration brings the database
+from the version before it to its own version, and runs in a single transaction.
+"""
+from loguru import logger
+
+
+def create_tables(cur):
+    """Version 1 - the original tables plus the escalation state columns and the rooms table."""
+    cur.execute('''CREATE TABLE IF NOT EXISTS webexTriage
+                   (card_id text, type text, sender_id text, sender_name text, clicked text, responder_id text,
+                    responder_name text, room_id text)''')
+    columns = [column[1] for column in cur.execute("PRAGMA table_info(webexTriage)")]
+    for column, column_type in (("state", "text"), ("attempt", "integer"), ("next_due", "real"),
+                                ("claimed_by", "text"), ("claim_expires", "real")):
+        if column not in columns:
+            cur.execute(f"ALTER TABLE webexTriage ADD COLUMN {column} {column_type}")
+    cur.execute('''CREATE TABLE IF NOT EXISTS webexRooms
+                   (room_id text PRIMARY KEY, card_id text, created real)''')
+
+
+def add_keys_and_indexes(cur):
+    """
+    Version 2 - rebuild webexTriage with card_id as the primary key and a created time, and index
+    the room, due time and state/age lookups. If a card has more than one row the last one is kept.
+    """
+    cur.execute('''CREATE TABLE webexTriageNew
+                   (card_id text PRIMARY KEY, type text, sender_id text, sender_name text, clicked text,
+                    responder_id text, responder_name text, room_id text, state text, attempt integer,
+                    next_due real, claimed_by text, claim_expires real, created real)''')
+    cur.execute('''INSERT OR REPLACE INTO webexTriageNew
+                   (card_id, type, sender_id, sender_name, clicked, responder_id, responder_name, room_id,
+                    state, attempt, next_due, claimed_by, claim_expires, created)
+                   SELECT card_id, type, sender_id, sender_name, clicked, responder_id, responder_name, room_id,
+                          state, attempt, next_due, claimed_by, claim_expires,
+                          CAST(strftime('%s', 'now') AS real)
+                   FROM webexTriage
+                   WHERE card_id IS NOT NULL
+                   ORDER BY rowid''')
+    cur.execute("DROP TABLE webexTriage")
+    cur.execute("ALTER TABLE webexTriageNew RENAME TO webexTriage")
+    cur.execute("CREATE INDEX webexTriage_due ON webexTriage (state, next_due)")
+    cur.execute("CREATE INDEX webexTriage_room ON webexTriage (room_id)")
+    cur.execute("CREATE INDEX webexTriage_state_created ON webexTriage (state, created)")
+    cur.execute("CREATE INDEX IF NOT EXISTS webexRooms_created ON webexRooms (created)")
+
+
+def add_webhook_events(cur):
+    """Version 3 - webhook events already handled, used to drop duplicate deliveries."""
+    cur.execute('''CREATE TABLE webhookEvents
+                   (event_id text PRIMARY KEY, resource text, received real)''')
+    cur.execute("CREATE INDEX webhookEvents_received ON webhookEvents (received)")
+
+
+def add_archive(cur):
+    """Version 4 - archive for request rows swept out of webexTriage, so the live table stays small."""
+    cur.execute('''CREATE TABLE webexTriageArchive
+                   (card_id text PRIMARY KEY, type text, sender_id text, sender_name text, clicked text,
+                    responder_id text, responder_name text, room_id text, state text, attempt integer,
+                    next_due real, claimed_by text, claim_expires real, created real, archived real)''')
+    cur.execute("CREATE INDEX webexTriageArchive_archived ON webexTriageArchive (archived)")
+
+
+def add_cluster(cur):
+    """Version 5 - the instances in a cluster with when each was last heard from, and the leases they hold."""
+    cur.execute('''CREATE TABLE clusterMembers
+                   (worker_id text PRIMARY KEY, heartbeat real, joined real)''')
+    cur.execute('''CREATE TABLE clusterLeases
+                   (name text PRIMARY KEY, holder text, expires real)''')
+
+
+def add_specialty(cur):
+    """Version 6 - the roster specialty a request goes to, None for the general on-call doctors."""
+    cur.execute("ALTER TABLE webexTriage ADD COLUMN specialty text")
+    cur.execute("ALTER TABLE webexTriageArchive ADD COLUMN specialty text")
+
+
+def add_queue_card(cur):
+    """
+    Version 7 - the queue card shared by every worker: the card showing, when it is due to be reposted and the
+    changes waiting to go out with it, and the accepted requests still to be announced.
+    """
+    cur.execute('''CREATE TABLE queueCard
+                   (name text PRIMARY KEY, card_id text, due real, reminder integer, version integer,
+                    posted real, claimed_by text, claim_expires real)''')
+    cur.execute("INSERT INTO queueCard (name, reminder, version) VALUES ('doctors', 0, 0)")
+    cur.execute('''CREATE TABLE queueCardAccepted
+                   (id integer PRIMARY KEY AUTOINCREMENT, sender_name text, responder_name text)''')
+
+
+""" Migrations in order, the position in the list + 1 is the schema version it produces"""
+MIGRATIONS = [
+    create_tables,
+    add_keys_and_indexes,
+    add_webhook_events,
+    add_archive,
+    add_cluster,
+    add_specialty,
+    add_queue_card,
+]
+
+
+def migrate(con):
+    """
+    Apply any migrations the database hasn't had yet.
+
+    :param con: sqlite3 connection.
+    :returns: the schema version the database is now at.
+    """
+    version = con.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        logger.info(f"Migrating database to version {number}: {migration.__name__}")
+        cur = con.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            # Another worker may have migrated while we waited for the lock
+            if cur.execute("PRAGMA user_version").fetchone()[0] >= number:
+                cur.execute("ROLLBACK")
+                continue
+            migration(cur)
+            cur.execute(f"PRAGMA user_version = {number}")
+            cur.execute("COMMIT")
+        except Exception:
+            cur.execute("ROLLBACK")
+            raise
+    return len(MIGRATIONS)
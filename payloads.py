@@ -0,0 +1,92 @@
+"""
+Webex webhook payloads.
+
+Both webhooks share one envelope; only the `data` differs between the messages and attachmentActions
+resources. Bodies are decoded with orjson when it is installed, and only the fields the bot reads
+are checked and kept, in slotted objects, rather than validating the whole envelope on every call.
+"""
+import json
+
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+
+class Payload:
+    """Base for the typed `data` of a webhook, every field is a string and those in `required` must be present."""
+
+    __slots__ = ()
+    required = ()
+
+    @classmethod
+    def from_dict(cls, data):
+        payload = cls.__new__(cls)
+        for field in cls.__slots__:
+            value = data.get(field)
+            if value is None:
+                if field in cls.required:
+                    raise ValueError(f"Webhook data is missing '{field}'.")
+            elif not isinstance(value, str):
+                raise ValueError(f"Webhook data field '{field}' is not a string.")
+            setattr(payload, field, value)
+        return payload
+
+    def __repr__(self):
+        fields = ", ".join(f"{field}={getattr(self, field)!r}" for field in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+
+class MessageData(Payload):
+    """Data of a `messages` webhook, the message text itself has to be fetched from Webex."""
+
+    __slots__ = ("id", "personId", "personEmail", "roomId")
+    required = ("id", "personId")
+
+
+class ActionData(Payload):
+    """Data of an `attachmentActions` webhook, i.e. a card button being clicked."""
+
+    __slots__ = ("id", "messageId", "personId", "roomId")
+    required = ("id", "messageId", "personId", "roomId")
+
+
+class Webhook:
+    """
+    A webhook delivery.
+
+    :param id: ID of the webhook.
+    :param resource: the resource the webhook is for, e.g. 'messages'.
+    :param event: the event, e.g. 'created'.
+    :param data: the typed payload.
+    """
+
+    __slots__ = ("id", "resource", "event", "data")
+
+    def __init__(self, id, resource, event, data):
+        self.id = id
+        self.resource = resource
+        self.event = event
+        self.data = data
+
+
+def parse_webhook(body, payload_type):
+    """
+    Decode a webhook body.
+
+    :param body: the raw request body.
+    :param payload_type: Payload class for the webhook's data, e.g. MessageData.
+    :returns: Webhook.
+    :raises ValueError: if the body isn't a webhook or is missing a field the bot needs.
+    """
+    envelope = loads(body)
+    if not isinstance(envelope, dict):
+        raise ValueError("Webhook body is not an object.")
+    data = envelope.get("data")
+    if not isinstance(data, dict):
+        raise ValueError("Webhook has no data.")
+    resource = envelope.get("resource")
+    if not isinstance(resource, str):
+        raise ValueError("Webhook has no resource.")
+    return Webhook(envelope.get("id"), resource, envelope.get("event"), payload_type.from_dict(data))
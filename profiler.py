@@ -0,0 +1,86 @@
+"""
+Sampling profiler, started and stopped on a running bot.
+
+A background thread takes the stack of every other thread at a fixed interval and counts how often
+each stack is seen. The result is in the folded format, one `frame;frame;frame count` line per
+stack with the thread name as the outermost frame, which flamegraph.pl, speedscope and most other
+flame graph tools read as it is.
+
+Only the code running when a sample is taken is seen, so time a coroutine spends awaiting Webex or
+the database shows up as the event loop waiting in `select`, use the slow trace log for that.
+"""
+import collections
+import os
+import sys
+import threading
+import time
+
+
+class Profiler:
+    """
+    Samples the stacks of the running threads.
+
+    :param interval: seconds between samples.
+    :param max_depth: the most frames kept from the top of each stack.
+    """
+
+    def __init__(self, interval=0.005, max_depth=100):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples = 0
+        self.started = None
+        self._stacks = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        """Start sampling, with a fresh profile."""
+        if self.running:
+            raise RuntimeError("The profiler is already running.")
+        self._stacks.clear()
+        self.samples = 0
+        self.started = time.perf_counter()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample_loop, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop sampling.
+
+        :returns: the profile in the folded format.
+        """
+        if not self.running:
+            raise RuntimeError("The profiler isn't running.")
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        return self.folded()
+
+    def folded(self):
+        """:returns: the profile so far in the folded format, the most common stacks first."""
+        return "".join(f"{stack} {count}\n" for stack, count in self._stacks.most_common())
+
+    def _sample_loop(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    self._stacks[self._fold(names.get(ident, str(ident)), frame)] += 1
+            self.samples += 1
+
+    def _fold(self, thread_name, frame):
+        frames = []
+        while frame is not None and len(frames) < self.max_depth:
+            code = frame.f_code
+            name = getattr(code, "co_qualname", code.co_name)
+            frames.append(f"{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        frames.append(thread_name)
+        # Outermost frame first, and no ';' inside a frame as it separates them
+        return ";".join(frame_name.replace(";", ":") for frame_name in reversed(frames))
@@ -0,0 +1,127 @@
+"""
+Queue card for the Doctors space.
+
+In a burst of emergencies a card per request, each with its own string of reminders, floods the
+Doctors space. With a queue card window set, the waiting requests are listed together on one card
+instead, each with its own accept button. The card is reposted at most once a window however many
+requests arrived, were accepted, timed out or came due for a reminder in it, and the reminders due
+in the window go out as a single reply mentioning the highest tier due.
+
+Webex can't change the attachments of a message once it has been sent, so the card is updated by
+deleting the old one and posting the new one.
+
+The card showing and the changes waiting to go out with it are kept in the database, so every worker
+and cluster instance shares the one card. Any of them can record a change, and the repost is claimed
+in the database like an escalation step, so only one of them posts the new card.
+"""
+import asyncio
+import time
+
+
+class QueueChanges:
+    """
+    What changed on the queue card since it was last posted, and how far the repost got with it.
+
+    :ivar card_id: ID of the card showing, None for none, kept up to date by the repost as it deletes and posts.
+    :ivar since: epoch time the requests on the last card were read, None if no card has been posted.
+    :ivar reminder: the highest reminder attempt due, 0 for none.
+    :ivar accepted: list of (sender name, responder name) for the requests accepted.
+    :ivar posted: True once the requests waiting are showing on the card, or there are none.
+    :ivar reminded: True once the reminder has been sent, or there was none to send.
+    :ivar announced: True once the accepted requests have been announced, or there were none.
+    """
+
+    __slots__ = ("card_id", "since", "reminder", "accepted", "posted", "reminded", "announced")
+
+    def __init__(self, card_id=None, since=None, reminder=0, accepted=()):
+        self.card_id = card_id
+        self.since = since
+        self.reminder = reminder
+        self.accepted = list(accepted)
+        self.posted = False
+        self.reminded = False
+        self.announced = False
+
+    @property
+    def done(self):
+        """True once every change has gone out."""
+        return self.posted and self.reminded and self.announced
+
+
+class QueueCard:
+    """
+    Records the changes to the queue card and has it reposted once a window.
+
+    :param db: Database the card is shared through.
+    :param scheduler: EscalationScheduler the reposts are timed with.
+    :param window: seconds changes are collected for before the card is reposted.
+    :param repost: coroutine function `repost(changes)` replacing the card, which records each step on the
+                   QueueChanges as it is done.
+    :param worker_id: ID of this worker, to claim the reposts with.
+    :param lease: seconds a claimed repost is held for before another worker can take it over.
+    """
+
+    def __init__(self, db, scheduler, window, repost, worker_id, lease=60):
+        self.db = db
+        self.scheduler = scheduler
+        self.window = window
+        self.worker_id = worker_id
+        self.lease = lease
+        self.reposts = 0
+        self._repost = repost
+        self._due = False
+        self._lock = asyncio.Lock()
+
+    async def remind(self, attempt):
+        """
+        Send a reminder with the card.
+
+        :param attempt: the attempt number of the reminder due.
+        """
+        await self.db.queue_card_changed(time.time() + self.window, reminder=attempt)
+        self._wake()
+
+    async def accepted(self, sender_name, responder_name):
+        """Tell the Doctors space a request on the card has been accepted."""
+        await self.db.queue_card_changed(time.time() + self.window, accepted=(sender_name, responder_name))
+        self._wake()
+
+    async def changed(self):
+        """Have the card reposted at the end of the window, e.g. when a request is added or has timed out."""
+        await self.db.queue_card_changed(time.time() + self.window)
+        self._wake()
+
+    async def poll(self):
+        """Repost the card if it is due, e.g. for changes recorded by another worker."""
+        if await self.db.queue_card_due(time.time()):
+            await self._run()
+
+    def _wake(self):
+        # The poll would find the change anyway, this only saves waiting for it
+        if not self._due:
+            self._due = True
+            self.scheduler.schedule("queue-card", self.window, self._run)
+
+    async def _run(self):
+        # Only one repost at a time, so there's never more than one card showing
+        async with self._lock:
+            self._due = False
+            claim = await self.db.claim_queue_card(self.worker_id, self.lease)
+            if claim is None:
+                return
+            card_id, reminder, version, since, accepted = claim
+            started = time.time()
+            changes = QueueChanges(card_id, since, reminder, [(sender_name, responder_name)
+                                                              for _, sender_name, responder_name in accepted])
+            try:
+                await self._repost(changes)
+            finally:
+                if changes.done:
+                    self.reposts += 1
+                # Only the changes which went out are cleared, the rest have the card reposted again next window
+                await self.db.release_queue_card(self.worker_id, changes.card_id,
+                                                 started if changes.posted else since,
+                                                 version if changes.done else None,
+                                                 reminder if changes.reminded else 0,
+                                                 accepted[-1][0] if accepted and changes.announced else None,
+                                                 started + self.window)
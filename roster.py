@@ -0,0 +1,116 @@
+"""
+On-call doctor roster, loaded from a JSON file.
+
+The roster lists the doctors and their shifts. When it is loaded the shifts are expanded into an
+index of fixed time slots across the week for each specialty, so finding who is on call for a
+request is a single lookup however many shifts the roster holds.
+"""
+import datetime
+import json
+from collections import namedtuple
+
+
+DAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+TIERS = ("primary", "secondary")
+DEFAULTSPECIALTY = "general"
+""" Length of a slot in the on-call index, shift times are rounded to it"""
+SLOTMINUTES = 15
+SLOTSPERDAY = 24 * 60 // SLOTMINUTES
+
+OnCall = namedtuple("OnCall", ["primary", "secondary"])
+NOBODY = OnCall((), ())
+
+
+def minutes(clock):
+    """:returns: minutes since midnight for a 'HH:MM' time."""
+    hours, mins = clock.split(":")
+    return int(hours) * 60 + int(mins)
+
+
+class Roster:
+    """
+    Doctors and their on-call shifts.
+
+    Each doctor is a dict with a `name`, a contact `url` and an `email` used to mention them in the
+    doctors space, which only doctors without shifts can leave out. Each shift is a dict with:
+        doctor: name of the doctor.
+        tier: 'primary' or 'secondary'.
+        start, end: 'HH:MM' times; a shift ending before it starts runs past midnight.
+        days: days the shift starts on, e.g. ["mon", "tue"], defaults to every day.
+        specialty: defaults to 'general'.
+
+    :param doctors: list of doctor dicts.
+    :param shifts: list of shift dicts.
+    """
+
+    def __init__(self, doctors, shifts=()):
+        self.doctors = doctors
+        self.shifts = list(shifts)
+        # Values worked out from the roster, e.g. rendered cards, dropped with the roster when it reloads
+        self.cache = {}
+        by_name = {}
+        for doctor in doctors:
+            if not doctor.get("name") or not doctor.get("url"):
+                raise ValueError(f"Roster entry {doctor} needs a name and a url.")
+            by_name[doctor["name"]] = doctor
+
+        slots = {}
+        for shift in self.shifts:
+            doctor = by_name.get(shift.get("doctor"))
+            if doctor is None:
+                raise ValueError(f"Shift {shift} is for a doctor who isn't in the roster.")
+            if not doctor.get("email"):
+                raise ValueError(f"{doctor['name']} has shifts but no email to mention them by in reminders.")
+            tier = shift.get("tier", "primary")
+            if tier not in TIERS:
+                raise ValueError(f"Shift {shift} has an unknown tier '{tier}'.")
+            start = minutes(shift["start"]) // SLOTMINUTES
+            end = minutes(shift["end"]) // SLOTMINUTES
+            length = (end - start) % SLOTSPERDAY or SLOTSPERDAY
+            specialty = shift.get("specialty", DEFAULTSPECIALTY)
+            index = slots.setdefault(specialty, [[[], []] for _ in range(7 * SLOTSPERDAY)])
+            for day in shift.get("days", DAYS):
+                first = DAYS.index(day.lower()[:3]) * SLOTSPERDAY + start
+                for slot in range(first, first + length):
+                    entry = index[slot % (7 * SLOTSPERDAY)][TIERS.index(tier)]
+                    if doctor not in entry:
+                        entry.append(doctor)
+        self._index = {specialty: [OnCall(tuple(primary), tuple(secondary)) for primary, secondary in index]
+                       for specialty, index in slots.items()}
+
+    @classmethod
+    def from_file(cls, path):
+        """
+        Load a roster file of the form {"doctors": [...], "shifts": [...]}.
+
+        :param path: path to the roster file.
+        """
+        with open(path, encoding="utf-8") as roster_file:
+            roster = json.load(roster_file)
+        return cls(roster["doctors"], roster.get("shifts", ()))
+
+    @staticmethod
+    def slot(when):
+        """:returns: the index slot a datetime falls in."""
+        return when.weekday() * SLOTSPERDAY + (when.hour * 60 + when.minute) // SLOTMINUTES
+
+    def on_call(self, when=None, specialty=None):
+        """
+        Find who is on call, falling back to the general on-call doctors if nobody in the specialty is.
+
+        :param when: datetime to look up, defaults to now.
+        :param specialty: specialty to look up, None for general.
+        :returns: OnCall of the primary and secondary doctors, both empty if nobody is rostered.
+        """
+        slot = self.slot(when or datetime.datetime.now())
+        for name in (specialty or DEFAULTSPECIALTY, DEFAULTSPECIALTY):
+            index = self._index.get(name)
+            if index is not None and (index[slot].primary or index[slot].secondary):
+                return index[slot]
+        return NOBODY
+
+    def contacts(self, when=None, specialty=None):
+        """:returns: the doctors on call, or every doctor in the roster if there are no shifts covering the time."""
+        on_call = self.on_call(when, specialty)
+        doctors = {doctor["name"]: doctor for doctor in on_call.primary + on_call.secondary}
+        return list(doctors.values()) or self.doctors
@@ -0,0 +1,116 @@
+"""
+Escalation scheduler for the triage bot.
+
+Owns the per-card timers (reminders, timeout and the fallback to the requester) so the
+webhook handlers can return straight away instead of sleeping between alerts.
+Timers live on the asyncio event loop, which keeps them in a min-heap ordered by due time.
+The local timers are only a wake-up, the escalation state itself is kept in the database so
+a periodic poll on any worker can pick up steps that are due.
+"""
+import asyncio
+
+from loguru import logger
+
+
+class EscalationScheduler:
+    """
+    Schedule and cancel timed escalation steps keyed by card ID.
+
+    Only one timer is held per card - scheduling a new step for a card replaces the
+    pending one. All timer bookkeeping happens on the event loop thread, `schedule` and
+    `cancel` are safe to call from FastAPI's threadpool.
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._timers = {}
+
+    def start(self, loop):
+        """
+        Attach the scheduler to the running event loop.
+
+        :param loop: the asyncio event loop the timers will run on.
+        """
+        self._loop = loop
+        logger.info("Escalation scheduler started.")
+
+    def stop(self):
+        """Cancel every pending timer, used when the application shuts down."""
+        for handle in self._timers.values():
+            handle.cancel()
+        self._timers.clear()
+        self._loop = None
+        logger.info("Escalation scheduler stopped.")
+
+    def schedule(self, card_id, delay, callback, *args):
+        """
+        Run `callback(*args)` after `delay` seconds for the given card.
+
+        Blocking callbacks are run in the default executor so they don't hold up the event loop,
+        coroutine functions are run as tasks.
+
+        :param card_id: ID of the card the step belongs to.
+        :param delay: seconds to wait before running the step.
+        :param callback: function (or coroutine function) to run.
+        """
+        if self._loop is None:
+            raise RuntimeError("Escalation scheduler has not been started.")
+        self._loop.call_soon_threadsafe(self._arm, card_id, delay, callback, args)
+
+    def schedule_periodic(self, key, interval, callback, *args):
+        """
+        Run `callback(*args)` every `interval` seconds until cancelled with `cancel(key)`.
+        The next run is only armed once the previous one has finished, so runs never overlap.
+
+        :param key: name for the periodic job.
+        :param interval: seconds between the end of one run and the start of the next.
+        :param callback: function (or coroutine function) to run.
+        """
+        async def run():
+            try:
+                if asyncio.iscoroutinefunction(callback):
+                    await callback(*args)
+                else:
+                    await self._loop.run_in_executor(None, callback, *args)
+            finally:
+                if self._loop is not None:
+                    self.schedule(key, interval, run)
+
+        self.schedule(key, interval, run)
+
+    def cancel(self, card_id):
+        """
+        Cancel the pending step for a card, if there is one.
+
+        :param card_id: ID of the card to stop escalating.
+        """
+        if self._loop is None:
+            return
+        self._loop.call_soon_threadsafe(self._disarm, card_id)
+
+    def pending(self):
+        """:returns: number of cards with a pending escalation step."""
+        return len(self._timers)
+
+    def _arm(self, card_id, delay, callback, args):
+        self._disarm(card_id)
+        self._timers[card_id] = self._loop.call_later(delay, self._fire, card_id, callback, args)
+
+    def _disarm(self, card_id):
+        handle = self._timers.pop(card_id, None)
+        if handle is not None:
+            handle.cancel()
+            logger.debug(f"Cancelled escalation for card {card_id}")
+
+    def _fire(self, card_id, callback, args):
+        self._timers.pop(card_id, None)
+        if asyncio.iscoroutinefunction(callback):
+            future = self._loop.create_task(callback(*args))
+        else:
+            future = self._loop.run_in_executor(None, callback, *args)
+        future.add_done_callback(self._report)
+
+    @staticmethod
+    def _report(future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.opt(exception=future.exception()).error("Escalation step failed.")
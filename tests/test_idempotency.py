@@ -0,0 +1,57 @@
+"""
+Behaviour of the duplicate webhook suppression.
+"""
+import asyncio
+import sqlite3
+
+import pytest
+
+from idempotency import EventDeduplicator
+
+
+class FakeDatabase:
+    """Records events in memory, failing the first `failures` writes like a locked database."""
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.events = set()
+
+    async def record_event(self, event_id, resource):
+        if self.failures:
+            self.failures -= 1
+            raise sqlite3.OperationalError("database is locked")
+        if event_id in self.events:
+            return False
+        self.events.add(event_id)
+        return True
+
+
+def test_duplicates_are_suppressed():
+    deduplicator = EventDeduplicator(FakeDatabase())
+
+    async def deliver():
+        return [await deduplicator.first_delivery(event_id, "messages") for event_id in ("a", "b", "a")]
+
+    assert asyncio.run(deliver()) == [True, True, False]
+    assert deduplicator.suppressed == 1
+
+
+def test_duplicate_seen_by_another_worker():
+    db = FakeDatabase()
+    first, second = EventDeduplicator(db), EventDeduplicator(db)
+
+    async def deliver():
+        return [await first.first_delivery("a", "messages"), await second.first_delivery("a", "messages")]
+
+    assert asyncio.run(deliver()) == [True, False]
+
+
+def test_redelivery_after_a_failed_write_is_handled():
+    deduplicator = EventDeduplicator(FakeDatabase(failures=1))
+
+    async def deliver():
+        with pytest.raises(sqlite3.OperationalError):
+            await deduplicator.first_delivery("a", "messages")
+        return await deduplicator.first_delivery("a", "messages")
+
+    assert asyncio.run(deliver()) is True
@@ -0,0 +1,61 @@
+"""
+Behaviour of the bounded ingest queue when it is full.
+"""
+import asyncio
+
+from ingest import ACCEPT, MESSAGE, WorkQueue, severity_lane
+
+
+async def noop(*args):
+    pass
+
+
+def test_shed_work_is_put_off_up_to_a_limit():
+    async def flood():
+        work = WorkQueue(maxsize=2, workers=1, max_deferred=3)
+        # Not started workers, so nothing is taken off the queue
+        work._ready = asyncio.Semaphore(0)
+        queued = [work.submit(MESSAGE, noop, number, defer=60) for number in range(10)]
+        deferred = work.deferred()
+        await work.stop()
+        return queued, deferred, work.deferred()
+
+    queued, deferred, after_stop = asyncio.run(flood())
+    assert queued == [True, True] + [False] * 8
+    assert deferred["message"] == 3
+    assert after_stop["message"] == 0
+
+
+def test_emergencies_and_clicks_push_out_messages():
+    async def flood():
+        work = WorkQueue(maxsize=2, workers=1)
+        work._ready = asyncio.Semaphore(0)
+        for number in range(2):
+            work.submit(MESSAGE, noop, number, defer=60)
+        queued = [work.submit(severity_lane("critical"), noop), work.submit(ACCEPT, noop),
+                  work.submit(severity_lane("high"), noop)]
+        depth, deferred = work.depth(), work.deferred()
+        await work.stop()
+        return queued, depth, deferred
+
+    queued, depth, deferred = asyncio.run(flood())
+    assert queued == [True, True, True]
+    assert (depth["critical"], depth["high"], depth["accept"], depth["message"]) == (1, 1, 1, 0)
+    assert deferred["message"] == 2
+
+
+def test_put_off_work_is_queued_again():
+    async def flood():
+        work = WorkQueue(maxsize=1, workers=1)
+        work._ready = asyncio.Semaphore(0)
+        work.submit(MESSAGE, noop, 0, defer=0.01)
+        work.submit(MESSAGE, noop, 1, defer=0.01)
+        # The first message is taken off, so the second one fits when it comes back
+        work._take()
+        await asyncio.sleep(0.05)
+        depth, deferred = work.depth(), work.deferred()
+        await work.stop()
+        return depth, deferred
+
+    depth, deferred = asyncio.run(flood())
+    assert depth["message"] == 1 and deferred["message"] == 0
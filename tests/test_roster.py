@@ -0,0 +1,87 @@
+"""
+Behaviour of the on-call lookup, including shifts running past midnight and across the end of the week.
+"""
+import datetime
+
+import pytest
+
+from roster import Roster
+
+DOCTORS = [{"name": name, "url": f"https://example.com/{name}", "email": f"{name}@example.com"}
+           for name in ("ollie", "sam", "kim", "lee")]
+
+
+def at(day, clock):
+    """:returns: the datetime of `clock` on a day of the week starting from Monday 0."""
+    hours, minutes = map(int, clock.split(":"))
+    # 2024-01-01 was a Monday
+    return datetime.datetime(2024, 1, 1 + day, hours, minutes)
+
+
+def names(doctors):
+    return [doctor["name"] for doctor in doctors]
+
+
+@pytest.fixture
+def roster():
+    return Roster(DOCTORS, [
+        {"doctor": "ollie", "tier": "primary", "start": "08:00", "end": "20:00", "days": ["mon", "tue", "wed"]},
+        {"doctor": "sam", "tier": "primary", "start": "20:00", "end": "08:00", "days": ["sun"]},
+        {"doctor": "kim", "tier": "secondary", "start": "00:00", "end": "00:00", "days": ["Saturday"]},
+        {"doctor": "lee", "tier": "primary", "start": "09:00", "end": "17:00", "specialty": "cardiology"},
+    ])
+
+
+def test_day_shift(roster):
+    assert names(roster.on_call(at(0, "08:00")).primary) == ["ollie"]
+    assert names(roster.on_call(at(2, "19:59")).primary) == ["ollie"]
+    assert roster.on_call(at(2, "20:00")).primary == ()
+    assert roster.on_call(at(3, "12:00")).primary == ()
+
+
+def test_overnight_shift_wraps_the_week(roster):
+    assert names(roster.on_call(at(6, "20:00")).primary) == ["sam"]
+    assert names(roster.on_call(at(6, "23:59")).primary) == ["sam"]
+    # Sunday night runs into Monday morning
+    assert names(roster.on_call(at(0, "03:00")).primary) == ["sam"]
+    assert names(roster.on_call(at(0, "07:59")).primary) == ["sam"]
+    assert names(roster.on_call(at(0, "08:00")).primary) == ["ollie"]
+    assert names(roster.on_call(at(6, "19:59")).primary) == []
+
+
+def test_whole_day_shift(roster):
+    assert names(roster.on_call(at(5, "00:00")).secondary) == ["kim"]
+    assert names(roster.on_call(at(5, "23:59")).secondary) == ["kim"]
+    assert roster.on_call(at(6, "00:00")).secondary == ()
+
+
+def test_specialty_falls_back_to_general(roster):
+    assert names(roster.on_call(at(0, "10:00"), "cardiology").primary) == ["lee"]
+    assert names(roster.on_call(at(0, "18:00"), "cardiology").primary) == ["ollie"]
+    assert names(roster.on_call(at(0, "10:00"), "neurology").primary) == ["ollie"]
+    assert names(roster.on_call(at(0, "10:00")).primary) == ["ollie"]
+
+
+def test_contacts(roster):
+    assert names(roster.contacts(at(0, "03:00"))) == ["sam"]
+    # Nobody on call, so everyone
+    assert names(roster.contacts(at(3, "03:00"))) == names(DOCTORS)
+
+
+def test_no_shifts_is_nobody():
+    assert Roster(DOCTORS).on_call(at(0, "12:00")) == ((), ())
+
+
+@pytest.mark.parametrize("shift", [
+    {"doctor": "nobody", "start": "08:00", "end": "20:00"},
+    {"doctor": "ollie", "tier": "tertiary", "start": "08:00", "end": "20:00"},
+])
+def test_bad_shifts(shift):
+    with pytest.raises(ValueError):
+        Roster(DOCTORS, [shift])
+
+
+def test_doctor_with_shifts_needs_an_email():
+    with pytest.raises(ValueError):
+        Roster([{"name": "ollie", "url": "https://example.com/ollie"}],
+               [{"doctor": "ollie", "start": "08:00", "end": "20:00"}])
@@ -0,0 +1,94 @@
+"""
+Behaviour of the trigger word matching.
+"""
+import pytest
+
+from triggers import DEFAULT_TRIGGERS, TriggerEngine, anchors, typo_variants
+
+
+@pytest.fixture(scope="module")
+def engine():
+    return TriggerEngine(DEFAULT_TRIGGERS)
+
+
+@pytest.mark.parametrize("message, keyword", [
+    ("Please help", "help"),
+    ("I need HELP now", "help"),
+    ("helping hand", "help"),
+    ("emergency at home", "emergency"),
+    ("this is an emergancy", "emergency"),
+    ("hlep me", "help"),
+    ("need assistance", "assistance"),
+    ("can you assist", "assist"),
+    ("tech support", "support"),
+])
+def test_match(engine, message, keyword):
+    assert engine.match(message).keyword == keyword
+
+
+@pytest.mark.parametrize("message", ["", None, "hello there", "held up at work", "see you later"])
+def test_no_match(engine, message):
+    assert engine.match(message) is None
+
+
+def test_highest_severity_wins(engine):
+    found = engine.match("support please, help, it's an emergency")
+    assert (found.keyword, found.severity) == ("emergency", "critical")
+
+
+def test_first_wins_a_tie(engine):
+    assert engine.match("assist or help").keyword == "assist"
+
+
+def test_typo_reports_its_spelling(engine):
+    found = engine.match("emergnecy")
+    assert (found.keyword, found.text) == ("emergency", "emergnecy")
+
+
+def test_exact_keyword_wins_over_a_typo_of_another():
+    engine = TriggerEngine([{"keyword": "assistance", "fuzzy": True}, {"keyword": "assistanc", "severity": "low"}])
+    assert engine.match("assistanc").keyword == "assistanc"
+
+
+def test_word_boundary():
+    engine = TriggerEngine([{"keyword": "help", "word_boundary": True}])
+    assert engine.match("help me").keyword == "help"
+    assert engine.match("(help)").keyword == "help"
+    assert engine.match("helping") is None
+    assert engine.match("whelp") is None
+
+
+def test_specialty_and_language_are_reported():
+    engine = TriggerEngine([{"keyword": "chest pain", "severity": "critical", "language": "en",
+                             "specialty": "cardiology"}])
+    assert engine.match("I have chest pain") == ("chest pain", "critical", "en", "chest pain", "cardiology")
+
+
+def test_unknown_severity():
+    with pytest.raises(ValueError):
+        TriggerEngine([{"keyword": "help", "severity": "urgent"}])
+
+
+def test_typo_variants():
+    assert {"hlep", "hhelp", "helpp"} <= typo_variants("help")
+    # Short keywords don't drop or replace letters, e.g. 'held'
+    assert "held" not in typo_variants("help") and "hep" not in typo_variants("help")
+    assert {"emergncy", "emergancy"} <= typo_variants("emergency")
+    assert "emergency" not in typo_variants("emergency")
+
+
+@pytest.mark.parametrize("keyword", ["help", "assist", "support", "emergency", "assistance", "chest pain"])
+def test_every_spelling_contains_an_anchor(keyword):
+    spellings = {keyword} | typo_variants(keyword)
+    found = anchors(keyword, spellings)
+    assert all(any(anchor in spelling for anchor in found) for spelling in spellings)
+
+
+def test_anchors_of_a_plain_keyword():
+    assert anchors("support", {"support"}) == {"support"}
+
+
+def test_every_typo_matches():
+    engine = TriggerEngine([{"keyword": "emergency", "fuzzy": True}])
+    for spelling in typo_variants("emergency"):
+        assert engine.match(f"it's an {spelling.upper()}!").keyword == "emergency"
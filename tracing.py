@@ -0,0 +1,222 @@
+"""
+Opt-in tracing of the work done for each webhook, to see where the time went when one is slow.
+
+A trace is started by the functions doing the work (decorated with `traced`) and every Webex call,
+outbound send and database query made while it runs is recorded as a span in it, with its parent
+found through a context variable, so the spans follow the work across `await` and `gather`. A trace
+taking longer than the threshold is logged as a tree of its spans with their timings, e.g.
+
+    Slow trace accept_request 1520.3ms
+      sqlite write 4.1ms
+      webex GET people 210.0ms
+      create_room 1302.5ms
+        dispatch urgent 840.2ms
+          webex POST rooms 650.7ms
+
+Tracing is off until a threshold is set with `configure`, and while it is off the hooks cost a
+context variable lookup.
+"""
+import contextvars
+import functools
+import time
+
+from loguru import logger
+
+
+""" The most spans kept in one trace, anything past it is counted and left out"""
+MAXSPANS = 500
+
+_current = contextvars.ContextVar("triage_span", default=None)
+
+
+class Span:
+    """
+    A timed step of a trace.
+
+    :param name: what the step is, e.g. 'webex GET messages'.
+    :param tags: extra details shown with the span.
+    :param parent: the span it is part of, None for the root of a trace.
+    """
+
+    __slots__ = ("name", "tags", "parent", "root", "start", "end", "children", "spans", "dropped", "_token")
+
+    def __init__(self, name, tags, parent=None):
+        self.name = name
+        self.tags = tags
+        self.parent = parent
+        self.root = parent.root if parent is not None else self
+        self.start = None
+        self.end = None
+        self.children = []
+        self.spans = 1
+        self.dropped = 0
+        self._token = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        if self.parent is not None:
+            self.parent.children.append(self)
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, *exc):
+        self.end = time.perf_counter()
+        _current.reset(self._token)
+        if self.parent is None:
+            TRACER.finish(self)
+
+    def tag(self, key, value):
+        """Add a detail to the span, e.g. the status of a Webex call once it has answered."""
+        self.tags[key] = value
+
+    def duration(self):
+        """:returns: seconds the span took, or has taken so far if it is still running."""
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    def lines(self, depth=0):
+        """:returns: the span and its children as indented lines of text."""
+        tags = "".join(f" {key}={value}" for key, value in self.tags.items())
+        running = "" if self.end is not None else " (still running)"
+        result = [f"{'  ' * depth}{self.name} {self.duration() * 1000:.1f}ms{tags}{running}"]
+        for child in self.children:
+            result.extend(child.lines(depth + 1))
+        return result
+
+
+class NoSpan:
+    """Stands in for a span when nothing is being traced."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def tag(self, key, value):
+        pass
+
+
+NOSPAN = NoSpan()
+
+
+class Tracer:
+    """
+    Starts traces and logs the slow ones.
+
+    :param slow: seconds a trace has to take to be logged, None to not trace at all.
+    """
+
+    def __init__(self, slow=None):
+        self.slow = slow
+        self.traces = 0
+        self.slow_traces = 0
+
+    def start(self, name, tags, root=False):
+        """
+        :returns: a span for a step, part of the running trace if there is one and `root` isn't set, otherwise
+                  the root of a new trace.
+        """
+        parent = None if root else active()
+        if parent is not None and not self._admit(parent):
+            return NOSPAN
+        return Span(name, tags, parent)
+
+    def span(self, name, tags):
+        """:returns: a span for a step of the running trace, or NOSPAN if nothing is being traced."""
+        parent = active()
+        if parent is None or not self._admit(parent):
+            return NOSPAN
+        return Span(name, tags, parent)
+
+    def finish(self, root):
+        """Count a finished trace, and log it if it was slow."""
+        self.traces += 1
+        if self.slow is not None and root.duration() >= self.slow:
+            self.slow_traces += 1
+            text = "\n".join(root.lines())
+            dropped = f"\n({root.dropped} more spans left out)" if root.dropped else ""
+            logger.warning(f"Slow trace {text}{dropped}")
+
+    @staticmethod
+    def _admit(parent):
+        root = parent.root
+        if root.spans >= MAXSPANS:
+            root.dropped += 1
+            return False
+        root.spans += 1
+        return True
+
+
+TRACER = Tracer()
+
+
+def configure(slow):
+    """
+    Turn tracing on or off.
+
+    :param slow: seconds a trace has to take to be logged, None to turn tracing off.
+    """
+    TRACER.slow = slow
+
+
+def active():
+    """:returns: the span running in this context, or None if there isn't one or its trace has finished."""
+    current = _current.get()
+    if current is None or current.root.end is not None:
+        return None
+    return current
+
+
+def span(name, **tags):
+    """
+    Context manager recording a step of the running trace, e.g. `with span("sqlite read"):`.
+
+    :param name: what the step is.
+    :param tags: extra details shown with the span.
+    """
+    if TRACER.slow is None:
+        return NOSPAN
+    return TRACER.span(name, tags)
+
+
+def traced(name, root=False):
+    """
+    Decorator tracing each call of a coroutine function.
+
+    :param name: name of the span.
+    :param root: always start a new trace, for work run on its own (e.g. from a queue or a timer), rather
+                 than being part of the trace it was started from.
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            if TRACER.slow is None:
+                return await function(*args, **kwargs)
+            with TRACER.start(name, {}, root):
+                return await function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def bind(call):
+    """
+    Carry the running span over to a coroutine function which will be awaited somewhere else, e.g. by a
+    dispatcher worker, so the spans it records are part of this trace.
+
+    :param call: coroutine function.
+    :returns: `call`, wrapped if there is a trace running.
+    """
+    parent = active() if TRACER.slow is not None else None
+    if parent is None:
+        return call
+
+    @functools.wraps(call)
+    async def wrapper(*args, **kwargs):
+        token = _current.set(parent)
+        try:
+            return await call(*args, **kwargs)
+        finally:
+            _current.reset(token)
+    return wrapper
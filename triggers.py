@@ -0,0 +1,185 @@
+"""
+Trigger word matching for incoming messages.
+
+Like the original scan a keyword matches anywhere in a message, so 'helping' triggers on 'help',
+unless its entry asks for whole words only. Entries can be marked fuzzy, in which case the common
+typos of the keyword are matched as well.
+
+Each keyword is compiled into its own regular expression, built as a trie of its spellings. Most
+messages contain no trigger at all, so a message is first checked for a few short pieces of each
+keyword (its anchors) with plain substring checks, which every spelling of the keyword contains at
+least one of, and only a keyword with an anchor in the message has its expression run.
+"""
+import json
+import re
+import string
+from collections import namedtuple
+
+
+""" Severities in priority order, the highest severity found in a message is the one reported"""
+SEVERITIES = ("critical", "high", "medium", "low")
+
+DEFAULT_TRIGGERS = [
+    {"keyword": "emergency", "severity": "critical", "fuzzy": True},
+    {"keyword": "help", "severity": "high", "fuzzy": True},
+    {"keyword": "assistance", "severity": "high", "fuzzy": True},
+    {"keyword": "assist", "severity": "high"},
+    {"keyword": "support", "severity": "medium"},
+]
+
+TriggerMatch = namedtuple("TriggerMatch", ["keyword", "severity", "language", "text", "specialty"])
+
+
+def typo_variants(keyword):
+    """
+    Generate the typos of a keyword matched by a fuzzy entry:
+    two neighbouring letters swapped and a letter typed twice for any keyword, plus a single
+    letter dropped or replaced for keywords of six letters or more (shorter words have too many
+    real words one letter away, e.g. 'help' and 'held').
+
+    :param keyword: lower case keyword.
+    :returns: set of variants, not including the keyword itself.
+    """
+    variants = set()
+    for i in range(len(keyword) - 1):
+        variants.add(keyword[:i] + keyword[i + 1] + keyword[i] + keyword[i + 2:])
+    for i in range(len(keyword)):
+        variants.add(keyword[:i + 1] + keyword[i] + keyword[i + 1:])
+    if len(keyword) >= 6:
+        for i in range(len(keyword)):
+            variants.add(keyword[:i] + keyword[i + 1:])
+            for letter in string.ascii_lowercase:
+                variants.add(keyword[:i] + letter + keyword[i + 1:])
+    variants.discard(keyword)
+    return variants
+
+
+def trie_pattern(words):
+    """
+    Build a regular expression matching any of `words`, nested as a trie so shared prefixes are
+    only tested once, e.g. ['help', 'hlep'] becomes 'h(?:elp|lep)'.
+
+    :param words: iterable of strings.
+    :returns: regular expression source.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = True
+
+    def build(node):
+        ends = "" in node
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        if len(branches) == 1 and not ends:
+            return branches[0]
+        pattern = "(?:" + "|".join(branches) + ")"
+        return pattern + "?" if ends else pattern
+
+    return build(trie)
+
+
+def anchors(keyword, spellings):
+    """
+    Pick the pieces of a keyword to look for before running its expression.
+    A single typo changes at most two neighbouring letters, so one of the keyword's halves, less the
+    letter next to the middle, is left intact in every spelling, e.g. 'eme' or 'ency' for 'emergency'.
+    Keywords too short to split are looked for by every spelling which doesn't contain another.
+
+    :param keyword: lower case keyword.
+    :param spellings: the keyword and the typos matched for it.
+    :returns: set of strings, every spelling contains at least one of them.
+    """
+    if len(spellings) == 1:
+        return {keyword}
+    half = len(keyword) // 2
+    pieces = {keyword[:half - 1], keyword[half + 1:]}
+    if min(len(piece) for piece in pieces) < 3 or not all(any(piece in spelling for piece in pieces)
+                                                           for spelling in spellings):
+        return {spelling for spelling in spellings
+                if not any(other != spelling and other in spelling for other in spellings)}
+    return pieces
+
+
+class TriggerEngine:
+    """
+    Compiled set of trigger keywords.
+
+    Each entry is a dict with:
+        keyword: word or phrase to match (case insensitive).
+        severity: one of SEVERITIES, defaults to 'high'.
+        word_boundary: only match whole words, defaults to False so the keyword matches anywhere.
+        fuzzy: also match common typos of the keyword, defaults to False.
+        language: optional language tag, reported with the match.
+        specialty: optional roster specialty whose on-call doctors the request goes to, e.g. 'cardiology'.
+
+    :param entries: list of trigger entries.
+    """
+
+    def __init__(self, entries):
+        self.entries = {}
+        self.regexes = []
+        by_anchor = {}
+        for entry in entries:
+            keyword = entry["keyword"].casefold().strip()
+            severity = entry.get("severity", "high")
+            if severity not in SEVERITIES:
+                raise ValueError(f"Unknown severity '{severity}' for trigger '{keyword}'.")
+            spellings = {keyword}
+            if entry.get("fuzzy", False):
+                spellings |= typo_variants(keyword)
+            for spelling in spellings:
+                found = TriggerMatch(keyword, severity, entry.get("language"), spelling, entry.get("specialty"))
+                current = self.entries.get(spelling)
+                # An exact keyword always wins over another keyword's typo
+                if current is None or (current.text != current.keyword and spelling == keyword):
+                    self.entries[spelling] = found
+            pattern = trie_pattern(spellings)
+            if entry.get("word_boundary", False):
+                # Lookarounds rather than \b, so the match can only start where a word starts
+                pattern = r"(?<!\w)" + pattern + r"(?!\w)"
+            for anchor in anchors(keyword, spellings):
+                by_anchor.setdefault(anchor, []).append(len(self.regexes))
+            self.regexes.append((SEVERITIES.index(severity), re.compile(pattern)))
+        # An anchor containing another is only found where the shorter one is, so only look for the shorter one
+        for anchor in sorted(by_anchor, key=len, reverse=True):
+            shorter = next((other for other in by_anchor if other != anchor and other in anchor), None)
+            if shorter is not None:
+                by_anchor[shorter].extend(by_anchor.pop(anchor))
+        self.anchors = [(anchor, tuple(indexes)) for anchor, indexes in by_anchor.items()]
+
+    @classmethod
+    def from_file(cls, path):
+        """
+        Load the engine from a JSON file of the form {"triggers": [entry, ...]}.
+
+        :param path: path to the trigger file.
+        """
+        with open(path, encoding="utf-8") as triggers_file:
+            return cls(json.load(triggers_file)["triggers"])
+
+    def match(self, message):
+        """
+        Find the trigger in a message with the highest severity, the first one in the message wins a tie.
+
+        :param message: text of the message.
+        :returns: TriggerMatch or None if no trigger was found.
+        """
+        if not message:
+            return None
+        text = message.casefold()
+        hits = [indexes for anchor, indexes in self.anchors if anchor in text]
+        if not hits:
+            return None
+        best = None
+        best_rank = None
+        for index in {index for indexes in hits for index in indexes}:
+            rank, regex = self.regexes[index]
+            found = regex.search(text)
+            if found is not None and (best is None or (rank, found.start()) < best_rank):
+                best = self.entries[found.group(0)]
+                best_rank = (rank, found.start())
+        return best
@@ -0,0 +1,267 @@
+"""
+Async client for the parts of the Webex REST API used by the triage bot.
+
+All calls go through one pooled keep-alive `httpx.AsyncClient`, so a slow Webex call only
+holds up the coroutine that made it rather than the whole event loop. The interface follows
+webexteamssdk (`api.messages.create(...)`, `api.people.get(...)`) with every call awaited.
+"""
+import json as jsonlib
+
+import time
+
+import httpx
+
+from metrics import counter, histogram
+from tracing import span
+
+
+BASEURL = "https://webexapis.com/v1/"
+
+REQUEST_SECONDS = histogram("triage_webex_request_seconds", "Time taken by Webex API calls.", ("method", "endpoint"))
+RESPONSES = counter("triage_webex_responses", "Webex API responses by status code.", ("endpoint", "status"))
+
+
+class ApiError(Exception):
+    """Raised when the Webex API returns an error response."""
+
+    def __init__(self, response):
+        self.response = response
+        self.status_code = response.status_code
+        self.tracking_id = response.headers.get("trackingId")
+        retry_after = response.headers.get("Retry-After")
+        self.retry_after = float(retry_after) if retry_after else None
+        try:
+            self.message = response.json().get("message", response.reason_phrase)
+        except ValueError:
+            self.message = response.reason_phrase
+        super().__init__(f"[{self.status_code}] {self.message} [Tracking ID: {self.tracking_id}]")
+
+
+class RawJSON(str):
+    """Already serialised JSON, spliced into a request body as-is (e.g. a pre-rendered card)."""
+
+
+def encode_body(body):
+    """
+    Encode a request body as JSON, inserting any RawJSON values without re-encoding them.
+
+    :param body: dict for the body.
+    :returns: the encoded body as bytes.
+    """
+    raw = {key: value for key, value in body.items() if isinstance(value, RawJSON)}
+    if not raw:
+        return jsonlib.dumps(body).encode()
+    plain = jsonlib.dumps({key: value for key, value in body.items() if key not in raw})
+    spliced = ",".join(f"{jsonlib.dumps(key)}:{value}" for key, value in raw.items())
+    return (plain[:-1] + ("," if len(plain) > 2 else "") + spliced + "}").encode()
+
+
+class WebexObject:
+    """Read-only attribute access to the JSON returned by the Webex API, e.g. `person.displayName`."""
+
+    __slots__ = ("json_data",)
+
+    def __init__(self, json_data):
+        self.json_data = json_data
+
+    def __getattr__(self, name):
+        return self.json_data.get(name)
+
+    def __repr__(self):
+        return f"WebexObject({self.json_data!r})"
+
+
+class WebexAPI:
+    """
+    Webex API connection.
+
+    :param access_token: bot access token.
+    :param base_url: Webex API base URL.
+    :param max_connections: the most connections kept open to Webex at once.
+    :param timeout: seconds before a request to Webex is abandoned.
+    """
+
+    def __init__(self, access_token, base_url=BASEURL, max_connections=20, timeout=30):
+        self.access_token = access_token
+        self.base_url = base_url
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self._client = None
+        self.messages = MessagesAPI(self)
+        self.people = PeopleAPI(self)
+        self.rooms = RoomsAPI(self)
+        self.memberships = MembershipsAPI(self)
+        self.webhooks = WebhooksAPI(self)
+        self.attachment_actions = AttachmentActionsAPI(self)
+
+    @property
+    def client(self):
+        """The pooled HTTP client, created on first use so it belongs to the running event loop."""
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers={"Authorization": f"Bearer {self.access_token}"},
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections),
+                timeout=self.timeout,
+            )
+        return self._client
+
+    async def close(self):
+        """Close the pooled connections."""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def send(self, method, url, params=None, json=None):
+        """
+        Send a request to Webex.
+
+        :param method: HTTP method.
+        :param url: path relative to the API base URL, or an absolute URL.
+        :param params: query string parameters, entries set to None are left out.
+        :param json: JSON body, entries set to None are left out.
+        :returns: the httpx response.
+        :raises ApiError: if Webex returns an error.
+        """
+        if params is not None:
+            params = {key: value for key, value in params.items() if value is not None}
+        content, headers = None, None
+        if json is not None:
+            content = encode_body({key: value for key, value in json.items() if value is not None})
+            headers = {"Content-Type": "application/json"}
+        # Label by the resource only, e.g. 'messages' rather than each message ID, to keep the label sets few
+        endpoint = url.split("/", 1)[0] if "://" not in url else "next"
+        start = time.perf_counter()
+        with span(f"webex {method} {endpoint}") as current:
+            try:
+                response = await self.client.request(method, url, params=params, content=content, headers=headers)
+            finally:
+                REQUEST_SECONDS.labels(method, endpoint).observe(time.perf_counter() - start)
+            current.tag("status", response.status_code)
+        RESPONSES.labels(endpoint, response.status_code).inc()
+        if response.status_code >= 400:
+            raise ApiError(response)
+        return response
+
+    async def request(self, method, url, params=None, json=None):
+        """
+        Send a request to Webex and decode the response.
+
+        :returns: the decoded JSON response, or None for an empty response.
+        :raises ApiError: if Webex returns an error.
+        """
+        response = await self.send(method, url, params=params, json=json)
+        if response.status_code == 204 or not response.content:
+            return None
+        return response.json()
+
+    async def list(self, url, params=None):
+        """
+        Retrieve every item of a list endpoint, following the `Link` header across pages.
+
+        :returns: list of WebexObject.
+        :raises ApiError: if Webex returns an error.
+        """
+        items = []
+        while url:
+            response = await self.send("GET", url, params=params)
+            items.extend(WebexObject(item) for item in response.json().get("items", []))
+            url = response.links.get("next", {}).get("url")
+            params = None
+        return items
+
+
+class MessagesAPI:
+    """Webex `/messages` endpoint."""
+
+    def __init__(self, api):
+        self._api = api
+
+    async def get(self, messageId):
+        return WebexObject(await self._api.request("GET", f"messages/{messageId}"))
+
+    async def create(self, roomId=None, parentId=None, toPersonId=None, toPersonEmail=None,
+                     text=None, markdown=None, attachments=None):
+        body = {
+            "roomId": roomId,
+            "parentId": parentId,
+            "toPersonId": toPersonId,
+            "toPersonEmail": toPersonEmail,
+            "text": text,
+            "markdown": markdown,
+            "attachments": attachments,
+        }
+        return WebexObject(await self._api.request("POST", "messages", json=body))
+
+    async def delete(self, messageId):
+        await self._api.request("DELETE", f"messages/{messageId}")
+
+
+class PeopleAPI:
+    """Webex `/people` endpoint."""
+
+    def __init__(self, api):
+        self._api = api
+
+    async def get(self, personId):
+        return WebexObject(await self._api.request("GET", f"people/{personId}"))
+
+    async def me(self):
+        return WebexObject(await self._api.request("GET", "people/me"))
+
+
+class RoomsAPI:
+    """Webex `/rooms` endpoint."""
+
+    def __init__(self, api):
+        self._api = api
+
+    async def create(self, title, teamId=None):
+        return WebexObject(await self._api.request("POST", "rooms", json={"title": title, "teamId": teamId}))
+
+    async def delete(self, roomId):
+        await self._api.request("DELETE", f"rooms/{roomId}")
+
+
+class MembershipsAPI:
+    """Webex `/memberships` endpoint."""
+
+    def __init__(self, api):
+        self._api = api
+
+    async def list(self, roomId=None, personId=None):
+        return await self._api.list("memberships", params={"roomId": roomId, "personId": personId})
+
+    async def create(self, roomId, personId=None, personEmail=None, isModerator=False):
+        body = {"roomId": roomId, "personId": personId, "personEmail": personEmail, "isModerator": isModerator}
+        return WebexObject(await self._api.request("POST", "memberships", json=body))
+
+
+class AttachmentActionsAPI:
+    """Webex `/attachment/actions` endpoint, a click on a card with the values it submitted in `inputs`."""
+
+    def __init__(self, api):
+        self._api = api
+
+    async def get(self, actionId):
+        return WebexObject(await self._api.request("GET", f"attachment/actions/{actionId}"))
+
+
+class WebhooksAPI:
+    """Webex `/webhooks` endpoint."""
+
+    def __init__(self, api):
+        self._api = api
+
+    async def list(self):
+        return await self._api.list("webhooks")
+
+    async def create(self, name, targetUrl, resource, event, filter=None, secret=None):
+        body = {"name": name, "targetUrl": targetUrl, "resource": resource, "event": event,
+                "filter": filter, "secret": secret}
+        return WebexObject(await self._api.request("POST", "webhooks", json=body))
+
+    async def update(self, webhookId, name, targetUrl, status=None):
+        body = {"name": name, "targetUrl": targetUrl, "status": status}
+        return WebexObject(await self._api.request("PUT", f"webhooks/{webhookId}", json=body))